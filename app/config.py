@@ -0,0 +1,79 @@
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+# Настройки приложения; любое значение можно переопределить переменной окружения
+class Config:
+    SECRET_KEY = os.environ.get('COSMETICSHOP_SECRET_KEY', "replace-this-with-a-secure-random-key-in-production")
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'COSMETICSHOP_DATABASE_URL',
+        f'sqlite:///{os.path.join(basedir, "cosmeticshop.db")}'
+    )
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Пул соединений (для файловой SQLite и серверных СУБД)
+    DB_POOL_SIZE = _env_int('COSMETICSHOP_DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = _env_int('COSMETICSHOP_DB_MAX_OVERFLOW', 10)
+    DB_POOL_TIMEOUT = _env_int('COSMETICSHOP_DB_POOL_TIMEOUT', 30)
+
+    # PRAGMA для каждого нового соединения SQLite
+    SQLITE_JOURNAL_MODE = os.environ.get('COSMETICSHOP_SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('COSMETICSHOP_SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_CACHE_SIZE = _env_int('COSMETICSHOP_SQLITE_CACHE_SIZE', -65536)
+    SQLITE_MMAP_SIZE = _env_int('COSMETICSHOP_SQLITE_MMAP_SIZE', 268435456)
+    SQLITE_BUSY_TIMEOUT = _env_int('COSMETICSHOP_SQLITE_BUSY_TIMEOUT', 5000)
+
+    # Время жизни кэша каталога и категорий в памяти процесса, сек
+    CATALOG_CACHE_TTL = _env_int('COSMETICSHOP_CATALOG_CACHE_TTL', 300)
+
+    # Наибольшее время жизни кэша пользователей Flask-Login в памяти процесса, сек;
+    # изменение пользователя сбрасывает копии раньше через счетчик в cache_versions
+    USER_CACHE_TTL = _env_int('COSMETICSHOP_USER_CACHE_TTL', 30)
+
+    # Параметры хэширования паролей (формат werkzeug: "scrypt:32768:8:1", "pbkdf2:sha256:600000").
+    # Старые хэши пересчитываются с новыми параметрами при успешном входе.
+    PASSWORD_HASH_METHOD = os.environ.get('COSMETICSHOP_PASSWORD_HASH_METHOD', 'scrypt')
+    # Пул потоков для проверки паролей и ограничение неудачных попыток входа
+    LOGIN_HASH_WORKERS = _env_int('COSMETICSHOP_LOGIN_HASH_WORKERS', os.cpu_count() or 4)
+    LOGIN_HASH_TIMEOUT = _env_int('COSMETICSHOP_LOGIN_HASH_TIMEOUT', 10)
+    LOGIN_MAX_ATTEMPTS = _env_int('COSMETICSHOP_LOGIN_MAX_ATTEMPTS', 5)
+    LOGIN_ATTEMPT_WINDOW = _env_int('COSMETICSHOP_LOGIN_ATTEMPT_WINDOW', 300)
+
+    # Запросы дольше этого порога (мс) пишутся в лог cosmeticshop.requests с уровнем WARNING
+    SLOW_REQUEST_MS = _env_int('COSMETICSHOP_SLOW_REQUEST_MS', 500)
+
+    # Каталог для снимков метрик рабочих процессов (несколько процессов gunicorn/uwsgi);
+    # без него /metrics показывает только текущий процесс
+    METRICS_DIR = os.environ.get('COSMETICSHOP_METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = _env_int('COSMETICSHOP_METRICS_FLUSH_INTERVAL', 1)
+    # Доступ к /metrics: запросы с адресов из этих сетей (через запятую) или с заголовком
+    # "Authorization: Bearer <METRICS_TOKEN>". За обратным прокси адрес клиента - адрес прокси.
+    METRICS_ALLOWED_NETWORKS = os.environ.get('COSMETICSHOP_METRICS_ALLOWED_NETWORKS', '127.0.0.1/32,::1/128')
+    METRICS_TOKEN = os.environ.get('COSMETICSHOP_METRICS_TOKEN')
+
+    # Фоновые отчеты директора: потоков расчета, сколько запрос ждет готовый результат (сек),
+    # не чаще какого интервала пересчитывать отчет при новых продажах (сек),
+    # через сколько секунд считать задачу зависшей
+    REPORT_WORKERS = _env_int('COSMETICSHOP_REPORT_WORKERS', 1)
+    REPORT_WAIT_SECONDS = float(os.environ.get('COSMETICSHOP_REPORT_WAIT_SECONDS', 0.5))
+    REPORT_MIN_INTERVAL = _env_int('COSMETICSHOP_REPORT_MIN_INTERVAL', 30)
+    REPORT_JOB_TIMEOUT = _env_int('COSMETICSHOP_REPORT_JOB_TIMEOUT', 300)
+    # Период обновления страницы, пока отчет считается (сек)
+    REPORT_POLL_SECONDS = _env_int('COSMETICSHOP_REPORT_POLL_SECONDS', 2)
+
+    # Ключи идемпотентности оформления продажи в памяти процесса: не больше IDEMPOTENCY_MAX_KEYS,
+    # каждый хранится IDEMPOTENCY_TTL секунд
+    IDEMPOTENCY_MAX_KEYS = _env_int('COSMETICSHOP_IDEMPOTENCY_MAX_KEYS', 10000)
+    IDEMPOTENCY_TTL = _env_int('COSMETICSHOP_IDEMPOTENCY_TTL', 600)
+
+    # Резерв товаров открытой корзины кассы: сколько живет без продления (сек)
+    # и как часто снимаются истекшие резервы всех процессов (сек)
+    RESERVATION_TTL = _env_int('COSMETICSHOP_RESERVATION_TTL', 300)
+    RESERVATION_SWEEP_SECONDS = _env_int('COSMETICSHOP_RESERVATION_SWEEP_SECONDS', 30)
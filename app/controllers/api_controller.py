@@ -0,0 +1,198 @@
+import hashlib
+from datetime import date
+
+from flask import Blueprint, request, jsonify, abort, current_app
+from flask_login import login_required, current_user
+from werkzeug.exceptions import HTTPException
+
+from app.models.cache import current_versions
+from app.models.product import CATALOG_SEQ, ProductRepo
+from app.models.receipt import ReceiptRepo
+from app.models.reservation import MAX_CART_ID_LENGTH, ReservationError, reservations
+from app.models.sale import SaleRepo, SALES_VERSION
+from app.models.sales_rollup import SalesRollupRepo
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+product_repo = ProductRepo()
+sale_repo = SaleRepo()
+rollup_repo = SalesRollupRepo()
+receipt_repo = ReceiptRepo()
+
+CATALOG_VERSION = 'catalog'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+@bp.errorhandler(HTTPException)
+def handle_error(error):
+    return jsonify(error=error.description), error.code
+
+
+def _page_size():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+# ?fields=id,name - вернуть только перечисленные поля
+def _select_fields(items):
+    fields = request.args.get('fields')
+    if not fields:
+        return items
+    wanted = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in wanted if items and field not in items[0]]
+    if unknown:
+        abort(400, f"Неизвестные поля: {', '.join(unknown)}")
+    return [{field: item[field] for field in wanted} for item in items]
+
+
+def _page_payload(page):
+    return {
+        'items': _select_fields([item.to_dict() for item in page.items]),
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }
+
+
+# Условный GET: ETag строится из версий данных в cache_versions, адреса запроса,
+# пользователя и его роли (от роли зависит, что попадает в ответ). Если клиент прислал
+# актуальный If-None-Match, ответ 304 отдается без запросов к самим данным.
+# Last-Modified не отдается: с точностью до секунды он пропустил бы изменение,
+# сделанное в ту же секунду, и вернул бы устаревший ответ.
+# extra - прочее, от чего зависит ответ (например, текущая дата).
+def _conditional(version_names, build, extra=''):
+    versions = current_versions(version_names)
+    etag = hashlib.sha1(
+        f'{request.full_path}|{current_user.id}|{current_user.role}|{versions}|{extra}'.encode('utf-8')
+    ).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    # Клиент может хранить ответ, но перед использованием обязан его перепроверить
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.get("/products")
+@login_required
+def list_products():
+    def build():
+        page = product_repo.page(request.args.get('category', ''),
+                                 after=request.args.get('after'),
+                                 before=request.args.get('before'),
+                                 limit=_page_size())
+        return _page_payload(page)
+    return _conditional([CATALOG_VERSION], build)
+
+
+@bp.get("/products/<int:product_id>")
+@login_required
+def get_product(product_id):
+    def build():
+        product = product_repo.get_by_id(product_id)
+        if not product:
+            abort(404, "Товар не найден")
+        return _select_fields([product.to_dict()])[0]
+    return _conditional([CATALOG_VERSION], build)
+
+
+# Дельта каталога для касс: товары, измененные после номера since, и id удаленных.
+# Клиент хранит копию каталога и номер seq из ответа, следующий запрос - ?since=seq.
+# available - свободный остаток (на складе минус резервы корзин); резервы меняют
+# номер изменения товара, поэтому ответ зависит только от catalog_seq.
+@bp.get("/catalog")
+@login_required
+def catalog_changes():
+    since = max(request.args.get('since', 0, type=int), 0)
+
+    def build():
+        seq, products, deleted, reset = product_repo.get_changes(since)
+        held = reservations.held()
+        return {
+            'seq': seq,
+            'reset': reset or since == 0,
+            'products': [dict(product.to_dict(), available=product.stock_quantity - held.get(product.id, 0))
+                         for product in products],
+            'deleted': deleted,
+        }
+    return _conditional([CATALOG_SEQ], build)
+
+
+# Директор видит все продажи (можно отфильтровать по cashier_id), кассир - только свои
+@bp.get("/sales")
+@login_required
+def list_sales():
+    if current_user.is_director():
+        cashier_id = request.args.get('cashier_id', type=int)
+    else:
+        cashier_id = current_user.id
+
+    def build():
+        page = sale_repo.page_with_details(cashier_id,
+                                           after=request.args.get('after'),
+                                           before=request.args.get('before'),
+                                           limit=_page_size())
+        return _page_payload(page)
+    return _conditional([SALES_VERSION], build)
+
+
+@bp.get("/statistics")
+@login_required
+def statistics():
+    if not current_user.is_director():
+        abort(403, "Доступ запрещен")
+
+    today = date.today()
+
+    def build():
+        today_count, today_revenue = receipt_repo.get_totals(day=today)
+        total_count, total_revenue = receipt_repo.get_totals()
+        return {
+            'total_revenue': total_revenue,
+            'total_sales_count': total_count,
+            'today_revenue': today_revenue,
+            'today_sales_count': today_count,
+            'top_products': [
+                {'name': name, 'quantity': int(quantity), 'revenue': float(revenue)}
+                for name, quantity, revenue in rollup_repo.get_top_products(limit=10)
+            ],
+        }
+    return _conditional([SALES_VERSION, CATALOG_VERSION], build, extra=today.isoformat())
+
+
+# Резерв корзины кассы: {"items": [{"product_id": 1, "quantity": 2}, ...]} заменяет
+# отложенные товары корзины целиком, пустой список снимает резерв. Страница кассы
+# вызывает его при каждом изменении корзины и периодически, чтобы продлить срок.
+@bp.put("/reservations/<cart_id>")
+@login_required
+def reserve_cart(cart_id):
+    if len(cart_id) > MAX_CART_ID_LENGTH:
+        abort(400, "Неверный номер корзины")
+    payload = request.get_json(silent=True) or {}
+    try:
+        items = [(int(item['product_id']), int(item['quantity'])) for item in payload.get('items', [])]
+    except (KeyError, TypeError, ValueError):
+        abort(400, "Ожидается items: [{product_id, quantity}]")
+
+    try:
+        expires_at = reservations.reserve(cart_id, current_user.id, items)
+    except ReservationError as e:
+        return jsonify(error=str(e), errors=e.errors), 409
+    held = {}
+    for product_id, quantity in items:
+        held[product_id] = held.get(product_id, 0) + quantity
+    return jsonify(
+        cart_id=cart_id,
+        expires_at=expires_at.isoformat() if held else None,
+        items=[{'product_id': product_id, 'quantity': quantity} for product_id, quantity in held.items()],
+    )
+
+
+@bp.delete("/reservations/<cart_id>")
+@login_required
+def release_cart(cart_id):
+    reservations.release(cart_id, current_user.id)
+    return '', 204
@@ -1,6 +1,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from app.models.user import UserRepo, User, ROLE_CASHIER
+from app.models.cache import user_cache
+from app.models.metrics import registry as metrics
+from app.models.security import login_throttle, verify_password
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
@@ -14,13 +17,31 @@ def login():
     if request.method == "POST":
         username = request.form.get("username")
         password = request.form.get("password")
+        if login_throttle.is_blocked(username):
+            metrics.inc('cosmeticshop_login_failures_total', reason='throttled')
+            flash("Слишком много неудачных попыток входа. Попробуйте позже.", "error")
+            return render_template("auth/login.html")
+
         user = repo.get_by_username(username)
-        if user and user.check_password(password):
-            login_user(user)
+        try:
+            valid, new_hash = verify_password(user.password_hash, password or "") if user else (False, None)
+        except TimeoutError:
+            metrics.inc('cosmeticshop_login_failures_total', reason='timeout')
+            flash("Сервер перегружен, попробуйте войти еще раз", "error")
+            return render_template("auth/login.html")
+
+        if valid:
+            login_throttle.reset(username)
+            if new_hash:
+                repo.set_password_hash(user, new_hash)
+            # Пользователь только что загружен из базы - отдаем Flask-Login его копию вне сессии
+            login_user(user_cache.put(user))
             role_name = "Директор" if user.is_director() else "Кассир"
             flash(f"Вход выполнен успешно! Вы вошли как {role_name}.", "success")
             return redirect(url_for("products.list_products"))
         else:
+            login_throttle.record_failure(username)
+            metrics.inc('cosmeticshop_login_failures_total', reason='invalid_credentials')
             flash("Неверное имя пользователя или пароль", "error")
     return render_template("auth/login.html")
 
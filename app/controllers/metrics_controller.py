@@ -0,0 +1,32 @@
+import hmac
+import ipaddress
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from app.models import metrics
+
+bp = Blueprint("metrics", __name__)
+
+
+# Метрики открыты только сетям METRICS_ALLOWED_NETWORKS и запросам с METRICS_TOKEN
+def _is_allowed():
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    networks = config.get('METRICS_ALLOWED_NETWORKS') or ''
+    return any(address in ipaddress.ip_network(network.strip(), strict=False)
+               for network in networks.split(',') if network.strip())
+
+
+# Метрики в текстовом формате Prometheus; при нескольких рабочих процессах
+# (METRICS_DIR) - сумма по всем процессам
+@bp.get("/metrics")
+def export_metrics():
+    if not _is_allowed():
+        abort(403)
+    return Response(metrics.render(metrics.store.collect()), mimetype="text/plain; version=0.0.4")
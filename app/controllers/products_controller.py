@@ -1,11 +1,15 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify
+from flask import Blueprint, request, render_template, redirect, url_for, flash
 from flask_login import login_required, current_user
-from app.models.product import ProductRepo
+from app.models.product import ProductConflict, ProductRepo
+from app.models.product_import import ProductImporter
 from decimal import Decimal
+import io
 
 bp = Blueprint("products", __name__, url_prefix="/products")
 repo = ProductRepo()
 
+PRODUCTS_PAGE_SIZE = 48
+
 
 @bp.get("/")
 @login_required
@@ -13,16 +17,22 @@ def list_products():
     category_filter = request.args.get('category', '')
     search_term = request.args.get('search', '')
 
-    products = repo.all()
-    
-    if category_filter:
-        products = repo.filter_by_category(category_filter)
-    elif search_term:
-        products = repo.filter_by_name(search_term)
+    if search_term and not category_filter:
+        # Результаты поиска упорядочены по релевантности, курсоры - по (rank, id)
+        page = repo.search_page(search_term,
+                                after=request.args.get('after'),
+                                before=request.args.get('before'),
+                                limit=PRODUCTS_PAGE_SIZE)
+    else:
+        page = repo.page(category_filter,
+                         after=request.args.get('after'),
+                         before=request.args.get('before'),
+                         limit=PRODUCTS_PAGE_SIZE)
 
     categories = repo.get_categories()
     return render_template("products/list.html", 
-                         products=products, 
+                         products=page.items,
+                         page=page,
                          categories=categories,
                          current_category=category_filter,
                          search_term=search_term,
@@ -70,6 +80,42 @@ def create_product():
     return redirect(url_for("products.list_products"))
 
 
+@bp.get("/import")
+@login_required
+def import_form():
+    if not current_user.is_director():
+        flash("Доступ запрещен.", "error")
+        return redirect(url_for("products.list_products"))
+
+    return render_template("products/import.html", result=None)
+
+
+@bp.post("/import")
+@login_required
+def import_products():
+    if not current_user.is_director():
+        flash("Доступ запрещен.", "error")
+        return redirect(url_for("products.list_products"))
+
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("Выберите файл для импорта", "error")
+        return redirect(url_for("products.import_form"))
+
+    encoding = request.form.get("encoding") or "utf-8-sig"
+    # Файл читается построчно из потока загрузки, целиком в память не загружается
+    stream = io.TextIOWrapper(upload.stream, encoding=encoding, newline="")
+    try:
+        result = ProductImporter().import_csv(stream)
+    except (ValueError, LookupError) as e:
+        flash(f"Ошибка импорта: {str(e)}", "error")
+        return redirect(url_for("products.import_form"))
+
+    flash(f"Импорт завершен: добавлено {result.created}, обновлено {result.updated}, ошибок {result.error_count}",
+          "success" if not result.error_count else "info")
+    return render_template("products/import.html", result=result)
+
+
 @bp.get("/<int:product_id>/edit")
 @login_required
 def edit_form(product_id):
@@ -100,12 +146,22 @@ def update_product(product_id):
     price = request.form.get("price")
     stock_quantity = request.form.get("stock_quantity")
     description = request.form.get("description")
+    version = request.form.get("version", type=int)
 
     try:
         price = Decimal(price) if price else None
         stock_quantity = int(stock_quantity) if stock_quantity else None
-        repo.update(product_id, name, category, price, stock_quantity, description, None, article, package)
+        repo.update(product_id, name, category, price, stock_quantity, description, None, article, package,
+                    expected_version=version)
         flash("Товар успешно обновлен!", "success")
+    except ProductConflict as e:
+        # Форма открывается заново с введенными значениями, но с текущими остатком и версией:
+        # остаток могли изменить продажи
+        product = e.product
+        flash(f"Товар изменили, пока открыта форма: сейчас на складе {product.stock_quantity} шт., "
+              f"цена {product.price} руб. Проверьте значения и сохраните снова.", "error")
+        return render_template("products/edit.html", product=product, form=request.form,
+                               categories=repo.get_categories()), 409
     except Exception as e:
         flash(f"Ошибка при обновлении товара: {str(e)}", "error")
 
@@ -135,10 +191,10 @@ def discounts():
         return redirect(url_for("products.list_products"))
 
     search_term = request.args.get('search', '')
-    products = repo.all()
-    
     if search_term:
         products = repo.filter_by_name(search_term)
+    else:
+        products = repo.get_catalog()
 
     return render_template("products/discounts.html", 
                          products=products,
@@ -164,7 +220,7 @@ def set_discount(product_id):
                 flash("Цена со скидкой должна быть больше нуля", "error")
                 return redirect(url_for("products.discounts", search=request.form.get("search", "")))
         
-        repo.update(product_id, discount_price=discount_price)
+        repo.update(product_id, discount_price=discount_price, clear_discount=discount_price is None)
         flash("Скидка успешно установлена!" if discount_price else "Скидка удалена!", "success")
     except (ValueError, Exception) as e:
         flash(f"Ошибка при установке скидки: {str(e)}", "error")
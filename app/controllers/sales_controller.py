@@ -1,41 +1,54 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify
+from flask import Blueprint, request, render_template, redirect, url_for, flash, Response, stream_with_context
 from flask_login import login_required, current_user
 from app.models.product import ProductRepo
-from app.models.sale import SaleRepo, Sale
+from app.models.sale import SaleRepo
+from app.models.checkout import CheckoutService, CheckoutError
+from app.models.receipt import ReceiptRepo, PAYMENT_CASH
+from app.models.idempotency import MAX_KEY_LENGTH
+from app.models.reservation import MAX_CART_ID_LENGTH
+from app.models.analytics import GRANULARITIES
+from app.models.report_jobs import report_jobs
 from decimal import Decimal
+from datetime import date, datetime, timedelta
+import csv
+import io
+import json
 
 bp = Blueprint("sales", __name__, url_prefix="/sales")
 product_repo = ProductRepo()
 sale_repo = SaleRepo()
+checkout_service = CheckoutService()
+receipt_repo = ReceiptRepo()
+
+SALES_PAGE_SIZE = 50
+ANALYTICS_DEFAULT_DAYS = 30
+ASSORTMENT_DEFAULT_DAYS = 182
+EXPORT_CHUNK_ROWS = 500
+EXPORT_FIELDS = ['id', 'receipt_id', 'product_id', 'cashier_id', 'quantity', 'total_price', 'sale_date']
 
 
 @bp.get("/")
 @login_required
 def list_sales():
-    if current_user.is_director():
-        sales = sale_repo.all()
-    else:
-        sales = sale_repo.get_by_cashier(current_user.id)
+    cashier_id = None if current_user.is_director() else current_user.id
+    page = sale_repo.page_with_details(cashier_id,
+                                       after=request.args.get('after'),
+                                       before=request.args.get('before'),
+                                       limit=SALES_PAGE_SIZE)
 
-    sales_with_products = []
-    for sale in sales:
-        product = product_repo.get_by_id(sale.product_id)
-        sales_with_products.append({
-            'sale': sale,
-            'product': product
-        })
+    sales_with_products = [{'sale': sale, 'product': sale.product} for sale in page]
 
     return render_template("sales/list.html", 
                          sales_with_products=sales_with_products,
+                         page=page,
                          is_director=current_user.is_director())
 
 
 @bp.get("/create")
 @login_required
 def create_sale_form():
-    products = product_repo.all()
-    available_products = [p for p in products if p.stock_quantity > 0]
-    return render_template("sales/create.html", products=available_products)
+    # Список товаров страница берет из своей копии каталога и /api/v1/catalog
+    return render_template("sales/create.html")
 
 
 @bp.post("/create")
@@ -53,64 +66,66 @@ def create_sale():
         flash("Ошибка: несоответствие количества товаров и количеств", "error")
         return redirect(url_for("sales.create_sale_form"))
 
-    try:
-        total_sales_amount = Decimal('0')
-        sales_created = 0
-        errors = []
-
-        # Сначала проверяем все товары на доступность
-        for i, product_id_str in enumerate(product_ids):
-            try:
-                product_id = int(product_id_str)
-                quantity = int(quantities[i])
-
-                product = product_repo.get_by_id(product_id)
-                if not product:
-                    errors.append(f"Товар с ID {product_id} не найден")
-                    continue
-
-                if quantity <= 0:
-                    errors.append(f"Количество для товара '{product.name}' должно быть больше нуля")
-                    continue
-
-                if product.stock_quantity < quantity:
-                    errors.append(f"Недостаточно товара '{product.name}' на складе. Доступно: {product.stock_quantity}")
-                    continue
-            except (ValueError, IndexError) as e:
-                errors.append(f"Ошибка обработки товара: {str(e)}")
-                continue
-
-        if errors:
-            for error in errors:
-                flash(error, "error")
-            return redirect(url_for("sales.create_sale_form"))
-
-        # Если все проверки пройдены, создаем продажи и обновляем остатки
-        for i, product_id_str in enumerate(product_ids):
-            product_id = int(product_id_str)
-            quantity = int(quantities[i])
-
-            product = product_repo.get_by_id(product_id)
-            price_to_use = product.discount_price if product.discount_price else product.price
-            total_price = Decimal(str(price_to_use)) * quantity
-
-            sale_repo.add(product_id, current_user.id, quantity, total_price)
-            product_repo.update(product_id, stock_quantity=product.stock_quantity - quantity)
-
-            total_sales_amount += total_price
-            sales_created += 1
-
-        if sales_created > 0:
-            flash(f"Продажа успешно оформлена! Продано товаров: {sales_created}, Общая сумма: {total_sales_amount:.2f} руб.", "success")
-        else:
-            flash("Не удалось оформить продажу", "error")
+    errors = []
+    items = []
+    for i, product_id_str in enumerate(product_ids):
+        try:
+            items.append((int(product_id_str), int(quantities[i])))
+        except (ValueError, IndexError) as e:
+            errors.append(f"Ошибка обработки товара: {str(e)}")
+
+    # Ключ создается страницей кассы один раз на корзину: повтор POST вернет ту же продажу
+    idempotency_key = request.form.get("idempotency_key") or None
+    if idempotency_key and len(idempotency_key) > MAX_KEY_LENGTH:
+        errors.append("Неверный ключ повторной отправки")
+    # Корзина страницы кассы, товары которой отложены резервом
+    cart_id = request.form.get("cart_id") or None
+    if cart_id and len(cart_id) > MAX_CART_ID_LENGTH:
+        errors.append("Неверный номер корзины")
+
+    payment_method = request.form.get("payment_method", PAYMENT_CASH)
+    paid_amount = None
+    if payment_method == PAYMENT_CASH and request.form.get("paid_amount"):
+        try:
+            paid_amount = Decimal(request.form["paid_amount"].replace(",", "."))
+        except ArithmeticError:
+            errors.append("Неверная сумма, полученная от покупателя")
+
+    if errors:
+        for error in errors:
+            flash(error, "error")
+        return redirect(url_for("sales.create_sale_form"))
 
+    try:
+        lines = checkout_service.checkout(current_user.id, items, payment_method, paid_amount, idempotency_key,
+                                         cart_id)
+    except CheckoutError as e:
+        for error in e.errors:
+            flash(error, "error")
+        return redirect(url_for("sales.create_sale_form"))
     except Exception as e:
         flash(f"Ошибка при создании продажи: {str(e)}", "error")
+        return redirect(url_for("sales.list_sales"))
+
+    total_sales_amount = sum(line['total_price'] for line in lines)
+    message = (f"Продажа успешно оформлена! Чек №{lines[0]['receipt_id']}. "
+               f"Продано товаров: {len(lines)}, Общая сумма: {total_sales_amount:.2f} руб.")
+    if paid_amount is not None:
+        message += f" Сдача: {paid_amount - total_sales_amount:.2f} руб."
+    flash(message, "success")
 
     return redirect(url_for("sales.list_sales"))
 
 
+# Отчеты директора считаются в фоне (app.models.report_jobs); страница показывает
+# последний готовый результат и обновляется, пока идет пересчет
+def _report_job(name, **params):
+    job = report_jobs.get(name, **params)
+    if job.error:
+        flash(f"Не удалось построить отчет: {job.error}", "error")
+    return job
+
+
 @bp.get("/statistics")
 @login_required
 def statistics():
@@ -118,39 +133,117 @@ def statistics():
         flash("Доступ запрещен.", "error")
         return redirect(url_for("products.list_products"))
 
-    total_revenue = sale_repo.get_total_revenue()
-    total_sales_count = sale_repo.get_total_sales_count()
-    top_products = sale_repo.get_top_products(limit=10)
+    job = _report_job('statistics')
 
     return render_template("sales/statistics.html",
-                         total_revenue=total_revenue,
-                         total_sales_count=total_sales_count,
-                         top_products=top_products,
+                         job=job,
+                         report=job.result,
+                         is_director=True)
+
+
+@bp.get("/analytics")
+@login_required
+def analytics():
+    if not current_user.is_director():
+        flash("Доступ запрещен.", "error")
+        return redirect(url_for("products.list_products"))
+
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        granularity = 'day'
+    end_day = date.today()
+    start_day = end_day - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    try:
+        if request.args.get('start'):
+            start_day = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        if request.args.get('end'):
+            end_day = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except ValueError:
+        flash("Неверный формат даты, ожидается ГГГГ-ММ-ДД", "error")
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+
+    job = _report_job('analytics', start_day=start_day.isoformat(), end_day=end_day.isoformat(),
+                      granularity=granularity)
+    if job.result and job.result['error']:
+        flash(job.result['error'], "error")
+
+    return render_template("sales/analytics.html",
+                         job=job,
+                         report=job.result,
+                         start_day=start_day,
+                         end_day=end_day,
+                         granularity=granularity,
                          is_director=True)
 
 
+@bp.get("/assortment")
+@login_required
+def assortment():
+    if not current_user.is_director():
+        flash("Доступ запрещен.", "error")
+        return redirect(url_for("products.list_products"))
+
+    end_day = date.today()
+    start_day = end_day - timedelta(days=ASSORTMENT_DEFAULT_DAYS - 1)
+    try:
+        if request.args.get('start'):
+            start_day = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+        if request.args.get('end'):
+            end_day = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+    except ValueError:
+        flash("Неверный формат даты, ожидается ГГГГ-ММ-ДД", "error")
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+
+    job = _report_job('assortment', start_day=start_day.isoformat(), end_day=end_day.isoformat())
+    abc = request.args.get('abc', '')
+    xyz = request.args.get('xyz', '')
+    rows = [row for row in (job.result['rows'] if job.result else [])
+            if (not abc or row['abc'] == abc) and (not xyz or row['xyz'] == xyz)]
+
+    return render_template("sales/assortment.html",
+                         job=job,
+                         report=job.result,
+                         rows=rows,
+                         abc=abc,
+                         xyz=xyz,
+                         start_day=start_day,
+                         end_day=end_day,
+                         is_director=True)
+
+
+@bp.get("/receipts/<int:receipt_id>")
+@login_required
+def receipt(receipt_id):
+    receipt = receipt_repo.get_with_lines(receipt_id)
+    if not receipt or (not current_user.is_director() and receipt.cashier_id != current_user.id):
+        flash("Чек не найден", "error")
+        return redirect(url_for("sales.list_sales"))
+    return render_template("sales/receipt.html",
+                         receipt=receipt,
+                         is_director=current_user.is_director())
+
+
 @bp.get("/my_sales")
 @login_required
 def my_sales():
     if current_user.is_director():
         return redirect(url_for("sales.list_sales"))
 
-    sales = sale_repo.get_by_cashier(current_user.id)
-    
-    sales_with_products = []
-    total_revenue = 0
-    for sale in sales:
-        product = product_repo.get_by_id(sale.product_id)
-        total_revenue += float(sale.total_price)
-        sales_with_products.append({
-            'sale': sale,
-            'product': product
-        })
+    page = sale_repo.page_with_details(current_user.id,
+                                       after=request.args.get('after'),
+                                       before=request.args.get('before'),
+                                       limit=SALES_PAGE_SIZE)
+    sales_count, total_revenue = receipt_repo.get_totals(cashier_id=current_user.id)
+
+    sales_with_products = [{'sale': sale, 'product': sale.product} for sale in page]
 
     return render_template("sales/my_sales.html",
                          sales_with_products=sales_with_products,
+                         page=page,
                          total_revenue=total_revenue,
-                         sales_count=len(sales))
+                         sales_count=sales_count)
 
 
 @bp.get("/daily_report")
@@ -160,7 +253,6 @@ def daily_report():
         flash("Доступ запрещен.", "error")
         return redirect(url_for("products.list_products"))
 
-    from datetime import datetime, date
     report_date = request.args.get('date')
     
     if report_date:
@@ -171,27 +263,64 @@ def daily_report():
     else:
         report_date = date.today()
 
-    start_datetime = datetime.combine(report_date, datetime.min.time())
-    end_datetime = datetime.combine(report_date, datetime.max.time())
+    # Отчет строится по сводке daily_sales: строк столько, сколько пар товар/кассир за день
+    job = _report_job('daily_report', day=report_date.isoformat())
 
-    sales = Sale.query.filter(
-        Sale.sale_date >= start_datetime,
-        Sale.sale_date <= end_datetime
-    ).order_by(Sale.sale_date.desc()).all()
+    return render_template("sales/daily_report.html",
+                         job=job,
+                         report=job.result,
+                         report_date=report_date)
 
-    daily_revenue = sale_repo.get_revenue_by_date_range(start_datetime, end_datetime)
-    
-    sales_with_products = []
-    for sale in sales:
-        product = product_repo.get_by_id(sale.product_id)
-        sales_with_products.append({
-            'sale': sale,
-            'product': product
-        })
 
-    return render_template("sales/daily_report.html",
-                         sales_with_products=sales_with_products,
-                         daily_revenue=daily_revenue,
-                         report_date=report_date,
-                         sales_count=len(sales))
 
+@bp.get("/export")
+@login_required
+def export_sales():
+    if not current_user.is_director():
+        flash("Доступ запрещен.", "error")
+        return redirect(url_for("products.list_products"))
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        flash("Неизвестный формат выгрузки", "error")
+        return redirect(url_for("sales.list_sales"))
+
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start_date = datetime.strptime(start, '%Y-%m-%d') if start else None
+        # Конец периода включительно: берем все продажи до начала следующего дня
+        end_date = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+        cashier_id = request.args.get('cashier_id', type=int)
+        product_id = request.args.get('product_id', type=int)
+    except ValueError:
+        flash("Неверный формат даты, ожидается ГГГГ-ММ-ДД", "error")
+        return redirect(url_for("sales.list_sales"))
+
+    sales = sale_repo.iter_for_export(start_date, end_date, cashier_id, product_id)
+
+    # Ответ отдается частями по мере чтения из базы, память не растет с объемом выгрузки
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS) if export_format == 'csv' else None
+        if writer:
+            writer.writeheader()
+        rows = 0
+        for sale in sales:
+            if writer:
+                writer.writerow(sale.to_dict())
+            else:
+                buffer.write(json.dumps(sale.to_dict(), ensure_ascii=False) + '\n')
+            rows += 1
+            if rows % EXPORT_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == 'csv':
+        mimetype, filename = 'text/csv', 'sales.csv'
+    else:
+        mimetype, filename = 'application/x-ndjson', 'sales.ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
@@ -0,0 +1,111 @@
+from datetime import timedelta
+
+from sqlalchemy import case, func, text
+
+from app.models import db
+from app.models.sales_rollup import DailySales
+
+# Группировка по времени: выражение SQLite, приводящее момент к началу интервала,
+# и шаг к следующему интервалу. Часы берутся из sales.sale_date (UTC),
+# дни, недели (с понедельника) и месяцы - из сводки daily_sales.
+GRANULARITIES = {
+    'hour': ("strftime('%Y-%m-%d %H:00:00', {})", "datetime(bucket, '+1 hour')"),
+    'day': ("date({})", "date(bucket, '+1 day')"),
+    'week': ("date({}, '-6 days', 'weekday 1')", "date(bucket, '+7 days')"),
+    'month': ("date({}, 'start of month')", "date(bucket, '+1 month')"),
+}
+BUCKET_DAYS = {'hour': 1 / 24, 'day': 1, 'week': 7, 'month': 28}
+MAX_BUCKETS = 2000
+
+HOURLY_TOTALS = (
+    'SELECT {bucket} AS bucket, SUM(total_price) AS revenue, COUNT(*) AS sales_count, SUM(quantity) AS quantity '
+    'FROM sales WHERE sale_date BETWEEN :start AND :end GROUP BY 1'
+)
+ROLLUP_TOTALS = (
+    'SELECT {bucket} AS bucket, SUM(revenue) AS revenue, SUM(line_count) AS sales_count, SUM(quantity) AS quantity '
+    'FROM daily_sales WHERE day BETWEEN :start AND :end GROUP BY 1'
+)
+# Все интервалы периода строятся рекурсивным CTE, поэтому пустые часы и дни
+# тоже попадают в ряд, а LAG сравнивает соседние интервалы, а не соседние строки с продажами
+SERIES_SQL = (
+    'WITH RECURSIVE buckets(bucket) AS ('
+    ' SELECT {first} UNION ALL SELECT {step} FROM buckets WHERE bucket < {last}'
+    '), totals AS ({totals}) '
+    'SELECT buckets.bucket, coalesce(totals.revenue, 0) AS revenue, '
+    'coalesce(totals.sales_count, 0) AS sales_count, coalesce(totals.quantity, 0) AS quantity, '
+    'SUM(coalesce(totals.revenue, 0)) OVER (ORDER BY buckets.bucket) AS cumulative_revenue, '
+    'LAG(coalesce(totals.revenue, 0)) OVER (ORDER BY buckets.bucket) AS previous_revenue '
+    'FROM buckets LEFT JOIN totals ON totals.bucket = buckets.bucket '
+    'ORDER BY buckets.bucket'
+)
+
+
+def _change(current, previous):
+    if not previous:
+        return None
+    return round((current - previous) / previous * 100, 1)
+
+
+class SalesAnalyticsRepo:
+    # Ряд выручки за период [start_day, end_day] одним запросом: интервал, выручка,
+    # число продаж, штуки, выручка нарастающим итогом и изменение к предыдущему интервалу, %
+    def revenue_series(self, start_day, end_day, granularity='day'):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Неизвестный интервал: {granularity}")
+        if ((end_day - start_day).days + 1) / BUCKET_DAYS[granularity] > MAX_BUCKETS:
+            raise ValueError("Слишком много интервалов, выберите период короче или интервал крупнее")
+
+        bucket, step = GRANULARITIES[granularity]
+        if granularity == 'hour':
+            column, totals = 'sale_date', HOURLY_TOTALS
+            params = {'start': f'{start_day.isoformat()} 00:00:00', 'end': f'{end_day.isoformat()} 23:59:59.999999'}
+        else:
+            column, totals = 'day', ROLLUP_TOTALS
+            params = {'start': start_day.isoformat(), 'end': end_day.isoformat()}
+        statement = SERIES_SQL.format(
+            first=bucket.format(':start'),
+            last=bucket.format(':end'),
+            step=step,
+            totals=totals.format(bucket=bucket.format(column)),
+        )
+        return [
+            {
+                'bucket': row.bucket,
+                'revenue': round(float(row.revenue), 2),
+                'sales_count': int(row.sales_count),
+                'quantity': int(row.quantity),
+                'cumulative_revenue': round(float(row.cumulative_revenue), 2),
+                'change_pct': _change(float(row.revenue), float(row.previous_revenue or 0)),
+            }
+            for row in db.session.execute(text(statement), params)
+        ]
+
+    # Итоги периода и такого же по длине предыдущего периода одним запросом по сводке
+    def compare_periods(self, start_day, end_day):
+        length = (end_day - start_day).days + 1
+        previous_start = start_day - timedelta(days=length)
+        previous_end = start_day - timedelta(days=1)
+        is_current = DailySales.day >= start_day
+
+        def split(column):
+            return (func.sum(case((is_current, column), else_=0)),
+                    func.sum(case((is_current, 0), else_=column)))
+
+        row = db.session.query(
+            *split(DailySales.revenue), *split(DailySales.line_count), *split(DailySales.quantity)
+        ).filter(DailySales.day >= previous_start, DailySales.day <= end_day).one()
+
+        revenue, previous_revenue, count, previous_count, quantity, previous_quantity = (
+            float(value) if value else 0 for value in row
+        )
+        current = {'revenue': revenue, 'sales_count': int(count), 'quantity': int(quantity),
+                   'average_sale': revenue / count if count else 0.0}
+        previous = {'revenue': previous_revenue, 'sales_count': int(previous_count), 'quantity': int(previous_quantity),
+                    'average_sale': previous_revenue / previous_count if previous_count else 0.0}
+        return {
+            'current': current,
+            'previous': previous,
+            'previous_start': previous_start,
+            'previous_end': previous_end,
+            'changes': {key: _change(current[key], previous[key]) for key in current},
+        }
@@ -0,0 +1,109 @@
+import numpy as np
+from sqlalchemy import text
+
+from app.models import db
+
+# Границы ABC по накопленной доле выручки и XYZ по коэффициенту вариации недельного спроса
+ABC_LIMITS = (0.80, 0.95)
+XYZ_LIMITS = (0.10, 0.25)
+CHUNK_ROWS = 100000
+
+# Продажи по (день, товар) из сводки daily_sales: SQLite сам сворачивает строки кассиров,
+# читая первичный ключ (day, product_id, cashier_id) по порядку. Номер дня считается от начала периода.
+DEMAND_SQL = (
+    'SELECT CAST(julianday(day) - julianday(:start) AS INTEGER) AS day_index, product_id, '
+    'SUM(quantity) AS quantity, CAST(SUM(revenue) AS REAL) AS revenue '
+    'FROM daily_sales WHERE day BETWEEN :start AND :end '
+    'GROUP BY day, product_id'
+)
+DEMAND_DTYPE = np.dtype([('day', np.int32), ('product_id', np.int64), ('quantity', np.int64), ('revenue', np.float64)])
+
+
+# Столбцы day/product_id/quantity/revenue читаются пачками по chunk_rows строк
+# и склеиваются в массивы NumPy; ORM-объекты не создаются
+def load_demand(start_day, end_day, chunk_rows=CHUNK_ROWS):
+    result = db.session.connection().execute(
+        text(DEMAND_SQL), {'start': start_day.isoformat(), 'end': end_day.isoformat()}
+    )
+    chunks = [np.fromiter(map(tuple, rows), dtype=DEMAND_DTYPE, count=len(rows))
+              for rows in iter(lambda: result.fetchmany(chunk_rows), [])]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=DEMAND_DTYPE)
+
+
+def _classify(values, limits, labels):
+    return np.array(labels)[np.searchsorted(np.asarray(limits), values, side='right')]
+
+
+# ABC/XYZ-анализ, скользящие средние спроса и запас в неделях по каждому товару.
+# Все расчеты - группировки np.bincount по индексу товара, без циклов по строкам.
+class AssortmentAnalytics:
+    def report(self, start_day, end_day, products):
+        days = (end_day - start_day).days + 1
+        product_ids = np.array([product.id for product in products], dtype=np.int64)
+        order = np.argsort(product_ids)
+        product_ids = product_ids[order]
+        products = [products[i] for i in order]
+        stock = np.array([product.stock_quantity for product in products], dtype=np.float64)
+        count = len(product_ids)
+
+        demand = load_demand(start_day, end_day)
+        # Строки удаленных товаров в отчет не попадают
+        index = np.minimum(np.searchsorted(product_ids, demand['product_id']), max(count - 1, 0))
+        known = product_ids[index] == demand['product_id'] if count else np.zeros(len(demand), dtype=bool)
+        index, demand = index[known], demand[known]
+
+        revenue = np.bincount(index, weights=demand['revenue'], minlength=count)
+        quantity = np.bincount(index, weights=demand['quantity'], minlength=count)
+
+        # ABC: товары по убыванию выручки, класс по доле выручки всех товаров выше данного
+        ranking = np.argsort(-revenue, kind='stable')
+        total_revenue = revenue.sum()
+        share = revenue / total_revenue if total_revenue else np.zeros(count)
+        share_before = np.empty(count)
+        share_before[ranking] = np.cumsum(share[ranking]) - share[ranking]
+        abc = _classify(share_before, ABC_LIMITS, ['A', 'B', 'C'])
+        abc[revenue == 0] = 'C'
+
+        # XYZ: коэффициент вариации спроса по неделям периода
+        weeks = max(days // 7, 1)
+        in_weeks = demand['day'] < weeks * 7
+        weekly = np.bincount(index[in_weeks] * weeks + demand['day'][in_weeks] // 7,
+                             weights=demand['quantity'][in_weeks], minlength=count * weeks).reshape(count, weeks)
+        mean = weekly.mean(axis=1)
+        variation = np.divide(weekly.std(axis=1), mean, out=np.full(count, np.inf), where=mean > 0)
+        xyz = _classify(variation, XYZ_LIMITS, ['X', 'Y', 'Z'])
+
+        # Скользящие средние дневного спроса за последние 7 и 28 дней периода
+        def moving_average(window):
+            window = min(window, days)
+            recent = demand['day'] >= days - window
+            return np.bincount(index[recent], weights=demand['quantity'][recent], minlength=count) / window
+
+        ma7 = moving_average(7)
+        ma28 = moving_average(28)
+        weeks_of_cover = np.divide(stock, ma28 * 7, out=np.full(count, np.inf), where=ma28 > 0)
+
+        rows = [
+            {
+                'product': products[i],
+                'revenue': float(revenue[i]),
+                'quantity': int(quantity[i]),
+                'share': float(share[i]),
+                'abc': str(abc[i]),
+                'xyz': str(xyz[i]),
+                'variation': float(variation[i]) if np.isfinite(variation[i]) else None,
+                'ma7': float(ma7[i]),
+                'ma28': float(ma28[i]),
+                'weeks_of_cover': float(weeks_of_cover[i]) if np.isfinite(weeks_of_cover[i]) else None,
+            }
+            for i in ranking
+        ]
+        matrix = {abc_class + xyz_class: int(np.count_nonzero((abc == abc_class) & (xyz == xyz_class)))
+                  for abc_class in 'ABC' for xyz_class in 'XYZ'}
+        return {
+            'rows': rows,
+            'matrix': matrix,
+            'total_revenue': float(total_revenue),
+            'start_day': start_day,
+            'end_day': end_day,
+        }
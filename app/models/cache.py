@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import db
+
+
+# Общий для всех процессов счетчик версий кэшируемых данных. Любая запись
+# увеличивает версию в своей транзакции, и другие процессы видят, что их копия устарела.
+class CacheVersion(db.Model):
+    __tablename__ = "cache_versions"
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+def current_version(name):
+    version = db.session.execute(
+        select(CacheVersion.version).where(CacheVersion.name == name)
+    ).scalar()
+    return version or 0
+
+
+# Версии сразу нескольких наборов данных одним запросом, в порядке names
+def current_versions(names):
+    found = dict(db.session.execute(
+        select(CacheVersion.name, CacheVersion.version).where(CacheVersion.name.in_(names))
+    ).all())
+    return tuple(found.get(name, 0) for name in names)
+
+
+def bump_version(name, connection=None):
+    table = CacheVersion.__table__
+    # Начальное значение случайное: пересозданная база не совпадет с версией старой копии
+    statement = sqlite_insert(table).values(name=name, version=random.randrange(1, 2 ** 31))
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={'version': table.c.version + 1}
+    )
+    (connection or db.session.connection()).execute(statement)
+
+
+# Кэш в памяти процесса: значение живет не дольше TTL и сбрасывается,
+# как только версия в базе отличается от версии, с которой оно было загружено
+class VersionedCache:
+    def __init__(self, name, ttl_setting='CATALOG_CACHE_TTL'):
+        self.name = name
+        self.ttl_setting = ttl_setting
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        version = current_version(self.name)
+        if not version:
+            # Версии в базе еще нет - не с чем сравнивать копию
+            return loader()
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and entry[0] == version and entry[1] > now:
+            return entry[2]
+
+        value = loader()
+        ttl = current_app.config.get(self.ttl_setting, 300)
+        with self._lock:
+            self._entries[key] = (version, now + ttl, value)
+        return value
+
+    # Вызывается внутри транзакции записи, до commit
+    def invalidate(self, connection=None):
+        with self._lock:
+            self._entries.clear()
+        bump_version(self.name, connection)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Кэш пользователей для Flask-Login: копия пользователя живет не дольше TTL и действует,
+# пока не изменился общий для всех процессов счетчик name в cache_versions.
+# UserRepo увеличивает его в транзакции любого изменения пользователя (роль, пароль,
+# удаление), поэтому понижение и удаление действуют сразу во всех процессах;
+# на запрос остается одно чтение счетчика по первичному ключу вместо загрузки пользователя.
+class IdentityCache:
+    def __init__(self, name='users', ttl_setting='USER_CACHE_TTL'):
+        self.name = name
+        self.ttl_setting = ttl_setting
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, loader):
+        # Версия читается до загрузки: изменение во время загрузки сбросит копию
+        version = current_version(self.name)
+        entry = self._entries.get(user_id)
+        if version and entry and entry[0] == version and entry[1] > time.monotonic():
+            return entry[2]
+        user = loader()
+        if user is None:
+            return None
+        copy = user.detached_copy()
+        if version:
+            expires_at = time.monotonic() + current_app.config.get(self.ttl_setting, 30)
+            with self._lock:
+                self._entries[user_id] = (version, expires_at, copy)
+        return copy
+
+    # Копия только что загруженного пользователя (вход); в кэш она попадет при следующем get
+    def put(self, user):
+        with self._lock:
+            self._entries.pop(user.id, None)
+        return user.detached_copy()
+
+    # Вызывается внутри транзакции изменения пользователя, до commit
+    def invalidate(self, user_id, connection=None):
+        with self._lock:
+            self._entries.pop(user_id, None)
+        bump_version(self.name, connection)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Копия строки модели, не привязанная к сессии: безопасно хранить между запросами
+def snapshot(instance):
+    return SimpleNamespace(**{
+        column.key: getattr(instance, column.key)
+        for column in instance.__table__.columns
+    })
+
+
+catalog_cache = VersionedCache('catalog')
+categories_cache = VersionedCache('categories')
+user_cache = IdentityCache()
@@ -0,0 +1,316 @@
+import hashlib
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+
+from app.models import db
+from app.models.cache import bump_version, catalog_cache
+from app.models.idempotency import IdempotencyKeyReused, checkout_keys
+from app.models.metrics import registry as metrics
+from app.models.product import Product
+from app.models.receipt import PAYMENT_CASH, PAYMENT_METHODS, Receipt
+from app.models.reservation import free_stock, reservations
+from app.models.sale import Sale, SALES_VERSION
+from app.models.sales_rollup import SalesRollupRepo
+
+# Сколько раз корзина оформляется заново, если товары изменились во время оформления
+CHECKOUT_ATTEMPTS = 3
+
+
+class CheckoutError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+KEY_REUSED_ERROR = "Ключ повторной отправки уже использован для другой корзины или оплаты"
+
+
+# Отпечаток запроса продажи: строки корзины и оплата. Хранится вместе с ключом
+# идемпотентности, чтобы тот же ключ с другой корзиной не получил чужую продажу.
+def request_hash(items, payment_method, paid_amount):
+    payload = json.dumps([sorted([product_id, quantity] for product_id, quantity in items), payment_method,
+                          None if paid_amount is None else f'{paid_amount:.2f}'])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CheckoutService:
+    def __init__(self):
+        self.rollup = SalesRollupRepo()
+
+    # Повтор запроса с тем же idempotency_key (таймаут, двойной клик) возвращает строки
+    # первой продажи: из памяти процесса без обращения к базе, а если запрос попал
+    # в другой процесс - по ключу, сохраненному в чеке. Тот же ключ с другими строками
+    # или оплатой (отпечаток request_hash не совпал) отклоняется, а не отдает первую продажу.
+    # cart_id - корзина, товары которой отложены резервом (app.models.reservation).
+    def checkout(self, cashier_id, items, payment_method=PAYMENT_CASH, paid_amount=None, idempotency_key=None,
+                 cart_id=None):
+        if idempotency_key is None:
+            return self._checkout(cashier_id, items, payment_method, paid_amount, cart_id=cart_id)
+        fingerprint = request_hash(items, payment_method, paid_amount)
+        try:
+            lines, replayed = checkout_keys.run(
+                (cashier_id, idempotency_key),
+                lambda: self._checkout(cashier_id, items, payment_method, paid_amount, idempotency_key, cart_id,
+                                       fingerprint),
+                remember_errors=(CheckoutError,),
+                fingerprint=fingerprint
+            )
+        except IdempotencyKeyReused:
+            metrics.inc('cosmeticshop_checkout_rejected_total')
+            raise CheckoutError([KEY_REUSED_ERROR])
+        except TimeoutError:
+            raise CheckoutError(["Продажа еще оформляется, проверьте список продаж"])
+        if replayed:
+            metrics.inc('cosmeticshop_checkout_replays_total')
+        return lines
+
+    # Оформление корзины одной транзакцией: товары загружаются одним IN-запросом,
+    # остатки списываются условным UPDATE ... WHERE price = :p AND discount_price IS :d
+    # AND <свободный остаток> >= :q (остаток минус резервы других корзин,
+    # app.models.reservation.free_stock), записывается чек, его строки вставляются пачкой
+    # вместе с обновлением сводки, коммит один. Продажа на другой кассе списанию не мешает,
+    # пока хватает остатка; если между чтением и списанием изменилась цена или остатка
+    # не хватило, транзакция откатывается и корзина оформляется заново по свежим данным,
+    # не больше CHECKOUT_ATTEMPTS раз. paid_amount - полученные наличные (или None).
+    # Корзина, полностью совпадающая со своим резервом, оформляется из резерва: чужие
+    # корзины отложенное не забрали; резерв другого состава сначала снимается.
+    def _checkout(self, cashier_id, items, payment_method, paid_amount, idempotency_key=None, cart_id=None,
+                  fingerprint=None):
+        if idempotency_key is not None:
+            existing = self._lines_for_key(cashier_id, idempotency_key, fingerprint)
+            if existing:
+                metrics.inc('cosmeticshop_checkout_replays_total')
+                return existing
+
+        # Каждая строка проверяется до сложения: 5 и -3 одного товара - ошибка, а не продажа 2 шт.
+        quantities = {}
+        for product_id, quantity in items:
+            if quantity <= 0:
+                metrics.inc('cosmeticshop_checkout_rejected_total')
+                raise CheckoutError([f"Количество для товара с ID {product_id} должно быть больше нуля"])
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+        if cart_id is not None:
+            hold = reservations.get(cart_id, cashier_id)
+            if hold is not None:
+                if hold.items == quantities:
+                    lines = self._convert(cart_id, cashier_id, quantities, payment_method, paid_amount,
+                                          idempotency_key, fingerprint)
+                    if lines is not None:
+                        return lines
+                reservations.release(cart_id, cashier_id)
+
+        for _ in range(CHECKOUT_ATTEMPTS):
+            lines = self._attempt(cashier_id, quantities, payment_method, paid_amount, idempotency_key,
+                                  fingerprint)
+            if lines is not None:
+                return lines
+            metrics.inc('cosmeticshop_checkout_stock_conflicts_total')
+        metrics.inc('cosmeticshop_checkout_rejected_total')
+        raise CheckoutError(["Товары корзины одновременно меняются на других кассах, повторите продажу"])
+
+    # Одна попытка оформления; None - цена или остаток какого-то товара успели измениться
+    def _attempt(self, cashier_id, quantities, payment_method, paid_amount, idempotency_key, fingerprint):
+        sale_date = datetime.utcnow()
+        products, free = self._load_free_stock(quantities, sale_date)
+
+        errors = self._validate(products, quantities, payment_method, free=free)
+        if errors:
+            metrics.inc('cosmeticshop_checkout_rejected_total')
+            raise CheckoutError(errors)
+
+        lines, total = self._price_lines(products, quantities, cashier_id, sale_date, paid_amount)
+
+        products_table = Product.__table__
+        decrement = products_table.update().where(
+            products_table.c.id == bindparam('line_product_id'),
+            products_table.c.price == bindparam('line_price', type_=products_table.c.price.type),
+            products_table.c.discount_price.is_not_distinct_from(
+                bindparam('line_discount_price', type_=products_table.c.discount_price.type)
+            ),
+            free_stock(sale_date) >= bindparam('line_quantity')
+        ).values(stock_quantity=products_table.c.stock_quantity - bindparam('line_quantity'),
+                 version=products_table.c.version + 1)
+
+        def write(connection):
+            result = connection.execute(decrement, [
+                {'line_product_id': line['product_id'], 'line_quantity': line['quantity'],
+                 'line_price': products[line['product_id']].price,
+                 'line_discount_price': products[line['product_id']].discount_price}
+                for line in lines
+            ])
+            if result.rowcount != len(lines):
+                # Цену или остаток успели изменить между чтением и списанием
+                return False
+            self._record(connection, cashier_id, lines, total, payment_method, paid_amount, idempotency_key,
+                         fingerprint)
+            catalog_cache.invalidate(connection)
+            return True
+
+        return self._commit(write, lines, cashier_id, idempotency_key, fingerprint)
+
+    # Оформление из резерва: первая запись транзакции забирает строки резерва, после нее
+    # SQLite не даст другим соединениям менять товары до коммита, поэтому цены читаются
+    # уже под блокировкой записи. Остаток списывается тем же условным UPDATE, что и без
+    # резерва. None - резерв истек или изменился либо остаток на складе уменьшили
+    # ниже отложенного: нужно обычное оформление.
+    def _convert(self, cart_id, cashier_id, quantities, payment_method, paid_amount, idempotency_key, fingerprint):
+        sale_date = datetime.utcnow()
+        try:
+            claimed = reservations.claim(db.session.connection(), cart_id, cashier_id, sale_date)
+            if claimed != quantities:
+                db.session.rollback()
+                return None
+            products = self._load_products(quantities)
+            errors = self._validate(products, quantities, payment_method)
+            if errors:
+                metrics.inc('cosmeticshop_checkout_rejected_total')
+                raise CheckoutError(errors)
+            lines, total = self._price_lines(products, quantities, cashier_id, sale_date, paid_amount)
+        except Exception:
+            db.session.rollback()
+            raise
+
+        products_table = Product.__table__
+        decrement = products_table.update().where(
+            products_table.c.id == bindparam('line_product_id'),
+            free_stock(sale_date) >= bindparam('line_quantity')
+        ).values(stock_quantity=products_table.c.stock_quantity - bindparam('line_quantity'),
+                 version=products_table.c.version + 1)
+
+        def write(connection):
+            result = connection.execute(decrement, [
+                {'line_product_id': line['product_id'], 'line_quantity': line['quantity']} for line in lines
+            ])
+            if result.rowcount != len(lines):
+                return False
+            self._record(connection, cashier_id, lines, total, payment_method, paid_amount, idempotency_key,
+                         fingerprint)
+            catalog_cache.invalidate(connection)
+            return True
+
+        lines = self._commit(write, lines, cashier_id, idempotency_key, fingerprint)
+        if lines is None:
+            return None
+        reservations.forget(cart_id)
+        metrics.inc('cosmeticshop_checkout_reserved_total')
+        return lines
+
+    @staticmethod
+    def _load_products(quantities):
+        return {
+            product.id: product
+            for product in Product.query.filter(Product.id.in_(list(quantities))).all()
+        }
+
+    # Товары и их свободный остаток {product_id: quantity} одним запросом
+    @staticmethod
+    def _load_free_stock(quantities, now):
+        rows = db.session.query(Product, free_stock(now)).filter(Product.id.in_(list(quantities))).all()
+        return {product.id: product for product, _ in rows}, {product.id: free for product, free in rows}
+
+    # free - свободный остаток {product_id: quantity}; None - остаток не проверяется
+    @staticmethod
+    def _validate(products, quantities, payment_method, free=None):
+        errors = []
+        for product_id, quantity in quantities.items():
+            product = products.get(product_id)
+            if not product:
+                errors.append(f"Товар с ID {product_id} не найден")
+            elif free is not None and free[product_id] < quantity:
+                errors.append(f"Недостаточно товара '{product.name}' на складе. Доступно: {free[product_id]}")
+        if payment_method not in PAYMENT_METHODS:
+            errors.append(f"Неизвестный способ оплаты: {payment_method}")
+        return errors
+
+    @staticmethod
+    def _price_lines(products, quantities, cashier_id, sale_date, paid_amount):
+        lines = []
+        for product_id, quantity in quantities.items():
+            product = products[product_id]
+            price_to_use = product.discount_price if product.discount_price else product.price
+            lines.append({
+                'product_id': product_id,
+                'cashier_id': cashier_id,
+                'quantity': quantity,
+                'total_price': Decimal(str(price_to_use)) * quantity,
+                'sale_date': sale_date,
+                'sale_day': sale_date.date(),
+            })
+        total = sum(line['total_price'] for line in lines)
+        if paid_amount is not None and paid_amount < total:
+            metrics.inc('cosmeticshop_checkout_rejected_total')
+            raise CheckoutError([f"Получено {paid_amount:.2f} руб., сумма чека {total:.2f} руб."])
+        return lines, total
+
+    # Чек, его строки и сводка продаж
+    def _record(self, connection, cashier_id, lines, total, payment_method, paid_amount, idempotency_key,
+                fingerprint):
+        sale_date = lines[0]['sale_date']
+        receipt_id = connection.execute(Receipt.__table__.insert().values(
+            cashier_id=cashier_id,
+            created_at=sale_date,
+            receipt_day=sale_date.date(),
+            total=total,
+            line_count=len(lines),
+            item_count=sum(line['quantity'] for line in lines),
+            payment_method=payment_method,
+            paid_amount=paid_amount,
+            idempotency_key=idempotency_key,
+            request_hash=fingerprint,
+        )).inserted_primary_key[0]
+        for line in lines:
+            line['receipt_id'] = receipt_id
+        connection.execute(Sale.__table__.insert(), lines)
+        self.rollup.apply(lines, connection)
+        bump_version(SALES_VERSION, connection)
+
+    # Выполняет write(connection) и коммитит; write вернул False - откат и None
+    def _commit(self, write, lines, cashier_id, idempotency_key, fingerprint):
+        try:
+            if not write(db.session.connection()):
+                db.session.rollback()
+                return None
+            db.session.commit()
+        except IntegrityError:
+            # Тот же ключ успел записать другой процесс - отдаем его продажу
+            db.session.rollback()
+            existing = self._lines_for_key(cashier_id, idempotency_key, fingerprint) if idempotency_key else None
+            if not existing:
+                raise
+            metrics.inc('cosmeticshop_checkout_replays_total')
+            return existing
+        except Exception:
+            db.session.rollback()
+            raise
+        metrics.inc('cosmeticshop_checkouts_total')
+        metrics.observe('cosmeticshop_checkout_cart_lines', len(lines))
+        return lines
+
+    # Строки продажи, записанной с этим ключом; чек с другим отпечатком - CheckoutError.
+    # У чеков, записанных до появления отпечатка (request_hash пуст), он не сверяется.
+    def _lines_for_key(self, cashier_id, idempotency_key, fingerprint):
+        rows = db.session.query(Sale, Receipt.request_hash).join(Receipt, Sale.receipt_id == Receipt.id).filter(
+            Receipt.cashier_id == cashier_id,
+            Receipt.idempotency_key == idempotency_key
+        ).order_by(Sale.id).all()
+        if rows and rows[0].request_hash not in (None, fingerprint):
+            metrics.inc('cosmeticshop_checkout_rejected_total')
+            raise CheckoutError([KEY_REUSED_ERROR])
+        sales = [sale for sale, _ in rows]
+        return [
+            {
+                'product_id': sale.product_id,
+                'cashier_id': sale.cashier_id,
+                'quantity': sale.quantity,
+                'total_price': sale.total_price,
+                'sale_date': sale.sale_date,
+                'sale_day': sale.sale_day,
+                'receipt_id': sale.receipt_id,
+            }
+            for sale in sales
+        ]
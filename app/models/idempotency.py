@@ -0,0 +1,119 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from flask import current_app
+
+MAX_KEY_LENGTH = 64
+# Сколько повторный запрос ждет, пока первый запрос с тем же ключом оформляет продажу, сек
+WAIT_SECONDS = 30
+
+
+# Ключ уже использован для запроса с другим отпечатком
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+class _Entry:
+    def __init__(self, expires_at, fingerprint):
+        self.expires_at = expires_at
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.outcome = None
+
+
+# Обработанные ключи идемпотентности и их результат в памяти процесса.
+# Не больше IDEMPOTENCY_MAX_KEYS записей (старые вытесняются первыми), каждая живет
+# IDEMPOTENCY_TTL секунд. Результат - ('ok', значение) или ('error', исключение).
+# У каждого приложения процесса (своя база) свои ключи; запись о приложении
+# держится по слабой ссылке и исчезает вместе с ним.
+class IdempotencyStore:
+    def __init__(self):
+        self._apps = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    # Ключи текущего приложения; вызывается под self._lock
+    def _entries(self):
+        app = current_app._get_current_object()
+        entries = self._apps.get(app)
+        if entries is None:
+            entries = self._apps[app] = OrderedDict()
+        return entries
+
+    def _settings(self):
+        config = current_app.config
+        return config.get('IDEMPOTENCY_MAX_KEYS', 10000), config.get('IDEMPOTENCY_TTL', 600)
+
+    # Выполняет action один раз для ключа и возвращает (результат, повтор ли это).
+    # Повторный вызов с тем же ключом получает результат первого (или то же исключение),
+    # пока запись не истекла; одновременный - ждет, пока первый закончит.
+    # Исключения не из remember_errors не запоминаются - такой запрос можно повторить.
+    # fingerprint - отпечаток запроса: повтор ключа с другим отпечатком получает
+    # IdempotencyKeyReused, а не чужой результат.
+    def run(self, key, action, remember_errors=(), fingerprint=None):
+        while True:
+            entry, owner = self._begin(key, fingerprint)
+            if owner:
+                break
+            if not entry.done.wait(WAIT_SECONDS):
+                raise TimeoutError(key)
+            if entry.outcome is not None:
+                return self._replay(entry.outcome), True
+
+        try:
+            value = action()
+        except remember_errors as e:
+            self._finish(entry, ('error', e))
+            raise
+        except BaseException:
+            self._abandon(key, entry)
+            raise
+        self._finish(entry, ('ok', value))
+        return value, False
+
+    @staticmethod
+    def _replay(outcome):
+        kind, value = outcome
+        if kind == 'error':
+            raise value
+        return value
+
+    def _begin(self, key, fingerprint):
+        max_keys, ttl = self._settings()
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries()
+            entry = entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyKeyReused(key)
+                return entry, False
+            # Записи добавляются с одним TTL, поэтому истекшие - в начале очереди
+            while entries:
+                oldest = next(iter(entries.values()))
+                if oldest.expires_at > now and len(entries) < max_keys:
+                    break
+                entries.popitem(last=False)
+            entries.pop(key, None)
+            entry = entries[key] = _Entry(now + ttl, fingerprint)
+            return entry, True
+
+    @staticmethod
+    def _finish(entry, outcome):
+        entry.outcome = outcome
+        entry.done.set()
+
+    def _abandon(self, key, entry):
+        with self._lock:
+            entries = self._entries()
+            if entries.get(key) is entry:
+                del entries[key]
+        entry.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries().clear()
+
+
+checkout_keys = IdempotencyStore()
@@ -0,0 +1,327 @@
+import atexit
+import glob
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, g, request
+from sqlalchemy import event
+
+from app.models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CART_SIZE_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+LOCK_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Описание метрик: имя -> (тип, справка, границы корзин гистограммы)
+METRICS = {
+    'cosmeticshop_http_requests_total': ('counter', 'Обработано HTTP-запросов', None),
+    'cosmeticshop_http_request_duration_seconds': ('histogram', 'Время обработки запроса', LATENCY_BUCKETS),
+    'cosmeticshop_checkouts_total': ('counter', 'Оформлено продаж', None),
+    'cosmeticshop_checkout_cart_lines': ('histogram', 'Строк в оформленном чеке', CART_SIZE_BUCKETS),
+    'cosmeticshop_checkout_rejected_total': ('counter', 'Отклонено корзин при проверке', None),
+    'cosmeticshop_checkout_stock_conflicts_total': ('counter', 'Повторов оформления продажи: товар изменился между чтением и списанием', None),
+    'cosmeticshop_checkout_reserved_total': ('counter', 'Продаж, оформленных из резерва корзины', None),
+    'cosmeticshop_checkout_replays_total': ('counter', 'Повторных отправок продажи с тем же ключом', None),
+    'cosmeticshop_login_failures_total': ('counter', 'Неудачных входов', None),
+    'cosmeticshop_db_lock_wait_seconds': ('histogram', 'Время первой записи в транзакции (ожидание блокировки SQLite)', LOCK_WAIT_BUCKETS),
+    'cosmeticshop_db_locked_errors_total': ('counter', 'Ошибок "database is locked"', None),
+    'cosmeticshop_db_pool_connections': ('gauge', 'Соединения пула по состоянию', None),
+}
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+# Имя файла снимка процесса: <pid>-<время запуска, мс>.json
+SNAPSHOT_NAME = re.compile(r'(\d+)-(\d+)\.json')
+
+
+# Счетчики и гистограммы процесса. Обновление - словарь под блокировкой,
+# поэтому учет почти ничего не стоит в обработке запроса.
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    # Снимок для записи в файл: [[имя, метки, значение или корзины+сумма], ...]
+    def snapshot(self):
+        with self._lock:
+            return {
+                'values': [[name, list(labels), value] for (name, labels), value in self._values.items()],
+                'histograms': [[name, list(labels), list(data)] for (name, labels), data in self._histograms.items()],
+            }
+
+
+registry = Registry()
+# После fork рабочий процесс начинает с нуля, иначе счетчики родителя посчитаются дважды
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+# Несколько рабочих процессов: каждый раз в METRICS_FLUSH_INTERVAL секунд процесс
+# записывает свой снимок в METRICS_DIR/<pid>-<время запуска, мс>.json, а /metrics
+# складывает все файлы. Время запуска в имени не дает новому процессу с тем же pid
+# затереть снимок завершившегося. Снимок завершившегося процесса забирает (переименованием)
+# тот, кто первым собирает метрики: его счетчики и гистограммы переходят в снимок
+# собравшего процесса, а файл удаляется, поэтому каталог не растет. Gauge завершившихся
+# процессов не учитываются. Файлы с другими именами пропускаются.
+class MetricsStore:
+    def __init__(self):
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._started = None
+        self._retired = ({}, {})
+
+    # (pid, время запуска) текущего процесса; после fork определяется заново,
+    # а перенятые родителем счетчики завершившихся процессов забываются
+    def _process(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid, self._started = pid, int(time.time() * 1000)
+            self._retired = ({}, {})
+        return self._pid, self._started
+
+    def directory(self):
+        return current_app.config.get('METRICS_DIR')
+
+    def maybe_flush(self):
+        if self.directory() and time.monotonic() - self._last_flush >= current_app.config.get('METRICS_FLUSH_INTERVAL', 1):
+            self.flush()
+
+    def flush(self, directory=None):
+        directory = directory or self.directory()
+        if not directory:
+            return
+        with self._lock:
+            self._last_flush = time.monotonic()
+            pid, started = self._process()
+            snapshot = registry.snapshot()
+            values, histograms = self._retired
+            snapshot['values'] += [[name, [list(pair) for pair in labels], value]
+                                   for (name, labels), value in values.items()]
+            snapshot['histograms'] += [[name, [list(pair) for pair in labels], list(data)]
+                                       for (name, labels), data in histograms.items()]
+            snapshot['gauges'] = _pool_gauges()
+            path = os.path.join(directory, f'{pid}-{started}.json')
+            os.makedirs(directory, exist_ok=True)
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as stream:
+                json.dump(snapshot, stream)
+            os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        directory = self.directory()
+        if not directory:
+            return [dict(registry.snapshot(), gauges=_pool_gauges())]
+        self._retire(directory)
+        self.flush()
+        snapshots = []
+        for path, pid, started in _snapshot_files(directory):
+            try:
+                with open(path, encoding='utf-8') as stream:
+                    snapshot = json.load(stream)
+            except (OSError, ValueError):
+                continue
+            if not self._is_running(pid, started):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return snapshots
+
+    # Переносит снимки завершившихся процессов в снимок текущего и удаляет их файлы.
+    # Файл сначала переименовывается: из нескольких собирающих процессов его получит один.
+    def _retire(self, directory):
+        claimed = []
+        for path, pid, started in _snapshot_files(directory):
+            if self._is_running(pid, started):
+                continue
+            claim = f'{path}.{os.getpid()}.retired'
+            try:
+                os.rename(path, claim)
+            except OSError:
+                continue
+            claimed.append(claim)
+            try:
+                with open(claim, encoding='utf-8') as stream:
+                    snapshot = json.load(stream)
+            except (OSError, ValueError):
+                continue
+            with self._lock:
+                self._process()
+                _add(*self._retired, snapshot, gauges=False)
+        if claimed:
+            # Сначала перенесенные счетчики записываются в свой снимок, потом удаляются чужие
+            self.flush(directory)
+            for claim in claimed:
+                try:
+                    os.remove(claim)
+                except OSError:
+                    pass
+
+    # Жив ли процесс снимка; тот же pid у текущего процесса с другим временем
+    # запуска - завершившийся предшественник
+    def _is_running(self, pid, started):
+        current_pid, current_started = self._process()
+        if pid == current_pid:
+            return started == current_started
+        return _is_alive(pid)
+
+
+# Снимки процессов в каталоге: [(путь, pid, время запуска)], прочие файлы пропускаются
+def _snapshot_files(directory):
+    files = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        match = SNAPSHOT_NAME.fullmatch(os.path.basename(path))
+        if match:
+            files.append((path, int(match.group(1)), int(match.group(2))))
+    return files
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+store = MetricsStore()
+
+
+def _pool_gauges():
+    gauges = []
+    for engine in db.engines.values():
+        pool = engine.pool
+        if not hasattr(pool, 'checkedout'):
+            continue
+        for state, value in (('checked_out', pool.checkedout()), ('checked_in', pool.checkedin()),
+                             ('overflow', max(pool.overflow(), 0)), ('size', pool.size())):
+            gauges.append(['cosmeticshop_db_pool_connections', [['state', state]], value])
+    return gauges
+
+
+# Складывает снимок в словари values и histograms с ключом (имя, метки)
+def _add(values, histograms, snapshot, gauges=True):
+    for name, labels, value in snapshot['values'] + (snapshot.get('gauges', []) if gauges else []):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        values[key] = values.get(key, 0) + value
+    for name, labels, data in snapshot['histograms']:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        total = histograms.setdefault(key, [0] * len(data))
+        for i, item in enumerate(data):
+            total[i] += item
+
+
+# Текст в формате Prometheus из снимков всех процессов
+def render(snapshots):
+    values = {}
+    histograms = {}
+    for snapshot in snapshots:
+        _add(values, histograms, snapshot)
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (metric, labels), data in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), data[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {data[-1]}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        else:
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unknown'
+        registry.inc('cosmeticshop_http_requests_total', endpoint=endpoint, method=request.method,
+                     status=str(response.status_code))
+        registry.observe('cosmeticshop_http_request_duration_seconds', time.perf_counter() - started,
+                         endpoint=endpoint, method=request.method)
+        store.maybe_flush()
+    return response
+
+
+# Первая запись в транзакции SQLite берет блокировку записи: ее длительность
+# включает ожидание busy_timeout, пока пишет другая касса
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if 'metrics_write_started' not in conn.info and statement.lstrip()[:7].upper().startswith(WRITE_PREFIXES):
+        conn.info['metrics_write_started'] = time.perf_counter()
+        conn.info['metrics_write_pending'] = True
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.pop('metrics_write_pending', False):
+        registry.observe('cosmeticshop_db_lock_wait_seconds', time.perf_counter() - conn.info['metrics_write_started'])
+
+
+def _end_transaction(conn):
+    conn.info.pop('metrics_write_started', None)
+    conn.info.pop('metrics_write_pending', None)
+
+
+def _handle_error(exception_context):
+    if 'database is locked' in str(exception_context.original_exception):
+        registry.inc('cosmeticshop_db_locked_errors_total')
+    if exception_context.connection is not None:
+        exception_context.connection.info.pop('metrics_write_pending', None)
+
+
+def _flush_at_exit(app, directory):
+    with app.app_context():
+        store.flush(directory)
+
+
+def init_metrics(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(engine, 'commit', _end_transaction)
+            event.listen(engine, 'rollback', _end_transaction)
+            event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    if app.config.get('METRICS_DIR'):
+        atexit.register(_flush_at_exit, app, app.config['METRICS_DIR'])
@@ -0,0 +1,187 @@
+from sqlalchemy import text
+
+from app.models import db
+
+
+# Миграции схемы для уже существующих баз (db.create_all() не меняет созданные таблицы).
+# Номер примененной версии хранится в PRAGMA user_version. Каждая миграция
+# идемпотентна: на новой базе, созданной через create_all(), она ничего не меняет.
+
+def _columns(connection, table):
+    return {row[1] for row in connection.execute(text(f'PRAGMA table_info({table})'))}
+
+
+def _migration_1_indexes(connection):
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_sales_sale_date ON sales (sale_date)',
+        'CREATE INDEX IF NOT EXISTS ix_sales_cashier_date ON sales (cashier_id, sale_date)',
+        'CREATE INDEX IF NOT EXISTS ix_sales_date_product ON sales (sale_date, product_id)',
+        'CREATE INDEX IF NOT EXISTS ix_sales_product ON sales (product_id)',
+        'CREATE INDEX IF NOT EXISTS ix_products_name ON products (name)',
+        'CREATE INDEX IF NOT EXISTS ix_products_category_name ON products (category, name)',
+        'CREATE INDEX IF NOT EXISTS ix_products_article ON products (article)',
+    ):
+        connection.execute(text(statement))
+
+
+def _migration_2_sale_day(connection):
+    if 'sale_day' not in _columns(connection, 'sales'):
+        connection.execute(text('ALTER TABLE sales ADD COLUMN sale_day DATE'))
+    connection.execute(text('UPDATE sales SET sale_day = date(sale_date) WHERE sale_day IS NULL'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_sales_day_date ON sales (sale_day, sale_date)'))
+
+
+def _migration_3_products_fts(connection):
+    from app.models.product import PRODUCTS_FTS_DDL
+    for statement in PRODUCTS_FTS_DDL:
+        connection.execute(text(statement))
+    connection.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+
+
+def _migration_4_daily_sales(connection):
+    from app.models.sales_rollup import REBUILD_SQL
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS daily_sales ('
+        'day DATE NOT NULL, product_id INTEGER NOT NULL, cashier_id INTEGER NOT NULL, '
+        'quantity INTEGER NOT NULL, revenue NUMERIC(12, 2) NOT NULL, line_count INTEGER NOT NULL, '
+        'PRIMARY KEY (day, product_id, cashier_id), '
+        'FOREIGN KEY(product_id) REFERENCES products (id), '
+        'FOREIGN KEY(cashier_id) REFERENCES users (id))'
+    ))
+    if connection.execute(text('SELECT COUNT(*) FROM daily_sales')).scalar() == 0:
+        connection.execute(text(REBUILD_SQL))
+
+
+def _migration_5_cache_versions(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS cache_versions ('
+        'name VARCHAR(50) NOT NULL, version INTEGER NOT NULL, PRIMARY KEY (name))'
+    ))
+
+
+# Счетчик изменений пользователей для кэша Flask-Login (app.models.cache.IdentityCache):
+# без строки в cache_versions копии пользователей не кэшируются
+def _migration_6_users_version(connection):
+    connection.execute(text(
+        "INSERT INTO cache_versions (name, version) VALUES ('users', abs(random() % 2147483647) + 1) "
+        "ON CONFLICT(name) DO NOTHING"
+    ))
+
+
+def _migration_7_catalog_seq(connection):
+    from app.models.product import CATALOG_SEQ_DDL
+    if 'change_seq' not in _columns(connection, 'products'):
+        connection.execute(text('ALTER TABLE products ADD COLUMN change_seq INTEGER'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_products_change_seq ON products (change_seq)'))
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS product_tombstones ('
+        'product_id INTEGER NOT NULL, change_seq INTEGER NOT NULL, PRIMARY KEY (product_id))'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_product_tombstones_change_seq ON product_tombstones (change_seq)'
+    ))
+    # Уже существующие товары нумеруются по id, счетчик продолжает с максимального номера
+    connection.execute(text('UPDATE products SET change_seq = id WHERE change_seq IS NULL'))
+    connection.execute(text(
+        "INSERT INTO cache_versions (name, version) "
+        "SELECT 'catalog_seq', coalesce(max(change_seq), 0) FROM products WHERE true "
+        "ON CONFLICT(name) DO UPDATE SET version = max(version, excluded.version)"
+    ))
+    for statement in CATALOG_SEQ_DDL:
+        connection.execute(text(statement))
+
+
+def _migration_8_report_results(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS report_results ('
+        'report VARCHAR(50) NOT NULL, params VARCHAR(500) NOT NULL, status VARCHAR(20) NOT NULL, '
+        'versions VARCHAR(200), result TEXT, error TEXT, '
+        'requested_at DATETIME, started_at DATETIME, computed_at DATETIME, '
+        'PRIMARY KEY (report, params))'
+    ))
+
+
+def _migration_9_receipts(connection):
+    from app.models.receipt import BACKFILL_LINKS_SQL, BACKFILL_SQL
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS receipts ('
+        'id INTEGER NOT NULL, cashier_id INTEGER NOT NULL, created_at DATETIME NOT NULL, '
+        'receipt_day DATE NOT NULL, total NUMERIC(12, 2) NOT NULL, line_count INTEGER NOT NULL, '
+        'item_count INTEGER NOT NULL, payment_method VARCHAR(20) NOT NULL, paid_amount NUMERIC(12, 2), '
+        'PRIMARY KEY (id), FOREIGN KEY(cashier_id) REFERENCES users (id))'
+    ))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_receipts_day ON receipts (receipt_day)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_receipts_cashier_date ON receipts (cashier_id, created_at)'))
+    if 'receipt_id' not in _columns(connection, 'sales'):
+        connection.execute(text('ALTER TABLE sales ADD COLUMN receipt_id INTEGER REFERENCES receipts (id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_sales_receipt ON sales (receipt_id)'))
+    connection.execute(text(BACKFILL_SQL))
+    connection.execute(text(BACKFILL_LINKS_SQL))
+
+
+def _migration_10_receipt_idempotency(connection):
+    if 'idempotency_key' not in _columns(connection, 'receipts'):
+        connection.execute(text('ALTER TABLE receipts ADD COLUMN idempotency_key VARCHAR(64)'))
+    if 'request_hash' not in _columns(connection, 'receipts'):
+        connection.execute(text('ALTER TABLE receipts ADD COLUMN request_hash VARCHAR(64)'))
+    connection.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_receipts_idempotency ON receipts (cashier_id, idempotency_key)'
+    ))
+
+
+def _migration_11_product_version(connection):
+    if 'version' not in _columns(connection, 'products'):
+        connection.execute(text('ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+
+def _migration_12_stock_reservations(connection):
+    from app.models.reservation import RESERVATION_SEQ_DDL
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS stock_reservations ('
+        'cart_id VARCHAR(64) NOT NULL, product_id INTEGER NOT NULL, cashier_id INTEGER NOT NULL, '
+        'quantity INTEGER NOT NULL, expires_at DATETIME NOT NULL, '
+        'PRIMARY KEY (cart_id, product_id), FOREIGN KEY(product_id) REFERENCES products (id), '
+        'FOREIGN KEY(cashier_id) REFERENCES users (id))'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_stock_reservations_expires ON stock_reservations (expires_at)'
+    ))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_stock_reservations_product ON stock_reservations (product_id, expires_at)'
+    ))
+    for statement in RESERVATION_SEQ_DDL:
+        connection.execute(text(statement))
+
+
+MIGRATIONS = [
+    (1, 'Индексы по полям фильтрации продаж и товаров', _migration_1_indexes),
+    (2, 'Столбец sale_day для выборок за день', _migration_2_sale_day),
+    (3, 'Полнотекстовый поиск товаров (FTS5)', _migration_3_products_fts),
+    (4, 'Сводка продаж по дням daily_sales', _migration_4_daily_sales),
+    (5, 'Версии кэша каталога cache_versions', _migration_5_cache_versions),
+    (6, 'Счетчик изменений пользователей для кэша Flask-Login', _migration_6_users_version),
+    (7, 'Номер изменения товара для синхронизации касс', _migration_7_catalog_seq),
+    (8, 'Результаты фоновых отчетов report_results', _migration_8_report_results),
+    (9, 'Чеки receipts и их строки в sales', _migration_9_receipts),
+    (10, 'Ключ идемпотентности и отпечаток запроса чека', _migration_10_receipt_idempotency),
+    (11, 'Версия товара для оптимистичных блокировок', _migration_11_product_version),
+    (12, 'Резервы товаров открытых корзин stock_reservations', _migration_12_stock_reservations),
+]
+
+
+def get_schema_version(connection):
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+# Применяет недостающие миграции по порядку и возвращает список примененных
+def run_migrations(engine=None):
+    engine = engine or db.engine
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        with engine.begin() as connection:
+            if get_schema_version(connection) >= version:
+                continue
+            migrate(connection)
+            connection.execute(text(f'PRAGMA user_version = {version}'))
+        applied.append((version, description))
+    return applied
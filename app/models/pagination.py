@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, literal, tuple_
+
+
+class Page:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+# Страница выборки по ключу (keyset): WHERE (ключ) > курсор ORDER BY ключ LIMIT n.
+# columns - столбцы сортировки, key(obj) - значения ключа для курсора,
+# after/before - курсоры следующей/предыдущей страницы.
+def keyset_page(query, columns, key, limit, after=None, before=None, descending=False):
+    after_values = _cursor_values(columns, after)
+    before_values = _cursor_values(columns, before)
+    backwards = before_values is not None and after_values is None
+    cursor_values = before_values if backwards else after_values
+
+    # При обратном проходе направление сортировки меняется, затем строки разворачиваются
+    ascending = descending == backwards
+    if cursor_values is not None:
+        if ascending:
+            query = query.filter(tuple_(*columns) > tuple_(*cursor_values))
+        else:
+            query = query.filter(tuple_(*columns) < tuple_(*cursor_values))
+    order = [column.asc() if ascending else column.desc() for column in columns]
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = encode_cursor(key(rows[-1]))
+        if cursor_values is not None and (has_more or not backwards):
+            prev_cursor = encode_cursor(key(rows[0]))
+    return Page(rows, next_cursor, prev_cursor)
+
+
+# Неверный курсор (испорченная ссылка) просто открывает первую страницу
+def _cursor_values(columns, cursor):
+    values = decode_cursor(cursor)
+    if values is None or len(values) != len(columns):
+        return None
+    try:
+        return [literal(datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value,
+                        type_=column.type)
+                for column, value in zip(columns, values)]
+    except (ValueError, TypeError):
+        return None
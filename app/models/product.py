@@ -1,8 +1,20 @@
+import re
+
+from sqlalchemy import DDL, Float, Integer, event, text
+
 from app.models import db
+from app.models.cache import catalog_cache, categories_cache, current_version, snapshot
+from app.models.pagination import Page, keyset_page
 
 
 class Product(db.Model):
     __tablename__ = "products"
+    __table_args__ = (
+        db.Index('ix_products_name', 'name'),
+        db.Index('ix_products_category_name', 'category', 'name'),
+        db.Index('ix_products_article', 'article'),
+        db.Index('ix_products_change_seq', 'change_seq'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
@@ -14,6 +26,11 @@ class Product(db.Model):
     stock_quantity = db.Column(db.Integer, nullable=False, default=0)
     description = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
+    # Номер последнего изменения товара, проставляется триггерами (см. CATALOG_SEQ_DDL)
+    change_seq = db.Column(db.Integer, nullable=True)
+    # Версия строки для сравнения с обменом: каждое изменение товара (форма, импорт,
+    # списание при продаже) увеличивает ее на 1 в том же UPDATE
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     sales = db.relationship('Sale', backref='product', lazy=True)
 
@@ -31,54 +48,158 @@ class Product(db.Model):
         return {
             'id': self.id,
             'name': self.name,
+            'article': self.article,
+            'package': self.package,
             'category': self.category,
             'price': float(self.price),
+            'discount_price': float(self.discount_price) if self.discount_price else None,
             'stock_quantity': self.stock_quantity,
-            'description': self.description
+            'description': self.description,
+            'version': self.version
         }
 
 
+# Товар изменили после того, как его прочитал автор изменения.
+# product - текущее состояние товара из базы.
+class ProductConflict(Exception):
+    def __init__(self, product):
+        super().__init__(f"Товар '{product.name}' изменен другим пользователем")
+        self.product = product
+
+
+# Полнотекстовый индекс FTS5 по названию, артикулу, категории и описанию.
+# Таблица хранит только индекс (content='products'), триггеры держат его в синхронизации;
+# изменение остатков и цен индекс не трогает.
+PRODUCTS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, article, category, description,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, article, category, description)
+        VALUES (new.id, new.name, new.article, new.category, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, article, category, description)
+        VALUES ('delete', old.id, old.name, old.article, old.category, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, article, category, description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, article, category, description)
+        VALUES ('delete', old.id, old.name, old.article, old.category, old.description);
+        INSERT INTO products_fts(rowid, name, article, category, description)
+        VALUES (new.id, new.name, new.article, new.category, new.description);
+    END""",
+]
+
+for statement in PRODUCTS_FTS_DDL:
+    event.listen(Product.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Product.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS products_fts').execute_if(dialect='sqlite'))
+
+
+# Удаленные товары: нужны кассам, чтобы убрать товар из своей копии каталога
+class ProductTombstone(db.Model):
+    __tablename__ = "product_tombstones"
+    __table_args__ = (
+        db.Index('ix_product_tombstones_change_seq', 'change_seq'),
+    )
+
+    product_id = db.Column(db.Integer, primary_key=True)
+    change_seq = db.Column(db.Integer, nullable=False)
+
+
+# Последовательность изменений каталога для синхронизации касс дельтами.
+# Любая вставка, изменение или удаление товара (через ORM, executemany импорта
+# или списание остатков при продаже) увеличивает счетчик catalog_seq в cache_versions
+# и записывает его значение в products.change_seq или в product_tombstones.
+# Запись в SQLite одна за раз, поэтому номера растут в порядке коммитов.
+CATALOG_SEQ = 'catalog_seq'
+_NEXT_SEQ = (
+    "INSERT INTO cache_versions (name, version) VALUES ('catalog_seq', 1) "
+    "ON CONFLICT(name) DO UPDATE SET version = version + 1;"
+)
+_CURRENT_SEQ = "(SELECT version FROM cache_versions WHERE name = 'catalog_seq')"
+CATALOG_SEQ_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS products_seq_ai AFTER INSERT ON products BEGIN
+        {_NEXT_SEQ}
+        UPDATE products SET change_seq = {_CURRENT_SEQ} WHERE id = new.id;
+        DELETE FROM product_tombstones WHERE product_id = new.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_seq_au AFTER UPDATE OF
+        name, article, package, category, price, discount_price, stock_quantity, description ON products BEGIN
+        {_NEXT_SEQ}
+        UPDATE products SET change_seq = {_CURRENT_SEQ} WHERE id = new.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS products_seq_ad AFTER DELETE ON products BEGIN
+        {_NEXT_SEQ}
+        INSERT OR REPLACE INTO product_tombstones (product_id, change_seq) VALUES (old.id, {_CURRENT_SEQ});
+    END""",
+]
+
+for statement in CATALOG_SEQ_DDL:
+    event.listen(Product.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+# Каждое слово запроса ищется как префикс: "крем дл" -> "крем"* "дл"*
+def fts_query(search_term):
+    words = re.findall(r'\w+', search_term or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
 class ProductRepo:
     def all(self):
         return db.session.query(Product).all()
 
+    # Постраничная выборка по ключу (name, id), при необходимости внутри категории
+    def page(self, category=None, after=None, before=None, limit=48):
+        query = Product.query
+        if category:
+            query = query.filter_by(category=category)
+        return keyset_page(query, [Product.name, Product.id], lambda product: (product.name, product.id),
+                           limit, after, before)
+
     def get_by_id(self, product_id):
         return Product.query.get(product_id)
 
     def add(self, name, category, price, stock_quantity, description=None, article=None, package=None):
         product = Product(name, category, price, stock_quantity, description, None, article, package)
         db.session.add(product)
+        self._invalidate_caches()
         db.session.commit()
         return product
 
-    def update(self, product_id, name=None, category=None, price=None, 
-               stock_quantity=None, description=None, discount_price=None, article=None, package=None):
-        product = self.get_by_id(product_id)
-        if not product:
-            return None
-        if name:
-            product.name = name
-        if category:
-            product.category = category
-        if price is not None:
-            product.price = price
-        if stock_quantity is not None:
-            product.stock_quantity = stock_quantity
-        if description is not None:
-            product.description = description
-        if discount_price is not None:
-            product.discount_price = discount_price
-        if article is not None:
-            product.article = article
-        if package is not None:
-            product.package = package
+    # Изменение одним UPDATE без предварительного чтения: записываются только переданные поля,
+    # версия увеличивается. С expected_version это сравнение с обменом - если товар успели
+    # изменить (продажа, другой директор), ничего не пишется и бросается ProductConflict.
+    # discount_price=None оставляет скидку как есть, clear_discount=True снимает ее.
+    def update(self, product_id, name=None, category=None, price=None,
+               stock_quantity=None, description=None, discount_price=None, article=None, package=None,
+               expected_version=None, clear_discount=False):
+        fields = {'name': name or None, 'category': category or None, 'price': price,
+                  'stock_quantity': stock_quantity, 'description': description,
+                  'discount_price': discount_price, 'article': article, 'package': package}
+        table = Product.__table__
+        values = {field: value for field, value in fields.items() if value is not None}
+        if clear_discount:
+            values['discount_price'] = None
+        statement = table.update().where(table.c.id == product_id).values(**values, version=table.c.version + 1)
+        if expected_version is not None:
+            statement = statement.where(table.c.version == expected_version)
+        if db.session.execute(statement).rowcount == 0:
+            db.session.rollback()
+            product = self.get_by_id(product_id)
+            if not product:
+                return None
+            raise ProductConflict(product)
+        self._invalidate_caches()
         db.session.commit()
-        return product
+        return self.get_by_id(product_id)
 
     def delete(self, product_id):
         product = self.get_by_id(product_id)
         if product:
             db.session.delete(product)
+            self._invalidate_caches()
             db.session.commit()
             return True
         return False
@@ -87,9 +208,80 @@ class ProductRepo:
         return Product.query.filter_by(category=category).all()
 
     def filter_by_name(self, search_term):
-        return Product.query.filter(Product.name.ilike(f'%{search_term}%')).all()
+        return self.search(search_term)
+
+    # Поиск по FTS5 с ранжированием bm25: совпадение в названии весит больше всего
+    def search(self, search_term, limit=None):
+        found = self._search_query(search_term)
+        if found is None:
+            return []
+        query, rank = found
+        query = query.order_by(rank, Product.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return [product for product, _ in query.all()]
+
+    # Постраничный поиск по ключу (rank, id): порядок по релевантности, как в search
+    def search_page(self, search_term, after=None, before=None, limit=48):
+        found = self._search_query(search_term)
+        if found is None:
+            return Page([])
+        query, rank = found
+        page = keyset_page(query, [rank, Product.id], lambda row: (row[1], row[0].id),
+                           limit, after, before)
+        page.items = [product for product, _ in page.items]
+        return page
+
+    # Запрос (товар, rank) по совпадениям FTS5 и столбец rank; None - в запросе нет слов
+    @staticmethod
+    def _search_query(search_term):
+        query = fts_query(search_term)
+        if not query:
+            return None
+        matches = text(
+            "SELECT rowid, bm25(products_fts, 10.0, 5.0, 2.0, 1.0) AS rank "
+            "FROM products_fts WHERE products_fts MATCH :query"
+        ).bindparams(query=query).columns(rowid=Integer, rank=Float).subquery()
+        return (db.session.query(Product, matches.c.rank)
+                .join(matches, matches.c.rowid == Product.id)), matches.c.rank
 
     def get_categories(self):
+        return categories_cache.get('all', self._load_categories)
+
+    def _load_categories(self):
         categories = db.session.query(Product.category).distinct().all()
         return [cat[0] for cat in categories]
 
+    # Весь каталог из кэша процесса (копии строк, не привязанные к сессии)
+    def get_catalog(self):
+        return catalog_cache.get('all', lambda: [
+            snapshot(product) for product in Product.query.order_by(Product.name, Product.id).all()
+        ])
+
+    # Изменения каталога после номера since: (текущий номер, измененные и новые товары,
+    # id удаленных, reset). Верхняя граница читается первой, поэтому изменения,
+    # закоммиченные во время выборки, не пропадут, а придут в следующей дельте.
+    # since больше текущего номера (база пересоздана) - отдается весь каталог с reset=True.
+    def get_changes(self, since=0):
+        seq = current_version(CATALOG_SEQ)
+        reset = since > seq
+        if reset:
+            since = 0
+        products = (Product.query
+                    .filter(Product.change_seq > since, Product.change_seq <= seq)
+                    .order_by(Product.change_seq)
+                    .all())
+        deleted = [] if not since else [row.product_id for row in (
+            ProductTombstone.query
+            .filter(ProductTombstone.change_seq > since, ProductTombstone.change_seq <= seq)
+            .all()
+        )]
+        return seq, products, deleted, reset
+
+    def get_available(self):
+        return [product for product in self.get_catalog() if product.stock_quantity > 0]
+
+    def _invalidate_caches(self):
+        catalog_cache.invalidate()
+        categories_cache.invalidate()
+
@@ -0,0 +1,172 @@
+import csv
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import bindparam, func
+
+from app.models import db
+from app.models.cache import catalog_cache, categories_cache
+from app.models.product import Product
+
+# Заголовки столбцов файла: английские имена полей и русские названия из прайс-листов
+FIELD_ALIASES = {
+    'name': 'name', 'название': 'name', 'наименование': 'name',
+    'article': 'article', 'артикул': 'article',
+    'package': 'package', 'упаковка': 'package',
+    'category': 'category', 'категория': 'category',
+    'price': 'price', 'цена': 'price',
+    'discount_price': 'discount_price', 'цена со скидкой': 'discount_price',
+    'stock_quantity': 'stock_quantity', 'остаток': 'stock_quantity', 'количество': 'stock_quantity',
+    'description': 'description', 'описание': 'description',
+}
+REQUIRED_FIELDS = ('name', 'category', 'price')
+UPDATE_FIELDS = ('name', 'package', 'category', 'price', 'discount_price', 'stock_quantity', 'description')
+
+
+class ImportResult:
+    MAX_ERRORS = 1000
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((line, message))
+
+
+def _detect_delimiter(header_line):
+    # Excel в русской локали сохраняет CSV через точку с запятой
+    return max((';', ',', '\t'), key=header_line.count)
+
+
+def _decimal(value, field_title):
+    try:
+        return Decimal(value.replace('\xa0', '').replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"{field_title}: неверное число '{value}'")
+
+
+# Импорт товаров из CSV (в том числе выгрузки из Excel): строки читаются по одной,
+# пишутся пачками по batch_size в одной транзакции через executemany.
+# Товар с уже существующим артикулом обновляется, остальные добавляются.
+# У существующего товара меняются только поля, столбцы которых есть в файле;
+# пустой остаток его не обнуляет. Ошибочные строки попадают в отчет и не прерывают импорт.
+class ProductImporter:
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def import_csv(self, stream):
+        result = ImportResult()
+        header_line = stream.readline()
+        delimiter = _detect_delimiter(header_line)
+        header = next(csv.reader([header_line], delimiter=delimiter), [])
+        fields = [FIELD_ALIASES.get(title.strip().lower()) for title in header]
+        missing = [field for field in REQUIRED_FIELDS if field not in fields]
+        if missing:
+            raise ValueError(f"В файле нет обязательных столбцов: {', '.join(missing)}")
+        columns = [field for field in UPDATE_FIELDS if field in fields]
+
+        reader = csv.reader(stream, delimiter=delimiter)
+        batch = []
+        for row in reader:
+            line = reader.line_num + 1
+            if not any(cell.strip() for cell in row):
+                continue
+            try:
+                batch.append(self._parse(line, fields, row))
+            except ValueError as e:
+                result.add_error(line, str(e))
+            if len(batch) >= self.batch_size:
+                self._write(batch, columns, result)
+                batch = []
+        if batch:
+            self._write(batch, columns, result)
+        return result
+
+    def _parse(self, line, fields, row):
+        values = {}
+        for field, cell in zip(fields, row):
+            if field:
+                values[field] = cell.strip()
+
+        for field in REQUIRED_FIELDS:
+            if not values.get(field):
+                raise ValueError(f"не заполнено поле {field}")
+
+        price = _decimal(values['price'], 'цена')
+        if price <= 0:
+            raise ValueError("цена должна быть больше нуля")
+        discount_price = _decimal(values['discount_price'], 'цена со скидкой') if values.get('discount_price') else None
+        # None - остаток не указан: у нового товара 0, у существующего прежний
+        try:
+            stock_quantity = int(values['stock_quantity']) if values.get('stock_quantity') else None
+        except ValueError:
+            raise ValueError(f"остаток: неверное число '{values['stock_quantity']}'")
+        if stock_quantity is not None and stock_quantity < 0:
+            raise ValueError("остаток не может быть отрицательным")
+
+        return {
+            'line': line,
+            'name': values['name'],
+            'article': values.get('article') or None,
+            'package': values.get('package') or None,
+            'category': values['category'],
+            'price': price,
+            'discount_price': discount_price,
+            'stock_quantity': stock_quantity,
+            'description': values.get('description') or None,
+        }
+
+    # columns - обновляемые поля существующих товаров (столбцы, которые есть в файле)
+    def _write(self, batch, columns, result):
+        # Повтор артикула внутри пачки: действует последняя строка
+        by_article = {}
+        without_article = []
+        for row in batch:
+            if row['article']:
+                by_article[row['article']] = row
+            else:
+                without_article.append(row)
+
+        try:
+            existing = dict(
+                db.session.query(Product.article, Product.id)
+                .filter(Product.article.in_(list(by_article))).all()
+            ) if by_article else {}
+
+            inserts = without_article + [row for article, row in by_article.items() if article not in existing]
+            updates = [dict(row, row_id=existing[article]) for article, row in by_article.items() if article in existing]
+
+            table = Product.__table__
+            connection = db.session.connection()
+            if inserts:
+                connection.execute(table.insert(), [
+                    {**{key: value for key, value in row.items() if key != 'line'},
+                     'stock_quantity': row['stock_quantity'] or 0}
+                    for row in inserts
+                ])
+            if updates:
+                values = {field: bindparam(f'new_{field}') for field in columns}
+                if 'stock_quantity' in values:
+                    values['stock_quantity'] = func.coalesce(values['stock_quantity'], table.c.stock_quantity)
+                statement = table.update().where(table.c.id == bindparam('row_id')).values(
+                    {**values, 'version': table.c.version + 1}
+                )
+                connection.execute(statement, [
+                    {'row_id': row['row_id'], **{f'new_{field}': row[field] for field in columns}}
+                    for row in updates
+                ])
+            catalog_cache.invalidate(connection)
+            categories_cache.invalidate(connection)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for row in batch:
+                result.add_error(row['line'], f"ошибка записи: {e}")
+            return
+
+        result.created += len(inserts)
+        result.updated += len(updates)
@@ -0,0 +1,87 @@
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app.models import db
+from app.models.pagination import encode_cursor
+
+
+# Запросы репозиториев, которые должны идти по индексу. Агрегаты по всей таблице
+# (общая выручка, топ товаров) и полный каталог сюда не входят - им индекс не поможет.
+def _repo_queries():
+    from app.models.product import ProductRepo
+    from app.models.sale import SaleRepo
+    from app.models.sales_rollup import SalesRollupRepo
+    from app.models.analytics import SalesAnalyticsRepo
+    from app.models.receipt import ReceiptRepo
+    from app.models.reservation import ReservationService
+
+    sale_repo = SaleRepo()
+    product_repo = ProductRepo()
+    rollup_repo = SalesRollupRepo()
+    now = datetime.utcnow()
+    sale_cursor = encode_cursor([now, 1])
+    product_cursor = encode_cursor(['Крем', 1])
+    return [
+        ('SaleRepo.all', sale_repo.all),
+        ('SaleRepo.all_with_details', sale_repo.all_with_details),
+        ('SaleRepo.get_by_cashier', lambda: sale_repo.get_by_cashier(1)),
+        ('SaleRepo.get_by_cashier_with_details', lambda: sale_repo.get_by_cashier_with_details(1)),
+        ('SaleRepo.get_by_product', lambda: sale_repo.get_by_product(1)),
+        ('SaleRepo.get_by_day_with_details', lambda: sale_repo.get_by_day_with_details(now.date())),
+        ('SaleRepo.get_by_date_range_with_details', lambda: sale_repo.get_by_date_range_with_details(now, now)),
+        ('SaleRepo.get_revenue_by_date_range', lambda: sale_repo.get_revenue_by_date_range(now, now)),
+        ('SaleRepo.page_with_details', lambda: sale_repo.page_with_details(after=sale_cursor)),
+        ('SaleRepo.page_with_details(cashier)', lambda: sale_repo.page_with_details(1, after=sale_cursor)),
+        ('SalesRollupRepo.get_by_day', lambda: rollup_repo.get_by_day(now.date())),
+        ('SalesRollupRepo.get_day_totals', lambda: rollup_repo.get_day_totals(now.date())),
+        ('SalesRollupRepo.get_revenue_by_days', lambda: rollup_repo.get_revenue_by_days(now.date(), now.date())),
+        ('ReceiptRepo.get_with_lines', lambda: ReceiptRepo().get_with_lines(1)),
+        ('ReceiptRepo.get_totals(cashier)', lambda: ReceiptRepo().get_totals(cashier_id=1)),
+        ('ReceiptRepo.get_totals(day)', lambda: ReceiptRepo().get_totals(day=now.date())),
+        ('SalesAnalyticsRepo.compare_periods', lambda: SalesAnalyticsRepo().compare_periods(now.date(), now.date())),
+        ('ProductRepo.get_by_id', lambda: product_repo.get_by_id(1)),
+        ('ProductRepo.filter_by_category', lambda: product_repo.filter_by_category('Крем')),
+        ('ProductRepo.get_categories', product_repo.get_categories),
+        ('ProductRepo.page', lambda: product_repo.page(after=product_cursor)),
+        ('ProductRepo.page(category)', lambda: product_repo.page('Крем', after=product_cursor)),
+        ('ProductRepo.get_changes', lambda: product_repo.get_changes(1)),
+        ('ReservationService.get', lambda: ReservationService().get('cart', 1)),
+        ('ReservationService.held', lambda: ReservationService().held([1])),
+        ('ReservationService.release_expired', lambda: ReservationService().release_expired()),
+    ]
+
+
+# Сортировка во временном B-дереве допустима, когда запрос и так возвращает все
+# отобранные строки; при LIMIT она означает сортировку всей выборки ради первых N
+def _is_unindexed(statement, detail):
+    detail = detail.upper()
+    if 'USE TEMP B-TREE' in detail:
+        return ' LIMIT ' in statement.upper()
+    return detail.startswith('SCAN') and 'USING' not in detail
+
+
+# Выполняет запросы репозиториев, для каждого SQL-выражения берет EXPLAIN QUERY PLAN
+# и возвращает [(имя запроса, SQL, строка плана)] для шагов без индекса
+def check_query_plans(queries=None):
+    captured = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    problems = []
+    for name, run in queries or _repo_queries():
+        captured.clear()
+        event.listen(db.engine, 'before_cursor_execute', on_execute)
+        try:
+            run()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', on_execute)
+        for statement, parameters in list(captured):
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            for row in plan:
+                if _is_unindexed(statement, row[-1]):
+                    problems.append((name, statement, row[-1]))
+    return problems
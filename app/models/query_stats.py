@@ -0,0 +1,116 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from app.models import db
+
+logger = logging.getLogger('cosmeticshop.requests')
+SLOWEST_STATEMENT_LENGTH = 300
+
+_local = threading.local()
+
+
+# Число SQL-запросов, их общее время и самый медленный запрос
+class QueryStats:
+    def __init__(self, keep_statements=False):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.statements = [] if keep_statements else None
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        if duration >= self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+# Считает запросы текущего потока внутри блока with, в том числе сделанные
+# тестовым клиентом: with capture_queries() as stats: client.get(...)
+@contextmanager
+def capture_queries():
+    stats = QueryStats(keep_statements=True)
+    collectors = _local.__dict__.setdefault('collectors', [])
+    collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+def _active_stats():
+    active = list(getattr(_local, 'collectors', ()))
+    if has_request_context() and g.get('query_stats') is not None:
+        active.append(g.query_stats)
+    return active
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    for stats in _active_stats():
+        stats.record(statement, duration)
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+    g.request_started = time.perf_counter()
+
+
+# Server-Timing показывает время SQL и всего запроса в инструментах разработчика браузера;
+# строка лога в JSON - для поиска страниц с лишними запросами. Медленные запросы
+# (дольше SLOW_REQUEST_MS) пишутся с уровнем WARNING, остальные - INFO.
+def _finish_request(response):
+    stats = g.pop('query_stats', None)
+    started = g.pop('request_started', None)
+    if stats is None or started is None:
+        return response
+    duration_ms = (time.perf_counter() - started) * 1000
+    sql_ms = stats.total_time * 1000
+
+    response.headers.add('Server-Timing', f'db;dur={sql_ms:.2f};desc="{stats.count} queries"')
+    response.headers.add('Server-Timing', f'app;dur={duration_ms:.2f}')
+
+    level = logging.WARNING if duration_ms >= current_app.config.get('SLOW_REQUEST_MS', 500) else logging.INFO
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 2),
+            'queries': stats.count,
+            'sql_ms': round(sql_ms, 2),
+            'slowest_sql_ms': round(stats.slowest_time * 1000, 2),
+            'slowest_sql': (stats.slowest_statement or '')[:SLOWEST_STATEMENT_LENGTH],
+        }, ensure_ascii=False))
+    return response
+
+
+# Подключает учет запросов к движкам приложения и к обработке каждого запроса Flask
+def init_query_stats(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,92 @@
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+
+from app.models import db
+
+PAYMENT_CASH = 'cash'
+PAYMENT_CARD = 'card'
+PAYMENT_METHODS = {PAYMENT_CASH: 'Наличные', PAYMENT_CARD: 'Карта'}
+
+# Чеки для продаж, оформленных до появления таблицы receipts: строки одного кассира
+# с одним временем продажи (корзина записывалась с общим sale_date) собираются в один чек
+BACKFILL_SQL = (
+    'INSERT INTO receipts (cashier_id, created_at, receipt_day, total, line_count, item_count, payment_method) '
+    "SELECT cashier_id, sale_date, sale_day, SUM(total_price), COUNT(*), SUM(quantity), 'cash' "
+    'FROM sales WHERE receipt_id IS NULL GROUP BY cashier_id, sale_date'
+)
+BACKFILL_LINKS_SQL = (
+    'UPDATE sales SET receipt_id = (SELECT receipts.id FROM receipts '
+    'WHERE receipts.cashier_id = sales.cashier_id AND receipts.created_at = sales.sale_date) '
+    'WHERE receipt_id IS NULL'
+)
+
+
+# Чек - один документ на оформленную корзину: итог, число строк и штук, оплата.
+# Строки чека - записи Sale с receipt_id.
+class Receipt(db.Model):
+    __tablename__ = "receipts"
+    __table_args__ = (
+        db.Index('ix_receipts_day', 'receipt_day'),
+        db.Index('ix_receipts_cashier_date', 'cashier_id', 'created_at'),
+        db.Index('ux_receipts_idempotency', 'cashier_id', 'idempotency_key', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cashier_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    receipt_day = db.Column(db.Date, nullable=False)
+    total = db.Column(db.Numeric(12, 2), nullable=False)
+    line_count = db.Column(db.Integer, nullable=False)
+    item_count = db.Column(db.Integer, nullable=False)
+    payment_method = db.Column(db.String(20), nullable=False, default=PAYMENT_CASH)
+    # Сколько получено от покупателя (для наличных), сдача = paid_amount - total
+    paid_amount = db.Column(db.Numeric(12, 2))
+    # Ключ идемпотентности из формы кассы: повтор того же POST не создаст второй чек
+    idempotency_key = db.Column(db.String(64))
+    # Отпечаток строк и оплаты запроса с этим ключом (app.models.checkout.request_hash)
+    request_hash = db.Column(db.String(64))
+
+    cashier = db.relationship('User')
+    lines = db.relationship('Sale', backref='receipt', order_by='Sale.id', lazy=True)
+
+    @property
+    def change(self):
+        return self.paid_amount - self.total if self.paid_amount is not None else None
+
+    @property
+    def payment_title(self):
+        return PAYMENT_METHODS.get(self.payment_method, self.payment_method)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'cashier_id': self.cashier_id,
+            'created_at': self.created_at.isoformat(),
+            'total': float(self.total),
+            'line_count': self.line_count,
+            'item_count': self.item_count,
+            'payment_method': self.payment_method,
+            'paid_amount': float(self.paid_amount) if self.paid_amount is not None else None,
+        }
+
+
+class ReceiptRepo:
+    # Чек со строками, товарами и кассиром: три запроса независимо от числа строк
+    def get_with_lines(self, receipt_id):
+        from app.models.sale import Sale
+        return Receipt.query.options(
+            joinedload(Receipt.cashier),
+            selectinload(Receipt.lines).joinedload(Sale.product)
+        ).filter(Receipt.id == receipt_id).first()
+
+    # Число чеков и выручка одним агрегатом по чекам; фильтр по кассиру или дню идет по индексу
+    def get_totals(self, cashier_id=None, day=None):
+        query = db.session.query(func.count(Receipt.id), func.sum(Receipt.total))
+        if cashier_id is not None:
+            query = query.filter(Receipt.cashier_id == cashier_id)
+        if day is not None:
+            query = query.filter(Receipt.receipt_day == day)
+        count, revenue = query.one()
+        return count, float(revenue) if revenue else 0.0
@@ -0,0 +1,253 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from flask import current_app
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import db
+from app.models.analytics import SalesAnalyticsRepo
+from app.models.cache import catalog_cache, current_versions
+from app.models.product import ProductRepo
+from app.models.receipt import ReceiptRepo
+from app.models.sale import SALES_VERSION
+from app.models.sales_rollup import SalesRollupRepo
+
+logger = logging.getLogger('cosmeticshop.reports')
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+# Последний результат отчета для набора параметров. Результат (JSON) остается в строке,
+# пока считается новый, поэтому страница всегда может показать последние готовые данные.
+# versions - версии данных (cache_versions), с которыми посчитан результат.
+class ReportResult(db.Model):
+    __tablename__ = "report_results"
+
+    report = db.Column(db.String(50), primary_key=True)
+    params = db.Column(db.String(500), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default=STATUS_QUEUED)
+    versions = db.Column(db.String(200))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    requested_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    computed_at = db.Column(db.DateTime)
+
+
+# Отчеты: имя -> (функция, наборы данных, от которых зависит результат).
+# Функция получает параметры из JSON (даты - строками ГГГГ-ММ-ДД) и возвращает
+# словарь, который можно сохранить в JSON.
+REPORTS = {}
+
+
+def report(name, version_names):
+    def decorator(function):
+        REPORTS[name] = (function, version_names)
+        return function
+    return decorator
+
+
+@report('statistics', [SALES_VERSION, catalog_cache.name])
+def statistics_report():
+    rollup = SalesRollupRepo()
+    receipts_count, total_revenue = ReceiptRepo().get_totals()
+    return {
+        'total_revenue': total_revenue,
+        'total_sales_count': receipts_count,
+        'average_receipt': total_revenue / receipts_count if receipts_count else 0.0,
+        'top_products': [
+            {'name': row.name, 'total_quantity': int(row.total_quantity), 'total_revenue': float(row.total_revenue)}
+            for row in rollup.get_top_products(limit=10)
+        ],
+    }
+
+
+@report('daily_report', [SALES_VERSION, catalog_cache.name])
+def daily_report(day):
+    day = date.fromisoformat(day)
+    receipts_count, daily_revenue = ReceiptRepo().get_totals(day=day)
+    rows = [
+        {
+            'product_name': row.product.name if row.product else None,
+            'article': row.product.article if row.product else None,
+            'package': row.product.package if row.product else None,
+            'cashier_name': row.cashier.username if row.cashier else None,
+            'quantity': row.quantity,
+            'revenue': float(row.revenue),
+            'line_count': row.line_count,
+        }
+        for row in SalesRollupRepo().get_by_day(day)
+    ]
+    return {
+        'rows': rows,
+        'daily_revenue': daily_revenue,
+        'sales_count': receipts_count,
+        'average_receipt': daily_revenue / receipts_count if receipts_count else 0.0,
+    }
+
+
+@report('analytics', [SALES_VERSION])
+def analytics_report(start_day, end_day, granularity):
+    repo = SalesAnalyticsRepo()
+    start_day, end_day = date.fromisoformat(start_day), date.fromisoformat(end_day)
+    try:
+        series, error = repo.revenue_series(start_day, end_day, granularity), None
+    except ValueError as e:
+        series, error = [], str(e)
+    comparison = repo.compare_periods(start_day, end_day)
+    comparison['previous_start'] = comparison['previous_start'].isoformat()
+    comparison['previous_end'] = comparison['previous_end'].isoformat()
+    return {
+        'series': series,
+        'error': error,
+        'comparison': comparison,
+        'max_revenue': max((row['revenue'] for row in series), default=0),
+    }
+
+
+@report('assortment', [SALES_VERSION, catalog_cache.name])
+def assortment_report(start_day, end_day):
+    # NumPy загружается при первом расчете отчета, а не при старте рабочего процесса
+    from app.models.assortment import AssortmentAnalytics
+
+    result = AssortmentAnalytics().report(
+        date.fromisoformat(start_day), date.fromisoformat(end_day), ProductRepo().get_catalog()
+    )
+    for row in result['rows']:
+        product = row.pop('product')
+        row.update(product_id=product.id, product_name=product.name, stock_quantity=product.stock_quantity)
+    result['start_day'] = result['start_day'].isoformat()
+    result['end_day'] = result['end_day'].isoformat()
+    return result
+
+
+# Отчеты считаются в ограниченном пуле потоков (REPORT_WORKERS), а не в обработчике запроса.
+# Повторный запрос с теми же параметрами получает готовый результат, пока данные не изменились,
+# и не чаще раза в REPORT_MIN_INTERVAL секунд запускает пересчет, даже если продажи идут.
+# Один отчет с одними параметрами считается не больше чем одной задачей на все процессы:
+# задачу ставит тот, кто перевел строку в статус queued.
+class ReportJobs:
+    def __init__(self):
+        self._executor = None
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=current_app.config.get('REPORT_WORKERS', 1),
+                        thread_name_prefix='report'
+                    )
+        return self._executor
+
+    # Состояние отчета: result (словарь или None, если еще не считался), computed_at,
+    # pending - идет пересчет, error - ошибка последнего пересчета.
+    # Запрос ждет задачу не дольше REPORT_WAIT_SECONDS, затем отдает то, что есть.
+    def get(self, name, **params):
+        config = current_app.config
+        key = json.dumps(params, sort_keys=True)
+        versions = json.dumps(current_versions(REPORTS[name][1]))
+        now = datetime.utcnow()
+        row = db.session.get(ReportResult, (name, key))
+
+        job_timeout = config.get('REPORT_JOB_TIMEOUT', 300)
+        if self._is_fresh(row, versions, now, config.get('REPORT_MIN_INTERVAL', 30), job_timeout):
+            if (name, key) not in self._futures:
+                return self._state(row)
+        elif self._claim(name, key, now, job_timeout):
+            self._submit(name, key, params)
+        # Завершить транзакцию чтения, иначе SQLite покажет строку на момент ее начала
+        db.session.commit()
+
+        future = self._futures.get((name, key))
+        if future is not None:
+            wait([future], timeout=config.get('REPORT_WAIT_SECONDS', 0.5))
+        return self._state(db.session.get(ReportResult, (name, key), populate_existing=True))
+
+    @staticmethod
+    def _state(row):
+        return SimpleNamespace(
+            result=json.loads(row.result) if row.result else None,
+            computed_at=row.computed_at,
+            pending=row.status in (STATUS_QUEUED, STATUS_RUNNING),
+            error=row.error if row.status == STATUS_FAILED else None,
+        )
+
+    @staticmethod
+    def _is_fresh(row, versions, now, min_interval, job_timeout):
+        if row is None:
+            return False
+        if row.status in (STATUS_QUEUED, STATUS_RUNNING):
+            return now - row.requested_at < timedelta(seconds=job_timeout)
+        if row.status == STATUS_FAILED:
+            return now - row.requested_at < timedelta(seconds=min_interval)
+        return row.versions == versions or now - row.computed_at < timedelta(seconds=min_interval)
+
+    # Строка переводится в queued одним upsert; зависшая задача (процесс завершился,
+    # не досчитав) перезапускается через REPORT_JOB_TIMEOUT секунд
+    def _claim(self, name, key, now, job_timeout):
+        table = ReportResult.__table__
+        statement = sqlite_insert(table).values(report=name, params=key, status=STATUS_QUEUED, requested_at=now)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.report, table.c.params],
+            set_={'status': STATUS_QUEUED, 'requested_at': now},
+            where=table.c.status.notin_([STATUS_QUEUED, STATUS_RUNNING])
+            | (table.c.requested_at < now - timedelta(seconds=job_timeout))
+        )
+        claimed = db.session.execute(statement).rowcount > 0
+        db.session.commit()
+        return claimed
+
+    def _submit(self, name, key, params):
+        app = current_app._get_current_object()
+        future = self._get_executor().submit(self._run, app, name, key, params)
+        with self._lock:
+            self._futures[(name, key)] = future
+        future.add_done_callback(lambda done: self._forget(name, key, done))
+
+    def _forget(self, name, key, future):
+        with self._lock:
+            if self._futures.get((name, key)) is future:
+                del self._futures[(name, key)]
+
+    @staticmethod
+    def _run(app, name, key, params):
+        function, version_names = REPORTS[name]
+        table = ReportResult.__table__
+        selected = (table.c.report == name) & (table.c.params == key)
+        with app.app_context():
+            # Версии читаются до расчета: продажи во время расчета сделают результат устаревшим
+            versions = json.dumps(current_versions(version_names))
+            db.session.execute(update(table).where(selected).values(status=STATUS_RUNNING,
+                                                                    started_at=datetime.utcnow()))
+            db.session.commit()
+            try:
+                result = json.dumps(function(**params), ensure_ascii=False)
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Отчет %s %s не построен", name, key)
+                values = {'status': STATUS_FAILED, 'error': str(e)}
+            else:
+                values = {'status': STATUS_DONE, 'result': result, 'versions': versions,
+                          'error': None, 'computed_at': datetime.utcnow()}
+            db.session.execute(update(table).where(selected).values(**values))
+            db.session.commit()
+
+    # Ожидание всех задач этого процесса (тесты, команды CLI)
+    def wait_all(self, timeout=None):
+        with self._lock:
+            futures = list(self._futures.values())
+        wait(futures, timeout=timeout)
+
+
+report_jobs = ReportJobs()
@@ -0,0 +1,333 @@
+import heapq
+import logging
+import threading
+import weakref
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import DDL, DateTime, Integer, String, bindparam, event, func, literal, select
+
+from app.models import db
+from app.models.product import _CURRENT_SEQ, _NEXT_SEQ, Product
+
+logger = logging.getLogger('cosmeticshop.reservations')
+
+MAX_CART_ID_LENGTH = 64
+
+
+class ReservationError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+# Товар, отложенный в открытую корзину кассы. products.stock_quantity остается
+# остатком на складе: резерв его не меняет, а только уменьшает свободный остаток
+# (см. free_stock) до продажи или до expires_at. Списывает остаток сама продажа.
+class StockReservation(db.Model):
+    __tablename__ = "stock_reservations"
+    __table_args__ = (
+        db.Index('ix_stock_reservations_expires', 'expires_at'),
+        db.Index('ix_stock_reservations_product', 'product_id', 'expires_at'),
+    )
+
+    cart_id = db.Column(db.String(64), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    cashier_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+# Появление, снятие и изменение резерва меняет свободный остаток товара, поэтому
+# получает номер изменения каталога, как правка самого товара: кассы забирают его
+# дельтой /api/v1/catalog. Продление срока (UPDATE expires_at) номер не меняет.
+RESERVATION_SEQ_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS stock_reservations_seq_ai AFTER INSERT ON stock_reservations BEGIN
+        {_NEXT_SEQ}
+        UPDATE products SET change_seq = {_CURRENT_SEQ} WHERE id = new.product_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stock_reservations_seq_au AFTER UPDATE OF quantity ON stock_reservations BEGIN
+        {_NEXT_SEQ}
+        UPDATE products SET change_seq = {_CURRENT_SEQ} WHERE id = new.product_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS stock_reservations_seq_ad AFTER DELETE ON stock_reservations BEGIN
+        {_NEXT_SEQ}
+        UPDATE products SET change_seq = {_CURRENT_SEQ} WHERE id = old.product_id;
+    END""",
+]
+
+for statement in RESERVATION_SEQ_DDL:
+    event.listen(StockReservation.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+# Свободный остаток товара строки products: остаток на складе минус действующие
+# (не истекшие к now) резервы всех корзин. Для условий UPDATE и INSERT ... SELECT по products.
+def free_stock(now):
+    reservations = StockReservation.__table__
+    products = Product.__table__
+    held = select(func.coalesce(func.sum(reservations.c.quantity), 0)).where(
+        reservations.c.product_id == products.c.id, reservations.c.expires_at > now
+    ).scalar_subquery()
+    return products.c.stock_quantity - held
+
+
+def _cart_condition(cart_id, cashier_id):
+    reservations = StockReservation.__table__
+    return (reservations.c.cart_id == cart_id) & (reservations.c.cashier_id == cashier_id)
+
+
+class _Hold:
+    __slots__ = ('cashier_id', 'expires_at', 'items')
+
+    def __init__(self, cashier_id, expires_at, items):
+        self.cashier_id = cashier_id
+        self.expires_at = expires_at
+        self.items = items
+
+
+# Корзины одного приложения в памяти процесса и его фоновый поток
+class _AppHolds:
+    __slots__ = ('holds', 'expiry', 'lock', 'wakeup', 'sweeper')
+
+    def __init__(self):
+        self.holds = {}
+        self.expiry = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.sweeper = None
+
+
+# Резервы корзин. База - источник истины для всех процессов; в памяти процесса
+# лежат его корзины (cart_id -> срок и товары) и куча сроков, по которой фоновый поток
+# просыпается к ближайшему истечению. Корзины других процессов (и оставшиеся после
+# перезапуска) читаются из базы и снимаются проходом раз в RESERVATION_SWEEP_SECONDS.
+# У каждого приложения процесса (своя база) свои корзины в памяти и свой поток;
+# поток держит приложение по слабой ссылке и завершается вместе с ним.
+class ReservationService:
+    def __init__(self):
+        self._apps = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _state(self):
+        app = current_app._get_current_object()
+        with self._lock:
+            state = self._apps.get(app)
+            if state is None:
+                state = self._apps[app] = _AppHolds()
+        return state
+
+    # Заменяет резерв корзины на items [(product_id, quantity)] одной транзакцией.
+    # Тот же состав только продлевает срок (один UPDATE expires_at, товары и каталог
+    # не меняются). Иначе прежние строки удаляются, а новые вставляются INSERT ... SELECT
+    # при условии, что свободного остатка хватает. При нехватке бросает ReservationError,
+    # прежний резерв остается. Пустой items снимает резерв. Возвращает срок резерва.
+    def reserve(self, cart_id, cashier_id, items):
+        quantities = {}
+        for product_id, quantity in items:
+            if quantity <= 0:
+                raise ReservationError(["Количество должно быть больше нуля"])
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=current_app.config.get('RESERVATION_TTL', 300))
+        reservations = StockReservation.__table__
+        products = Product.__table__
+        condition = _cart_condition(cart_id, cashier_id)
+        renew = reservations.update().where(condition, reservations.c.expires_at > now).values(
+            expires_at=expires_at
+        ).returning(reservations.c.product_id, reservations.c.quantity)
+        # Свободный остаток считается после удаления прежних строк корзины,
+        # поэтому в нем только резервы других корзин
+        hold = reservations.insert().from_select(
+            ['cart_id', 'product_id', 'cashier_id', 'quantity', 'expires_at'],
+            select(literal(cart_id, String), products.c.id, literal(cashier_id, Integer),
+                   bindparam('hold_quantity', type_=Integer), literal(expires_at, DateTime)).where(
+                products.c.id == bindparam('hold_product_id'),
+                free_stock(now) >= bindparam('hold_quantity')
+            )
+        )
+
+        try:
+            connection = db.session.connection()
+            renewed = {row.product_id: row.quantity for row in connection.execute(renew)}
+            if renewed != quantities:
+                connection.execute(reservations.delete().where(condition))
+                if quantities:
+                    result = connection.execute(hold, [
+                        {'hold_product_id': product_id, 'hold_quantity': quantity}
+                        for product_id, quantity in quantities.items()
+                    ])
+                    if result.rowcount != len(quantities):
+                        raise ReservationError(self._shortages(cart_id, cashier_id, quantities))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        if quantities:
+            self._remember(cart_id, cashier_id, expires_at, quantities)
+            self._start_sweeper()
+        else:
+            self.forget(cart_id)
+        return expires_at
+
+    # Свободный остаток для этой корзины - остаток на складе минус резервы других корзин
+    def _shortages(self, cart_id, cashier_id, quantities):
+        db.session.rollback()
+        held = self.held(list(quantities), exclude=(cart_id, cashier_id))
+        products = {product.id: product
+                    for product in Product.query.filter(Product.id.in_(list(quantities))).all()}
+        errors = []
+        for product_id, quantity in quantities.items():
+            product = products.get(product_id)
+            if not product:
+                errors.append(f"Товар с ID {product_id} не найден")
+            elif product.stock_quantity - held.get(product_id, 0) < quantity:
+                errors.append(f"Недостаточно товара '{product.name}' на складе. "
+                              f"Доступно: {product.stock_quantity - held.get(product_id, 0)}")
+        # Остаток успели освободить между записью и проверкой
+        return errors or ["Остатки изменились на других кассах, повторите резерв"]
+
+    # Отложено действующими резервами {product_id: quantity} по товарам product_ids
+    # (None - по всем товарам); exclude - корзина (cart_id, cashier_id), чей резерв не учитывается
+    def held(self, product_ids=None, now=None, exclude=None):
+        if product_ids is not None and not product_ids:
+            return {}
+        query = db.session.query(StockReservation.product_id, func.sum(StockReservation.quantity)).filter(
+            StockReservation.expires_at > (now or datetime.utcnow())
+        )
+        if product_ids is not None:
+            query = query.filter(StockReservation.product_id.in_(product_ids))
+        if exclude is not None:
+            query = query.filter(~_cart_condition(*exclude))
+        return dict(query.group_by(StockReservation.product_id).all())
+
+    def release(self, cart_id, cashier_id):
+        try:
+            db.session.execute(StockReservation.__table__.delete().where(_cart_condition(cart_id, cashier_id)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.forget(cart_id)
+
+    # Действующий резерв корзины (expires_at, items {product_id: quantity}) или None:
+    # из памяти процесса, а если корзину резервировал другой процесс - из базы
+    def get(self, cart_id, cashier_id):
+        now = datetime.utcnow()
+        state = self._state()
+        with state.lock:
+            hold = state.holds.get(cart_id)
+        if hold is not None and hold.cashier_id == cashier_id and hold.expires_at > now:
+            return hold
+        rows = StockReservation.query.filter(
+            StockReservation.cart_id == cart_id,
+            StockReservation.cashier_id == cashier_id,
+            StockReservation.expires_at > now
+        ).all()
+        if not rows:
+            return None
+        expires_at = min(row.expires_at for row in rows)
+        quantities = {row.product_id: row.quantity for row in rows}
+        return self._remember(cart_id, cashier_id, expires_at, quantities)
+
+    # Забирает действующий резерв корзины в транзакции продажи (без коммита):
+    # удаляет строки и возвращает {product_id: quantity}. Остаток списывает продажа.
+    def claim(self, connection, cart_id, cashier_id, now):
+        reservations = StockReservation.__table__
+        rows = connection.execute(reservations.delete().where(
+            _cart_condition(cart_id, cashier_id), reservations.c.expires_at > now
+        ).returning(reservations.c.product_id, reservations.c.quantity)).all()
+        return {row.product_id: row.quantity for row in rows}
+
+    # Удаляет все истекшие резервы всех процессов разом; без истекших - один SELECT без записи.
+    # Остаток на складе не меняется: истекший резерв и так не уменьшает свободный остаток.
+    def release_expired(self, now=None):
+        now = now or datetime.utcnow()
+        reservations = StockReservation.__table__
+        expired = reservations.c.expires_at <= now
+        if db.session.execute(select(reservations.c.cart_id).where(expired).limit(1)).first() is None:
+            db.session.rollback()
+            released = 0
+        else:
+            try:
+                released = db.session.execute(reservations.delete().where(expired)).rowcount
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        state = self._state()
+        with state.lock:
+            for cart_id in [cart_id for cart_id, hold in state.holds.items() if hold.expires_at <= now]:
+                del state.holds[cart_id]
+        return released
+
+    def _remember(self, cart_id, cashier_id, expires_at, quantities):
+        hold = _Hold(cashier_id, expires_at, quantities)
+        state = self._state()
+        with state.lock:
+            state.holds[cart_id] = hold
+            heapq.heappush(state.expiry, (expires_at, cart_id))
+        state.wakeup.set()
+        return hold
+
+    def forget(self, cart_id):
+        state = self._state()
+        with state.lock:
+            state.holds.pop(cart_id, None)
+
+    # Поток один на приложение: снимает резервы в базе того приложения, которое его запустило
+    def _start_sweeper(self):
+        state = self._state()
+        if state.sweeper is None:
+            with state.lock:
+                if state.sweeper is None:
+                    app = weakref.ref(current_app._get_current_object())
+                    state.sweeper = threading.Thread(target=self._sweep, args=(app, state),
+                                                     name='reservation-sweeper', daemon=True)
+                    state.sweeper.start()
+
+    # Секунд до ближайшего истечения резерва приложения, но не больше interval.
+    # Записи кучи для снятых или продленных корзин пропускаются.
+    @staticmethod
+    def _next_sweep(state, interval):
+        with state.lock:
+            while state.expiry:
+                expires_at, cart_id = state.expiry[0]
+                hold = state.holds.get(cart_id)
+                if hold is not None and hold.expires_at == expires_at:
+                    delay = (expires_at - datetime.utcnow()).total_seconds()
+                    return min(max(delay, 0), interval)
+                heapq.heappop(state.expiry)
+        return interval
+
+    # Между проходами поток не держит приложение, чтобы оно могло быть удалено
+    def _sweep(self, app_ref, state):
+        while True:
+            app = app_ref()
+            if app is None:
+                return
+            interval = app.config.get('RESERVATION_SWEEP_SECONDS', 30)
+            del app
+            state.wakeup.wait(self._next_sweep(state, interval))
+            if state.wakeup.is_set():
+                # Добавлен резерв - пересчитать время ближайшего истечения
+                state.wakeup.clear()
+                continue
+            app = app_ref()
+            if app is None:
+                return
+            try:
+                with app.app_context():
+                    self.release_expired()
+            except Exception:
+                logger.exception("Не удалось снять истекшие резервы")
+            del app
+            # Истекшие записи кучи не даем обработать повторно
+            with state.lock:
+                now = datetime.utcnow()
+                while state.expiry and state.expiry[0][0] <= now:
+                    heapq.heappop(state.expiry)
+
+
+reservations = ReservationService()
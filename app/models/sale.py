@@ -1,9 +1,25 @@
 from app.models import db
 from datetime import datetime
+from sqlalchemy.orm import joinedload
+from app.models.cache import bump_version
+from app.models.pagination import keyset_page
+from app.models.receipt import Receipt
+from app.models.sales_rollup import SalesRollupRepo
+
+# Имя счетчика в cache_versions, который увеличивается при каждой новой продаже
+SALES_VERSION = 'sales'
 
 
 class Sale(db.Model):
     __tablename__ = "sales"
+    __table_args__ = (
+        db.Index('ix_sales_sale_date', 'sale_date'),
+        db.Index('ix_sales_cashier_date', 'cashier_id', 'sale_date'),
+        db.Index('ix_sales_date_product', 'sale_date', 'product_id'),
+        db.Index('ix_sales_product', 'product_id'),
+        db.Index('ix_sales_day_date', 'sale_day', 'sale_date'),
+        db.Index('ix_sales_receipt', 'receipt_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
@@ -11,6 +27,10 @@ class Sale(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Numeric(10, 2), nullable=False)
     sale_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # День продажи хранится отдельно для быстрых выборок за день
+    sale_day = db.Column(db.Date, nullable=False)
+    # Чек, в который входит строка (app.models.receipt.Receipt)
+    receipt_id = db.Column(db.Integer, db.ForeignKey('receipts.id'))
 
     def __init__(self, product_id, cashier_id, quantity, total_price):
         self.product_id = product_id
@@ -18,6 +38,7 @@ class Sale(db.Model):
         self.quantity = quantity
         self.total_price = total_price
         self.sale_date = datetime.utcnow()
+        self.sale_day = self.sale_date.date()
 
     def to_dict(self):
         return {
@@ -26,14 +47,29 @@ class Sale(db.Model):
             'cashier_id': self.cashier_id,
             'quantity': self.quantity,
             'total_price': float(self.total_price),
-            'sale_date': self.sale_date.isoformat()
+            'sale_date': self.sale_date.isoformat(),
+            'receipt_id': self.receipt_id,
         }
 
 
 class SaleRepo:
+    def __init__(self):
+        self.rollup = SalesRollupRepo()
+
+    # Одиночная продажа оформляется отдельным чеком из одной строки
     def add(self, product_id, cashier_id, quantity, total_price):
         sale = Sale(product_id, cashier_id, quantity, total_price)
+        sale.receipt = Receipt(cashier_id=cashier_id, created_at=sale.sale_date, receipt_day=sale.sale_day,
+                               total=total_price, line_count=1, item_count=quantity)
         db.session.add(sale)
+        self.rollup.apply([{
+            'sale_day': sale.sale_day,
+            'product_id': product_id,
+            'cashier_id': cashier_id,
+            'quantity': quantity,
+            'total_price': total_price,
+        }])
+        bump_version(SALES_VERSION)
         db.session.commit()
         return sale
 
@@ -49,13 +85,52 @@ class SaleRepo:
     def get_by_product(self, product_id):
         return Sale.query.filter_by(product_id=product_id).all()
 
+    # Продажи вместе с товаром и кассиром одним запросом (без N+1)
+    def _with_details(self):
+        return Sale.query.options(joinedload(Sale.product), joinedload(Sale.cashier))
+
+    def all_with_details(self):
+        return self._with_details().order_by(Sale.sale_date.desc()).all()
+
+    def get_by_cashier_with_details(self, cashier_id):
+        return self._with_details().filter(Sale.cashier_id == cashier_id).order_by(Sale.sale_date.desc()).all()
+
+    # Постраничная выборка по ключу (sale_date, id), новые продажи первыми
+    def page_with_details(self, cashier_id=None, after=None, before=None, limit=50):
+        query = self._with_details()
+        if cashier_id is not None:
+            query = query.filter(Sale.cashier_id == cashier_id)
+        return keyset_page(query, [Sale.sale_date, Sale.id], lambda sale: (sale.sale_date, sale.id),
+                           limit, after, before, descending=True)
+
+    # Выборка для выгрузки: строки читаются пачками по batch_size, а не списком целиком
+    def iter_for_export(self, start_date=None, end_date=None, cashier_id=None, product_id=None, batch_size=1000):
+        query = Sale.query
+        if start_date:
+            query = query.filter(Sale.sale_date >= start_date)
+        if end_date:
+            query = query.filter(Sale.sale_date < end_date)
+        if cashier_id:
+            query = query.filter(Sale.cashier_id == cashier_id)
+        if product_id:
+            query = query.filter(Sale.product_id == product_id)
+        return query.order_by(Sale.sale_date, Sale.id).yield_per(batch_size)
+
+    def get_by_day_with_details(self, day):
+        return self._with_details().filter(Sale.sale_day == day).order_by(Sale.sale_date.desc()).all()
+
+    def get_by_date_range_with_details(self, start_date, end_date):
+        return self._with_details().filter(
+            Sale.sale_date >= start_date,
+            Sale.sale_date <= end_date
+        ).order_by(Sale.sale_date.desc()).all()
+
+    # Итоги для статистики берутся из сводки daily_sales
     def get_total_revenue(self):
-        from sqlalchemy import func
-        result = db.session.query(func.sum(Sale.total_price)).scalar()
-        return float(result) if result else 0.0
+        return self.rollup.get_total_revenue()
 
     def get_total_sales_count(self):
-        return Sale.query.count()
+        return self.rollup.get_total_sales_count()
 
     def get_revenue_by_date_range(self, start_date, end_date):
         from sqlalchemy import func
@@ -66,14 +141,4 @@ class SaleRepo:
         return float(result) if result else 0.0
 
     def get_top_products(self, limit=10):
-        from sqlalchemy import func
-        from app.models.product import Product
-        results = db.session.query(
-            Product.name,
-            func.sum(Sale.quantity).label('total_quantity'),
-            func.sum(Sale.total_price).label('total_revenue')
-        ).join(Sale).group_by(Product.id, Product.name).order_by(
-            func.sum(Sale.total_price).desc()
-        ).limit(limit).all()
-        return results
-
+        return self.rollup.get_top_products(limit)
@@ -0,0 +1,99 @@
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.models import db
+
+REBUILD_SQL = (
+    'INSERT INTO daily_sales (day, product_id, cashier_id, quantity, revenue, line_count) '
+    'SELECT sale_day, product_id, cashier_id, SUM(quantity), SUM(total_price), COUNT(*) '
+    'FROM sales GROUP BY sale_day, product_id, cashier_id'
+)
+
+
+# Сводка продаж по дням: одна строка на (день, товар, кассир).
+# Обновляется в той же транзакции, что и продажа, поэтому статистика
+# и отчет за день не пересчитывают всю таблицу sales.
+class DailySales(db.Model):
+    __tablename__ = "daily_sales"
+
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    cashier_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    line_count = db.Column(db.Integer, nullable=False, default=0)
+
+    product = db.relationship('Product', lazy='joined')
+    cashier = db.relationship('User', lazy='joined')
+
+
+class SalesRollupRepo:
+    # lines - словари со значениями sale_day, product_id, cashier_id, quantity, total_price
+    def apply(self, lines, connection=None):
+        totals = {}
+        for line in lines:
+            key = (line['sale_day'], line['product_id'], line['cashier_id'])
+            row = totals.setdefault(key, {'quantity': 0, 'revenue': 0, 'line_count': 0})
+            row['quantity'] += line['quantity']
+            row['revenue'] += line['total_price']
+            row['line_count'] += 1
+        if not totals:
+            return
+
+        table = DailySales.__table__
+        statement = sqlite_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.day, table.c.product_id, table.c.cashier_id],
+            set_={
+                'quantity': table.c.quantity + statement.excluded.quantity,
+                'revenue': table.c.revenue + statement.excluded.revenue,
+                'line_count': table.c.line_count + statement.excluded.line_count,
+            }
+        )
+        rows = [
+            {'day': day, 'product_id': product_id, 'cashier_id': cashier_id, **values}
+            for (day, product_id, cashier_id), values in totals.items()
+        ]
+        (connection or db.session.connection()).execute(statement, rows)
+
+    # Полный пересчет сводки из истории продаж одним INSERT ... SELECT
+    def rebuild(self):
+        db.session.execute(text('DELETE FROM daily_sales'))
+        db.session.execute(text(REBUILD_SQL))
+        db.session.commit()
+        return DailySales.query.count()
+
+    def get_total_revenue(self):
+        result = db.session.query(func.sum(DailySales.revenue)).scalar()
+        return float(result) if result else 0.0
+
+    def get_total_sales_count(self):
+        result = db.session.query(func.sum(DailySales.line_count)).scalar()
+        return int(result) if result else 0
+
+    def get_day_totals(self, day):
+        revenue, count = db.session.query(
+            func.sum(DailySales.revenue),
+            func.sum(DailySales.line_count)
+        ).filter(DailySales.day == day).one()
+        return (float(revenue) if revenue else 0.0), (int(count) if count else 0)
+
+    def get_revenue_by_days(self, start_day, end_day):
+        result = db.session.query(func.sum(DailySales.revenue)).filter(
+            DailySales.day >= start_day,
+            DailySales.day <= end_day
+        ).scalar()
+        return float(result) if result else 0.0
+
+    def get_by_day(self, day):
+        return DailySales.query.filter(DailySales.day == day).order_by(DailySales.revenue.desc()).all()
+
+    def get_top_products(self, limit=10):
+        from app.models.product import Product
+        return db.session.query(
+            Product.name,
+            func.sum(DailySales.quantity).label('total_quantity'),
+            func.sum(DailySales.revenue).label('total_revenue')
+        ).join(DailySales, DailySales.product_id == Product.id).group_by(Product.id, Product.name).order_by(
+            func.sum(DailySales.revenue).desc()
+        ).limit(limit).all()
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+def password_hash_method():
+    return current_app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+
+# Префикс хэша с полными параметрами ("scrypt:32768:8:1", "pbkdf2:sha256:600000"),
+# который дает настроенный метод; вычисляется один раз на метод
+@lru_cache(maxsize=8)
+def _hash_prefix(method):
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash, method):
+    return password_hash.split('$', 1)[0] != _hash_prefix(method)
+
+
+# Проверка пароля и, если параметры хэша устарели, новый хэш - выполняется в пуле потоков
+def _verify(password_hash, password, method):
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if needs_rehash(password_hash, method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=current_app.config.get('LOGIN_HASH_WORKERS', 4),
+                    thread_name_prefix='password-hash'
+                )
+    return _executor
+
+
+# Ограниченный пул: одновременно считается не больше LOGIN_HASH_WORKERS хэшей,
+# остальные входы ждут в очереди, а не забирают процессор у касс.
+# Возвращает (пароль верен, новый хэш или None); TimeoutError - пул перегружен.
+# Не дождавшаяся очереди проверка отменяется, чтобы пул не считал хэш для ушедшего входа.
+def verify_password(password_hash, password):
+    future = _get_executor().submit(_verify, password_hash, password, password_hash_method())
+    try:
+        return future.result(timeout=current_app.config.get('LOGIN_HASH_TIMEOUT', 10))
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+# Ограничение неудачных попыток входа по имени пользователя: после LOGIN_MAX_ATTEMPTS
+# ошибок за LOGIN_ATTEMPT_WINDOW секунд пароль не проверяется до конца окна
+class LoginThrottle:
+    MAX_TRACKED = 10000
+
+    def __init__(self):
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def _settings(self):
+        config = current_app.config
+        return config.get('LOGIN_MAX_ATTEMPTS', 5), config.get('LOGIN_ATTEMPT_WINDOW', 300)
+
+    def is_blocked(self, username):
+        limit, window = self._settings()
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get(username)
+            if not failures:
+                return False
+            while failures and failures[0] <= now - window:
+                failures.popleft()
+            if not failures:
+                del self._failures[username]
+                return False
+            return len(failures) >= limit
+
+    def record_failure(self, username):
+        limit, window = self._settings()
+        now = time.monotonic()
+        with self._lock:
+            if len(self._failures) >= self.MAX_TRACKED:
+                self._prune(now - window)
+            failures = self._failures.setdefault(username, deque(maxlen=limit))
+            failures.append(now)
+
+    def reset(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
+
+    def _prune(self, cutoff):
+        for username in [name for name, failures in self._failures.items() if failures[-1] <= cutoff]:
+            del self._failures[username]
+
+
+login_throttle = LoginThrottle()
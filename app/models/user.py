@@ -1,6 +1,8 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.models import db
+from app.models.cache import user_cache
+from app.models.security import password_hash_method
 
 ROLE_CASHIER = 'cashier'
 ROLE_DIRECTOR = 'director'
@@ -19,7 +21,7 @@ class User(db.Model, UserMixin):
     sales = db.relationship('Sale', backref='cashier', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=password_hash_method())
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -30,6 +32,11 @@ class User(db.Model, UserMixin):
     def is_cashier(self):
         return self.role == ROLE_CASHIER
 
+    # Копия вне сессии для кэша: ее можно читать в любом запросе и потоке
+    def detached_copy(self):
+        return User(id=self.id, username=self.username, password_hash=self.password_hash,
+                    role=self.role, full_name=self.full_name, created_at=self.created_at)
+
     def __repr__(self):
         return f'<User {self.username} ({self.role})>'
 
@@ -41,6 +48,16 @@ class UserRepo:
     def get_by_id(self, user_id):
         return User.query.get(user_id)
 
+    # Сохраняет хэш, пересчитанный с текущими параметрами при входе
+    def set_password_hash(self, user, password_hash):
+        user.password_hash = password_hash
+        user_cache.invalidate(user.id)
+        db.session.commit()
+
+    # Пользователь для Flask-Login: из кэша процесса, пока не изменился счетчик пользователей
+    def get_identity(self, user_id):
+        return user_cache.get(user_id, lambda: self.get_by_id(user_id))
+
     def add(self, username, password, role=ROLE_CASHIER, full_name=None):
         user = User(username=username, role=role, full_name=full_name)
         user.set_password(password)
@@ -63,6 +80,7 @@ class UserRepo:
             user.role = role
         if full_name is not None:
             user.full_name = full_name
+        user_cache.invalidate(user_id)
         db.session.commit()
         return user
 
@@ -70,6 +88,7 @@ class UserRepo:
         user = self.get_by_id(user_id)
         if user:
             db.session.delete(user)
+            user_cache.invalidate(user_id)
             db.session.commit()
             return True
         return False
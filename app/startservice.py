@@ -1,52 +1,132 @@
+from collections.abc import Mapping
+
+import click
 from flask import Flask, render_template
+from flask.cli import with_appcontext
 from flask_login import LoginManager
-from app.controllers.products_controller import bp as products_bp
-from app.controllers.sales_controller import bp as sales_bp
-from app.controllers.users_controller import bp as users_bp
-from app.controllers.auth_controller import bp as auth_bp
+from app.config import Config
 from app.models import db
-from app.models.user import User, UserRepo, ROLE_DIRECTOR, ROLE_CASHIER
-from app.models.product import Product
-from app.models.sale import Sale
-
-app = Flask(__name__, template_folder="views", static_folder="static")
-app.secret_key = "replace-this-with-a-secure-random-key-in-production"
-
-import os
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(basedir, "cosmeticshop.db")}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db.init_app(app)
+from app.models.engine import engine_options, init_engine
+from app.models.migrations import run_migrations
+from app.models.metrics import init_metrics
+from app.models.query_stats import init_query_stats
+from app.models.user import UserRepo, ROLE_DIRECTOR, ROLE_CASHIER
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Пожалуйста, войдите в систему для доступа к этой странице.'
 login_manager.login_message_category = 'info'
+# API отвечает 401 вместо перенаправления на страницу входа
+login_manager.blueprint_login_views['api'] = None
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return UserRepo().get_identity(int(user_id))
+
+
+# Создает приложение; config - словарь или объект с настройками поверх Config.
+# Импорт модуля и вызов фабрики не обращаются к базе: схема и начальные пользователи
+# создаются командами init-db и seed-users (или при запуске этого файла напрямую).
+def create_app(config=None):
+    app = Flask(__name__, template_folder="views", static_folder="static")
+    app.config.from_object(Config)
+    if isinstance(config, Mapping):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    db.init_app(app)
+    init_engine(app)
+    init_query_stats(app)
+    init_metrics(app)
+    login_manager.init_app(app)
+
+    _register_blueprints(app)
+    app.add_url_rule("/", "index", index)
+    for command in (init_db_command, seed_users_command, import_products, rebuild_rollup):
+        app.cli.add_command(command)
+    return app
+
+
+# Контроллеры (и все модели за ними) импортируются только при создании приложения
+def _register_blueprints(app):
+    from app.controllers.products_controller import bp as products_bp
+    from app.controllers.sales_controller import bp as sales_bp
+    from app.controllers.users_controller import bp as users_bp
+    from app.controllers.auth_controller import bp as auth_bp
+    from app.controllers.api_controller import bp as api_bp
+    from app.controllers.metrics_controller import bp as metrics_bp
+
+    for blueprint in (products_bp, sales_bp, users_bp, auth_bp, api_bp, metrics_bp):
+        app.register_blueprint(blueprint)
 
-app.register_blueprint(products_bp)
-app.register_blueprint(sales_bp)
-app.register_blueprint(users_bp)
-app.register_blueprint(auth_bp)
 
-@app.get("/")
 def index():
     return render_template("index.html")
 
-with app.app_context():
+
+# Таблицы и недостающие миграции; возвращает список примененных миграций
+def init_db():
     db.create_all()
+    return run_migrations()
 
+
+# Начальные пользователи: директор '1' и кассир '2'; возвращает созданных
+def seed_users():
     repo = UserRepo()
+    created = []
     if not repo.get_by_username('1'):
-        repo.add('1', '1', ROLE_DIRECTOR, 'Админ')
-    
+        created.append(repo.add('1', '1', ROLE_DIRECTOR, 'Админ'))
     if not repo.get_by_username('2'):
-        repo.add('2', '2', ROLE_CASHIER, 'Продавец')
+        created.append(repo.add('2', '2', ROLE_CASHIER, 'Продавец'))
+    return created
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    applied = init_db()
+    for version, description in applied:
+        click.echo(f"Миграция {version}: {description}")
+    click.echo(f"Схема базы готова, применено миграций: {len(applied)}")
+
+
+@click.command("seed-users")
+@with_appcontext
+def seed_users_command():
+    created = seed_users()
+    click.echo(f"Добавлено пользователей: {len(created)}")
+
+
+@click.command("import-products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--encoding", default="utf-8-sig", help="Кодировка файла (utf-8-sig, cp1251)")
+@click.option("--batch-size", default=1000, help="Строк в одной транзакции")
+@with_appcontext
+def import_products(path, encoding, batch_size):
+    from app.models.product_import import ProductImporter
+
+    with open(path, encoding=encoding, newline="") as stream:
+        result = ProductImporter(batch_size=batch_size).import_csv(stream)
+    for line, message in result.errors:
+        click.echo(f"Строка {line}: {message}")
+    click.echo(f"Добавлено: {result.created}, обновлено: {result.updated}, ошибок: {result.error_count}")
+
+
+@click.command("rebuild-rollup")
+@with_appcontext
+def rebuild_rollup():
+    from app.models.sales_rollup import SalesRollupRepo
+
+    rows = SalesRollupRepo().rebuild()
+    click.echo(f"Сводка продаж пересчитана: {rows} строк")
+
 
 if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        init_db()
+        seed_users()
     app.run(debug=True, port=5001)
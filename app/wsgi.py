@@ -0,0 +1,7 @@
+# Точка входа WSGI-сервера: gunicorn "app.wsgi:app".
+# Импорт только создает приложение и не обращается к базе, поэтому с --preload
+# рабочие процессы стартуют из готового мастера. Схема и пользователи создаются заранее:
+# flask --app app.wsgi init-db && flask --app app.wsgi seed-users
+from app.startservice import create_app
+
+app = create_app()
@@ -0,0 +1,84 @@
+# Нагрузочный тест входа: N кассиров одновременно входят через /auth/login.
+# Запуск из корня проекта:
+#   python -m benchmarks.bench_login --users 50 --threads 16 --seconds 10
+import argparse
+import os
+import threading
+import time
+
+from benchmarks.common import run_info, summarize, use_database, write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность /auth/login")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--hash-method", default=None,
+                        help="PASSWORD_HASH_METHOD, например scrypt или pbkdf2:sha256:600000")
+    parser.add_argument("--output", default=None, help="Файл для JSON (по умолчанию - stdout)")
+    args = parser.parse_args()
+
+    use_database(prefix="bench-login-")
+    if args.hash_method:
+        os.environ["COSMETICSHOP_PASSWORD_HASH_METHOD"] = args.hash_method
+    os.environ.setdefault("COSMETICSHOP_LOGIN_MAX_ATTEMPTS", "1000000")
+
+    from app.startservice import create_app, init_db
+    from app.models.user import UserRepo, ROLE_CASHIER
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        repo = UserRepo()
+        for i in range(args.users):
+            repo.add(f"bench{i}", f"password{i}", ROLE_CASHIER)
+
+    counts = [0] * args.threads
+    failures = [0] * args.threads
+    latencies = [[] for _ in range(args.threads)]
+    deadline = time.perf_counter() + args.seconds
+
+    def worker(index):
+        client = app.test_client()
+        i = index
+        while time.perf_counter() < deadline:
+            user = i % args.users
+            started = time.perf_counter()
+            response = client.post("/auth/login", data={
+                "username": f"bench{user}",
+                "password": f"password{user}",
+            })
+            latencies[index].append(time.perf_counter() - started)
+            if response.status_code == 302 and "/products/" in response.headers.get("Location", ""):
+                counts[index] += 1
+            else:
+                failures[index] += 1
+            client.get("/auth/logout")
+            i += args.threads
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "benchmark": "auth.login",
+        **run_info(),
+        "hash_method": app.config["PASSWORD_HASH_METHOD"],
+        "hash_workers": app.config["LOGIN_HASH_WORKERS"],
+        "threads": args.threads,
+        "seconds": round(elapsed, 3),
+        "logins": sum(counts),
+        "failures": sum(failures),
+        "logins_per_second": round(sum(counts) / elapsed, 2),
+        "latency": summarize([sample for samples in latencies for sample in samples]),
+    }
+    write_json(result, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Замеры страниц и методов репозиториев на синтетических данных магазина.
+# Для каждого замера - p50/p95/p99 в миллисекундах; результат пишется в JSON,
+# который можно сравнить с запуском на другом коммите (--baseline).
+# Запуск из корня проекта:
+#   python -m benchmarks.datagen --database bench.db --sales 1000000
+#   python -m benchmarks.bench_routes --database bench.db --output results.json
+# Без --database данные генерируются во временную базу по параметрам datagen.
+import argparse
+import json
+
+from benchmarks import datagen
+from benchmarks.common import measure, run_info, use_database, write_json
+
+BENCH_PASSWORD = "bench-password"
+STOCK_FOR_CARTS = 10 ** 9
+
+
+def _login(app, username):
+    client = app.test_client()
+    response = client.post("/auth/login", data={"username": username, "password": BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise SystemExit(f"не удалось войти как {username}")
+    return client
+
+
+def _get(client, url):
+    def request():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: {response.status_code}")
+    return request
+
+
+def _post_cart(client, product_ids):
+    data = {"product_ids": product_ids, "quantities": ["1"] * len(product_ids), "confirmed": "on"}
+
+    def request():
+        response = client.post("/sales/create", data=data)
+        if response.status_code != 302 or not response.headers["Location"].endswith("/sales/"):
+            raise RuntimeError(f"продажа не оформлена: {response.status_code} {response.headers.get('Location')}")
+    return request
+
+
+def _in_context(app, fn):
+    def call():
+        with app.app_context():
+            fn()
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры страниц и запросов на больших данных")
+    parser.add_argument("--database", default=None, help="Файл базы (по умолчанию - временный с новыми данными)")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--cart-sizes", default="1,5,20", help="Число строк в чеке для create_sale")
+    parser.add_argument("--search", default="крем", help="Строка поиска товаров")
+    parser.add_argument("--output", default=None, help="Файл для JSON (по умолчанию - stdout)")
+    parser.add_argument("--baseline", default=None, help="JSON предыдущего запуска для сравнения p50")
+    datagen.add_arguments(parser)
+    args = parser.parse_args()
+    cart_sizes = [int(size) for size in args.cart_sizes.split(",")]
+
+    path = use_database(args.database, prefix="bench-routes-")
+    from app.startservice import create_app, init_db
+    from app.models import db
+    from app.models.checkout import CheckoutService
+    from app.models.product import Product, ProductRepo
+    from app.models.sale import Sale, SaleRepo
+    from app.models.sales_rollup import SalesRollupRepo
+    from app.models.user import UserRepo, ROLE_CASHIER, ROLE_DIRECTOR
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        dataset = None
+        if not Product.query.first():
+            dataset = datagen.generate(args.products, args.cashiers, args.sales, args.days, args.seed)
+        users = UserRepo()
+        if not users.get_by_username("bench_director"):
+            users.add("bench_director", BENCH_PASSWORD, ROLE_DIRECTOR)
+        cashier = users.get_by_username("bench_cashier") or users.add("bench_cashier", BENCH_PASSWORD, ROLE_CASHIER)
+        cashier_id = cashier.id
+
+        # Для чеков берутся товары с самым большим остатком, остаток поднимается,
+        # чтобы все итерации продаж прошли успешно
+        cart_products = [product_id for product_id, in db.session.query(Product.id)
+                         .order_by(Product.stock_quantity.desc(), Product.id).limit(max(cart_sizes))]
+        Product.query.filter(Product.id.in_(cart_products)).update(
+            {Product.stock_quantity: STOCK_FOR_CARTS}, synchronize_session=False)
+        db.session.commit()
+
+        latest_sale = Sale.query.order_by(Sale.sale_date.desc()).first()
+        report_day = latest_sale.sale_day.isoformat() if latest_sale else None
+        second_page = SaleRepo().page_with_details(limit=50).next_cursor
+        dataset = dataset or {
+            "products": Product.query.count(),
+            "sales": Sale.query.count(),
+        }
+
+    director = _login(app, "bench_director")
+    cashier_client = _login(app, "bench_cashier")
+    sale_repo = SaleRepo()
+    product_repo = ProductRepo()
+    rollup_repo = SalesRollupRepo()
+    checkout_service = CheckoutService()
+
+    benchmarks = [
+        ("route", "sales.list_sales", _get(director, "/sales/")),
+        ("route", "sales.list_sales (page 2)", _get(director, f"/sales/?after={second_page}")),
+        ("route", "sales.my_sales", _get(cashier_client, "/sales/my_sales")),
+        ("route", "sales.daily_report", _get(director, f"/sales/daily_report?date={report_day}")),
+        ("route", "sales.statistics", _get(director, "/sales/statistics")),
+        ("route", "products.list_products", _get(director, "/products/")),
+        ("route", "products.list_products (search)", _get(director, f"/products/?search={args.search}")),
+        ("route", "api.catalog_changes (full)", _get(cashier_client, "/api/v1/catalog")),
+    ]
+    for size in cart_sizes:
+        benchmarks.append(("route", f"sales.create_sale ({size} lines)",
+                           _post_cart(cashier_client, cart_products[:size])))
+    benchmarks += [
+        ("repo", "SaleRepo.page_with_details", _in_context(app, lambda: sale_repo.page_with_details(limit=50))),
+        ("repo", "SalesRollupRepo.get_by_day", _in_context(app, lambda: rollup_repo.get_by_day(latest_sale.sale_day))),
+        ("repo", "SalesRollupRepo.get_top_products", _in_context(app, rollup_repo.get_top_products)),
+        ("repo", "ProductRepo.search", _in_context(app, lambda: product_repo.search(args.search))),
+        ("repo", "ProductRepo.get_changes(0)", _in_context(app, lambda: product_repo.get_changes(0))),
+    ]
+    for size in cart_sizes:
+        items = [(product_id, 1) for product_id in cart_products[:size]]
+        benchmarks.append(("repo", f"CheckoutService.checkout ({size} lines)",
+                           _in_context(app, lambda items=items: checkout_service.checkout(cashier_id, items))))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as stream:
+            baseline = {item["name"]: item for item in json.load(stream)["results"]}
+
+    results = []
+    for kind, name, fn in benchmarks:
+        result = {"kind": kind, "name": name, **measure(fn, args.iterations, args.warmup)}
+        previous = baseline.get(name)
+        if previous and previous.get("p50_ms"):
+            result["baseline_p50_ms"] = previous["p50_ms"]
+            result["p50_change_pct"] = round((result["p50_ms"] / previous["p50_ms"] - 1) * 100, 1)
+        results.append(result)
+
+    write_json({
+        "benchmark": "routes",
+        **run_info(),
+        "database": path,
+        "dataset": dataset,
+        "iterations": args.iterations,
+        "results": results,
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Общие части нагрузочных тестов: временная база, замер времени, перцентили, вывод JSON.
+# Модуль не импортирует приложение: адрес базы нужно задать до импорта app.startservice.
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+# База для замеров: переданный путь или новый файл во временном каталоге.
+# Рабочая cosmeticshop.db не трогается.
+def use_database(path=None, prefix="bench-"):
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(prefix=prefix), "bench.db")
+    os.environ["COSMETICSHOP_DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    return path
+
+
+# Перцентиль по рангу: значение, не меньше которого p% замеров
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    index = max(math.ceil(p / 100 * len(sorted_samples)) - 1, 0)
+    return sorted_samples[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "count": len(ordered),
+        "min_ms": to_ms(ordered[0] if ordered else None),
+        "mean_ms": to_ms(sum(ordered) / len(ordered) if ordered else None),
+        "p50_ms": to_ms(percentile(ordered, 50)),
+        "p95_ms": to_ms(percentile(ordered, 95)),
+        "p99_ms": to_ms(percentile(ordered, 99)),
+        "max_ms": to_ms(ordered[-1] if ordered else None),
+    }
+
+
+# Вызывает fn warmup раз без замера, затем iterations раз с замером каждого вызова
+def measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Сведения о запуске, по которым результаты сравниваются между коммитами
+def run_info():
+    return {
+        "revision": git_revision(),
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def write_json(result, output=None):
+    if output:
+        with open(output, "w", encoding="utf-8") as stream:
+            json.dump(result, stream, ensure_ascii=False, indent=2)
+    else:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
@@ -0,0 +1,208 @@
+# Генератор синтетических данных магазина: каталог, кассиры и история продаж.
+# Одинаковый seed дает одинаковые данные, поэтому замеры разных коммитов сравнимы.
+# Запуск из корня проекта (база создается, если ее нет, и должна быть пустой):
+#   python -m benchmarks.datagen --database bench.db --products 5000 --sales 1000000
+import argparse
+import math
+import random
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from benchmarks.common import use_database, write_json
+
+CATEGORIES = {
+    'Крем': ['Крем для лица', 'Крем для рук', 'Крем для тела', 'Крем вокруг глаз'],
+    'Шампунь': ['Шампунь', 'Сухой шампунь', 'Шампунь-кондиционер'],
+    'Бальзам': ['Бальзам для волос', 'Маска для волос', 'Кондиционер'],
+    'Тушь': ['Тушь для ресниц', 'Тушь объемная', 'Тушь водостойкая'],
+    'Помада': ['Помада', 'Блеск для губ', 'Бальзам для губ'],
+    'Пудра': ['Пудра компактная', 'Пудра рассыпчатая', 'Румяна'],
+    'Тональные средства': ['Тональный крем', 'BB-крем', 'Консилер'],
+    'Парфюмерия': ['Туалетная вода', 'Парфюмерная вода', 'Дезодорант'],
+    'Уход за телом': ['Гель для душа', 'Скраб для тела', 'Лосьон для тела'],
+    'Маникюр': ['Лак для ногтей', 'Жидкость для снятия лака', 'Масло для кутикулы'],
+}
+BRANDS = ['Нежность', 'Белита', 'Мирра', 'Лилия', 'Aurora', 'Velvet', 'Solaris', 'Natura',
+          'Grace', 'Ландыш', 'Camellia', 'Iris', 'Бархат', 'Luna', 'Сияние', 'Orchid']
+VARIANTS = ['увлажняющий', 'питательный', 'матирующий', 'с гиалуроновой кислотой', 'с алоэ',
+            'для чувствительной кожи', 'ночной', 'дневной', 'SPF 30', 'с маслом арганы',
+            'ромашка', 'роза', 'зеленый чай', 'кокос', 'ваниль', 'без отдушек']
+PACKAGES = ['15 мл', '30 мл', '50 мл', '100 мл', '150 мл', '250 мл', '400 мл', '10 г', '30 г']
+
+# Размер чека: доля чеков с 1, 2, ... строками
+CART_SIZE_WEIGHTS = [50, 25, 12, 7, 4, 2]
+# Покупатели по часам работы магазина (9:00-21:00), пик вечером
+HOUR_WEIGHTS = {9: 2, 10: 4, 11: 5, 12: 7, 13: 8, 14: 6, 15: 6, 16: 7, 17: 9, 18: 11, 19: 10, 20: 6}
+# Понедельник ... воскресенье
+WEEKDAY_WEIGHTS = [0.85, 0.85, 0.9, 0.95, 1.15, 1.3, 1.0]
+
+
+def _money(value):
+    return Decimal(value).quantize(Decimal('0.01'))
+
+
+def _products(rng, count):
+    rows = []
+    for i in range(count):
+        category = rng.choice(list(CATEGORIES))
+        kind = rng.choice(CATEGORIES[category])
+        price = _money(max(round(rng.lognormvariate(math.log(450), 0.7), -1), 49))
+        discount = _money(price * Decimal(rng.choice([70, 75, 80, 85, 90])) / 100) if rng.random() < 0.15 else None
+        rows.append({
+            'name': f"{kind} {rng.choice(BRANDS)} {rng.choice(VARIANTS)}",
+            'article': f"SYN-{i + 1:07d}",
+            'package': rng.choice(PACKAGES),
+            'category': category,
+            'price': price,
+            'discount_price': discount,
+            'stock_quantity': 0 if rng.random() < 0.05 else rng.randint(1, 300),
+            'description': f"{kind} от {rng.choice(BRANDS)}",
+        })
+    return rows
+
+
+# Продажи по дням за период days, заканчивающийся end_day. Строки одного чека
+# имеют одно время; популярность товаров распределена по Ципфу.
+def _sales(rng, product_prices, cashier_ids, count, days, end_day):
+    product_ids = list(product_prices)
+    rng.shuffle(product_ids)
+    popularity = [1 / (rank + 1) for rank in range(len(product_ids))]
+    cum_popularity = list(_accumulate(popularity))
+    hours = list(HOUR_WEIGHTS)
+    hour_weights = list(HOUR_WEIGHTS.values())
+    sizes = list(range(1, len(CART_SIZE_WEIGHTS) + 1))
+
+    first_day = end_day - timedelta(days=days - 1)
+    day_weights = [WEEKDAY_WEIGHTS[(first_day + timedelta(days=n)).weekday()] for n in range(days)]
+    per_day = Counter(rng.choices(range(days), weights=day_weights, k=count))
+
+    for n in range(days):
+        day = first_day + timedelta(days=n)
+        remaining = per_day.get(n, 0)
+        receipts = []
+        while remaining > 0:
+            size = min(rng.choices(sizes, weights=CART_SIZE_WEIGHTS)[0], remaining)
+            remaining -= size
+            moment = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=rng.choices(hours, weights=hour_weights)[0],
+                seconds=rng.randrange(3600), microseconds=rng.randrange(1000000))
+            receipts.append((moment, rng.choice(cashier_ids), size))
+        receipts.sort()
+        for moment, cashier_id, size in receipts:
+            for product_id in set(rng.choices(product_ids, cum_weights=cum_popularity, k=size)):
+                quantity = rng.choices([1, 2, 3], weights=[80, 15, 5])[0]
+                yield {
+                    'product_id': product_id,
+                    'cashier_id': cashier_id,
+                    'quantity': quantity,
+                    'total_price': product_prices[product_id] * quantity,
+                    'sale_date': moment,
+                    'sale_day': day,
+                }
+
+
+def _accumulate(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+# Заполняет текущую базу (нужен контекст приложения). Возвращает число созданных строк.
+def generate(products=2000, cashiers=20, sales=100000, days=365, seed=42, end_day=None, batch_size=10000):
+    from sqlalchemy import text
+    from werkzeug.security import generate_password_hash
+    from app.models import db
+    from app.models.cache import bump_version, catalog_cache, categories_cache
+    from app.models.product import Product
+    from app.models.receipt import BACKFILL_LINKS_SQL, BACKFILL_SQL
+    from app.models.sale import Sale, SALES_VERSION
+    from app.models.sales_rollup import SalesRollupRepo
+    from app.models.security import password_hash_method
+    from app.models.user import User, ROLE_CASHIER
+
+    rng = random.Random(seed)
+    end_day = end_day or date.today()
+    connection = db.session.connection()
+
+    connection.execute(Product.__table__.insert(), _products(rng, products))
+    # Все сгенерированные кассиры входят с паролем "password": хэш считается один раз
+    password_hash = generate_password_hash('password', method=password_hash_method())
+    connection.execute(User.__table__.insert(), [
+        {'username': f"cashier{i + 1:03d}", 'password_hash': password_hash, 'role': ROLE_CASHIER,
+         'full_name': f"Кассир {i + 1}", 'revision': rng.randrange(1, 2 ** 31)}
+        for i in range(cashiers)
+    ])
+    product_prices = {
+        product_id: discount_price or price
+        for product_id, price, discount_price in db.session.query(
+            Product.id, Product.price, Product.discount_price).filter(Product.article.like('SYN-%'))
+    }
+    cashier_ids = [user_id for user_id, in db.session.query(User.id).filter(User.username.like('cashier%'))]
+
+    lines = 0
+    batch = []
+    for line in _sales(rng, product_prices, cashier_ids, sales, days, end_day):
+        batch.append(line)
+        if len(batch) >= batch_size:
+            connection.execute(Sale.__table__.insert(), batch)
+            lines += len(batch)
+            batch = []
+    if batch:
+        connection.execute(Sale.__table__.insert(), batch)
+        lines += len(batch)
+    # Строки одного чека имеют общие время и кассира - чеки собираются тем же SQL, что и в миграции
+    receipts = connection.execute(text(BACKFILL_SQL)).rowcount
+    connection.execute(text(BACKFILL_LINKS_SQL))
+
+    catalog_cache.invalidate(connection)
+    categories_cache.invalidate(connection)
+    bump_version(SALES_VERSION, connection)
+    db.session.commit()
+    rollup_rows = SalesRollupRepo().rebuild()
+    return {
+        'products': products,
+        'cashiers': cashiers,
+        'sales': lines,
+        'receipts': receipts,
+        'rollup_rows': rollup_rows,
+        'days': days,
+        'seed': seed,
+        'end_day': end_day.isoformat(),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--cashiers", type=int, default=20)
+    parser.add_argument("--sales", type=int, default=100000, help="Строк продаж")
+    parser.add_argument("--days", type=int, default=365, help="Период истории, дней до сегодня")
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические данные для нагрузочных тестов")
+    parser.add_argument("--database", default=None, help="Файл базы (по умолчанию - временный)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    path = use_database(args.database, prefix="datagen-")
+    from app.startservice import create_app, init_db
+    from app.models.product import Product
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        if Product.query.first():
+            parser.error(f"база {path} уже содержит товары")
+        started = time.perf_counter()
+        result = generate(args.products, args.cashiers, args.sales, args.days, args.seed)
+    result['database'] = path
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    write_json(result)
+
+
+if __name__ == "__main__":
+    main()
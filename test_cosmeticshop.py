@@ -1,5 +1,5 @@
 import pytest
-from app.startservice import app
+from app.startservice import create_app, init_db
 from app.models import db
 from app.models.user import User, UserRepo, ROLE_DIRECTOR, ROLE_CASHIER
 from app.models.product import Product, ProductRepo
@@ -7,17 +7,28 @@ from app.models.sale import Sale, SaleRepo
 from decimal import Decimal
 
 
+# Свое приложение и свой файл базы на каждый тест (файл, а не :memory: - пулу соединений,
+# PRAGMA WAL и фоновым потокам отчетов и резервов нужны настоящие отдельные соединения)
 @pytest.fixture
-def client():
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-    app.config['WTF_CSRF_ENABLED'] = False
-    
+def app(tmp_path):
+    return create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "cosmeticshop.db"}',
+        'WTF_CSRF_ENABLED': False,
+        # Отчеты считаются в фоне; в тестах страница ждет результат и пересчитывает его после каждой продажи
+        'REPORT_WAIT_SECONDS': 10,
+        'REPORT_MIN_INTERVAL': 0,
+    })
+
+
+@pytest.fixture
+def client(app):
     with app.test_client() as client:
         with app.app_context():
-            db.create_all()
+            init_db()
             yield client
-            db.drop_all()
+            db.session.remove()
+            db.engine.dispose()
 
 
 @pytest.fixture
@@ -290,7 +301,7 @@ def test_19_daily_report_only_for_director(client, cashier_user):
     assert 'запрещен'.encode('utf-8') in response_lower or b'forbidden' in response_lower
 
 
-# Тест установки скидки на товар админом
+# Тест установки и снятия скидки на товар админом
 def test_20_discount_setting(client, admin_user, test_product):
     client.post('/auth/login', data={
         'username': 'admin',
@@ -305,6 +316,15 @@ def test_20_discount_setting(client, admin_user, test_product):
     updated = ProductRepo().get_by_id(test_product.id)
     assert float(updated.discount_price) == 80.00
 
+    # Изменение других полей скидку не трогает, пустое поле формы снимает ее
+    assert ProductRepo().update(test_product.id, stock_quantity=9).discount_price == Decimal('80.00')
+    response = client.post(f'/products/{test_product.id}/set_discount', data={
+        'discount_price': '',
+        'search': ''
+    }, follow_redirects=True)
+    assert 'Скидка удалена!' in response.get_data(as_text=True)
+    assert ProductRepo().get_by_id(test_product.id).discount_price is None
+
 
 # Тест что скидка применяется при продаже
 def test_21_discount_applied_in_sale(client, cashier_user, test_product):
@@ -387,3 +407,1186 @@ def test_25_logout(client, admin_user):
     }, follow_redirects=True)
     response = client.get('/auth/logout', follow_redirects=True)
     assert response.status_code == 200
+
+
+# Тест что список продаж загружается фиксированным числом запросов (без N+1)
+def test_26_sales_list_no_n_plus_one(client, admin_user, cashier_user, test_product):
+    from sqlalchemy import event
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+
+    def count_queries(url):
+        statements = []
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', on_execute)
+        try:
+            response = client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', on_execute)
+        assert response.status_code == 200
+        return len(statements)
+
+    SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('100.00'))
+    one_sale = count_queries('/sales/')
+    for _ in range(5):
+        SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('100.00'))
+    many_sales = count_queries('/sales/')
+    assert one_sale == many_sales
+
+    response = client.get('/sales/daily_report')
+    assert 'Тестовый товар'.encode('utf-8') in response.data
+
+
+# Тест постраничной выборки по ключу: страницы не пересекаются и переход назад возвращает ту же страницу
+def test_27_keyset_pagination(client, cashier_user):
+    product_repo = ProductRepo()
+    for i in range(7):
+        product_repo.add(f'Товар {i}', 'Крем', Decimal('10.00'), 5)
+    sale_repo = SaleRepo()
+    product = product_repo.all()[0]
+    for _ in range(7):
+        sale_repo.add(product.id, cashier_user.id, 1, Decimal('10.00'))
+
+    first = product_repo.page(limit=3)
+    second = product_repo.page(after=first.next_cursor, limit=3)
+    third = product_repo.page(after=second.next_cursor, limit=3)
+    assert [p.name for p in first] == ['Товар 0', 'Товар 1', 'Товар 2']
+    assert [p.name for p in third] == ['Товар 6']
+    assert third.next_cursor is None
+    back = product_repo.page(before=second.prev_cursor, limit=3)
+    assert [p.id for p in back] == [p.id for p in first]
+    assert back.prev_cursor is None
+
+    seen = []
+    page = sale_repo.page_with_details(cashier_user.id, limit=3)
+    while True:
+        seen.extend(sale.id for sale in page)
+        if not page.next_cursor:
+            break
+        page = sale_repo.page_with_details(cashier_user.id, after=page.next_cursor, limit=3)
+    assert seen == [sale.id for sale in sale_repo.get_by_cashier(cashier_user.id)]
+    assert len(set(seen)) == 7
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+    response = client.get('/sales/my_sales?after=garbage')
+    assert response.status_code == 200
+
+
+# Тест что корзина оформляется атомарно: при нехватке одного товара не продается ничего
+def test_28_checkout_is_atomic(client, cashier_user, test_product):
+    from app.models.checkout import CheckoutService, CheckoutError
+
+    other = ProductRepo().add('Второй товар', 'Крем', Decimal('50.00'), 2)
+    service = CheckoutService()
+
+    with pytest.raises(CheckoutError) as error:
+        service.checkout(cashier_user.id, [(test_product.id, 3), (other.id, 1), (other.id, 2)])
+    assert 'Недостаточно' in error.value.errors[0]
+    assert ProductRepo().get_by_id(test_product.id).stock_quantity == 10
+    assert ProductRepo().get_by_id(other.id).stock_quantity == 2
+    assert SaleRepo().get_total_sales_count() == 0
+
+    # Отрицательная строка не вычитается из другой строки того же товара
+    with pytest.raises(CheckoutError) as error:
+        service.checkout(cashier_user.id, [(test_product.id, 5), (test_product.id, -3)])
+    assert 'больше нуля' in error.value.errors[0]
+    assert SaleRepo().get_total_sales_count() == 0
+
+    lines = service.checkout(cashier_user.id, [(test_product.id, 3), (other.id, 2)])
+    assert len(lines) == 2
+    assert ProductRepo().get_by_id(test_product.id).stock_quantity == 7
+    assert ProductRepo().get_by_id(other.id).stock_quantity == 0
+    assert SaleRepo().get_total_revenue() == 400.0
+
+
+# Тест что каждое соединение SQLite получает настроенные PRAGMA
+def test_29_sqlite_pragmas(client, app):
+    from sqlalchemy import text
+    from app.models.engine import engine_options
+
+    with db.engine.connect() as connection:
+        assert connection.execute(text('PRAGMA busy_timeout')).scalar() == app.config['SQLITE_BUSY_TIMEOUT']
+        assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+        assert connection.execute(text('PRAGMA cache_size')).scalar() == app.config['SQLITE_CACHE_SIZE']
+
+    config = dict(app.config, SQLALCHEMY_DATABASE_URI='sqlite:///:memory:', SQLALCHEMY_ENGINE_OPTIONS={})
+    assert 'pool_size' not in engine_options(config)
+    config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/shop.db'
+    assert engine_options(config)['pool_size'] == app.config['DB_POOL_SIZE']
+
+
+# Тест что миграции добавляют индексы и столбец sale_day в базу старого формата
+def test_30_migrations_upgrade_legacy_database(tmp_path):
+    from sqlalchemy import create_engine, text
+    from app.models.migrations import MIGRATIONS, run_migrations, get_schema_version
+
+    engine = create_engine(f'sqlite:///{tmp_path / "legacy.db"}')
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE products (id INTEGER PRIMARY KEY, name VARCHAR(200), '
+                                'article VARCHAR(50), category VARCHAR(100), description TEXT)'))
+        connection.execute(text('CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(50))'))
+        connection.execute(text('CREATE TABLE sales (id INTEGER PRIMARY KEY, product_id INTEGER, '
+                                'cashier_id INTEGER, quantity INTEGER, total_price NUMERIC(10, 2), sale_date DATETIME)'))
+        connection.execute(text("INSERT INTO products VALUES (1, 'Крем', 'A1', 'Крем', NULL)"))
+        connection.execute(text("INSERT INTO sales VALUES (1, 1, 1, 2, 300.00, '2025-03-08 10:15:00.000000')"))
+
+    applied = run_migrations(engine)
+    assert [version for version, _ in applied] == [version for version, _, _ in MIGRATIONS]
+    assert run_migrations(engine) == []
+
+    with engine.connect() as connection:
+        assert get_schema_version(connection) == MIGRATIONS[-1][0]
+        indexes = {row[1] for row in connection.execute(text("PRAGMA index_list(sales)"))}
+        assert {'ix_sales_cashier_date', 'ix_sales_date_product', 'ix_sales_day_date'} <= indexes
+        assert connection.execute(text('SELECT sale_day FROM sales')).scalar() == '2025-03-08'
+        assert connection.execute(text('SELECT revenue FROM daily_sales')).scalar() == 300
+        assert connection.execute(text('SELECT line_count, total FROM receipts')).one() == (1, 300)
+        assert connection.execute(text('SELECT receipt_id FROM sales')).scalar() == 1
+        assert connection.execute(text("SELECT rowid FROM products_fts WHERE products_fts MATCH 'крем'")).scalar() == 1
+    engine.dispose()
+
+
+# Тест что запросы репозиториев используют индексы (EXPLAIN QUERY PLAN)
+def test_31_repo_queries_use_indexes(client):
+    from app.models.query_plans import check_query_plans
+    assert check_query_plans() == []
+
+
+# Тест полнотекстового поиска: префиксы, регистр кириллицы, артикул и синхронизация триггерами
+def test_32_product_fts_search(client, test_product):
+    repo = ProductRepo()
+    cream = repo.add('Крем для лица ночной', 'Крем', Decimal('300.00'), 5, 'Питательный', 'NIGHT-7')
+    repo.add('Маска для волос', 'Маски', Decimal('200.00'), 5, 'Для сухой кожи лица')
+
+    assert [p.name for p in repo.search('КРЕМ ЛИЦ')] == ['Крем для лица ночной']
+    assert [p.id for p in repo.search('night')] == [cream.id]
+    assert repo.search('лица')[0].id == cream.id
+    assert repo.search('  ') == []
+
+    repo.update(cream.id, name='Сыворотка ночная')
+    assert repo.search('крем лица') == []
+    assert [p.id for p in repo.search('сыворот')] == [cream.id]
+
+    repo.delete(cream.id)
+    assert repo.search('сыворотка') == []
+    assert [p.id for p in repo.filter_by_name('тестов')] == [test_product.id]
+
+    # Постраничный поиск по (rank, id): все совпадения доступны по курсорам
+    found = [repo.add(f'Гель {n}', 'Гели', Decimal('100.00'), 1).id for n in range(5)]
+    first = repo.search_page('гель', limit=2)
+    assert [p.id for p in first] == found[:2] and first.prev_cursor is None
+    second = repo.search_page('гель', after=first.next_cursor, limit=2)
+    third = repo.search_page('гель', after=second.next_cursor, limit=2)
+    assert [p.id for p in second] + [p.id for p in third] == found[2:]
+    assert third.next_cursor is None
+    assert [p.id for p in repo.search_page('гель', before=second.prev_cursor, limit=2)] == found[:2]
+    assert len(repo.search_page('  ')) == 0
+
+
+# Тест что сводка по дням обновляется при продаже и совпадает с полным пересчетом
+def test_33_daily_sales_rollup(client, admin_user, cashier_user, test_product):
+    from app.models.checkout import CheckoutService
+    from app.models.sales_rollup import SalesRollupRepo, DailySales
+
+    other = ProductRepo().add('Второй товар', 'Крем', Decimal('50.00'), 10)
+    CheckoutService().checkout(cashier_user.id, [(test_product.id, 2), (other.id, 1)])
+    CheckoutService().checkout(cashier_user.id, [(test_product.id, 1)])
+    SaleRepo().add(other.id, admin_user.id, 3, Decimal('150.00'))
+
+    def snapshot():
+        return sorted((r.day, r.product_id, r.cashier_id, r.quantity, float(r.revenue), r.line_count)
+                      for r in DailySales.query.all())
+
+    incremental = snapshot()
+    assert SalesRollupRepo().rebuild() == len(incremental)
+    assert snapshot() == incremental
+
+    sale_repo = SaleRepo()
+    assert sale_repo.get_total_revenue() == 500.0
+    assert sale_repo.get_total_sales_count() == 4
+    assert sale_repo.get_top_products()[0].name == 'Тестовый товар'
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/sales/daily_report?date=' + incremental[0][0].isoformat())
+    assert '500.00'.encode('utf-8') in response.data
+    assert 'Второй товар'.encode('utf-8') in response.data
+
+
+# Тест кэша каталога: повторное чтение из памяти, сброс при записи и при смене версии другим процессом
+def test_34_catalog_cache(client, cashier_user, test_product):
+    from app.models.cache import bump_version, catalog_cache
+    from app.models.checkout import CheckoutService
+
+    repo = ProductRepo()
+    assert repo.get_categories() == ['Крем']
+    first = repo.get_catalog()
+    assert repo.get_catalog() is first
+
+    repo.add('Шампунь', 'Волосы', Decimal('120.00'), 3)
+    assert sorted(repo.get_categories()) == ['Волосы', 'Крем']
+    assert [p.name for p in repo.get_catalog()] == ['Тестовый товар', 'Шампунь']
+
+    CheckoutService().checkout(cashier_user.id, [(test_product.id, 10)])
+    assert [p.name for p in repo.get_available()] == ['Шампунь']
+
+    # Другой процесс изменил товар и увеличил версию в базе: локальная копия не должна использоваться
+    cached = repo.get_catalog()
+    db.session.execute(Product.__table__.update().values(stock_quantity=7))
+    bump_version(catalog_cache.name)
+    db.session.commit()
+    assert repo.get_catalog() is not cached
+    assert {p.stock_quantity for p in repo.get_catalog()} == {7}
+
+
+# Тест кэша пользователя: запросы без обращения к users, смена роли и удаление действуют сразу
+def test_35_user_identity_cache(client, admin_user, cashier_user):
+    from flask import g
+    from sqlalchemy import event
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+
+    # Контекст приложения общий для всех запросов теста, поэтому Flask-Login
+    # держит пользователя в g; убираем его, чтобы каждый запрос шел через user_loader
+    def get(url):
+        g.pop('_login_user', None)
+        return client.get(url)
+
+    statements = []
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        assert get('/sales/my_sales').status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+    assert not [s for s in statements if 'FROM users' in s]
+
+    assert get('/sales/statistics').status_code == 302
+
+    UserRepo().update(cashier_user.id, role=ROLE_DIRECTOR)
+    assert get('/sales/statistics').status_code == 200
+
+    UserRepo().delete(cashier_user.id)
+    response = get('/sales/statistics')
+    assert response.status_code == 302
+    assert '/auth/login' in response.headers['Location']
+
+    # Понижение в другом процессе: его кэш не тронут, но общий счетчик сбрасывает копию
+    from app.models.cache import bump_version, user_cache
+    repo = UserRepo()
+    assert repo.get_identity(admin_user.id).is_director()
+    with db.engine.begin() as connection:
+        connection.execute(User.__table__.update().where(User.id == admin_user.id).values(role=ROLE_CASHIER))
+        bump_version(user_cache.name, connection)
+    db.session.remove()
+    assert not repo.get_identity(admin_user.id).is_director()
+
+    # Пересчет хэша при входе тоже сбрасывает копии во всех процессах
+    from app.models.cache import current_version
+    version = current_version(user_cache.name)
+    repo.set_password_hash(repo.get_by_username('admin'), 'rehashed')
+    assert current_version(user_cache.name) == version + 1
+
+
+# Тест пересчета хэша пароля при входе и ограничения неудачных попыток
+def test_36_login_rehash_and_throttle(client, app):
+    from app.models.security import login_throttle
+
+    original_method = app.config['PASSWORD_HASH_METHOD']
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    try:
+        user = UserRepo().add('rehash', 'secret1', ROLE_CASHIER)
+        assert user.password_hash.startswith('pbkdf2:sha256:1000$')
+
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        client.post('/auth/login', data={'username': 'rehash', 'password': 'secret1'})
+        user = UserRepo().get_by_username('rehash')
+        assert user.password_hash.startswith('pbkdf2:sha256:2000$')
+        assert user.check_password('secret1')
+        client.get('/auth/logout')
+
+        for _ in range(app.config['LOGIN_MAX_ATTEMPTS']):
+            client.post('/auth/login', data={'username': 'rehash', 'password': 'wrong'})
+        response = client.post('/auth/login', data={'username': 'rehash', 'password': 'secret1'})
+        assert 'Слишком много'.encode('utf-8') in response.data
+
+        login_throttle.reset('rehash')
+        response = client.post('/auth/login', data={'username': 'rehash', 'password': 'secret1'})
+        assert response.status_code == 302
+    finally:
+        app.config['PASSWORD_HASH_METHOD'] = original_method
+        login_throttle.reset('rehash')
+
+
+# Тест импорта товаров из CSV: добавление, обновление по артикулу, ошибки строк не прерывают импорт
+def test_37_product_csv_import(client, admin_user, test_product, app, tmp_path):
+    import io
+    from app.models.product_import import ProductImporter
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    content = (
+        'Название;Артикул;Категория;Цена;Остаток\n'
+        'Крем обновленный;ART001;Крем;120,50;15\n'
+        'Пудра;P-1;Пудра;300;4\n'
+        'Без цены;P-2;Пудра;;4\n'
+        'Тушь;T-1;Тушь;abc;1\n'
+        'Румяна;;Румяна;250;2\n'
+    )
+    response = client.post('/products/import', data={
+        'file': (io.BytesIO(content.encode('utf-8')), 'price.csv'),
+        'encoding': 'utf-8-sig'
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert 'добавлено 2, обновлено 1, ошибок 2'.encode('utf-8') in response.data
+
+    repo = ProductRepo()
+    updated = repo.get_by_id(test_product.id)
+    assert updated.name == 'Крем обновленный'
+    assert updated.price == Decimal('120.50')
+    assert updated.stock_quantity == 15
+    assert [p.name for p in repo.search('пудра')] == ['Пудра']
+
+    result = ProductImporter(batch_size=2).import_csv(io.StringIO(
+        'name,article,category,price\n' + ''.join(f'Товар {i},B-{i},Крем,10\n' for i in range(5))
+    ))
+    assert (result.created, result.updated, result.error_count) == (5, 0, 0)
+
+    # Существующему товару меняются только столбцы файла, пустой остаток его не обнуляет
+    repo.update(test_product.id, stock_quantity=40, description='Дневной', package='50 мл')
+    path = tmp_path / 'prices.csv'
+    path.write_text('name;article;category;price;stock_quantity\nКрем;ART001;Крем;130;\nМаска;M-1;Маски;90;\n',
+                    encoding='utf-8')
+    output = app.test_cli_runner().invoke(args=['import-products', str(path)]).output
+    assert 'Добавлено: 1, обновлено: 1, ошибок: 0' in output
+    updated = repo.get_by_id(test_product.id)
+    assert (updated.price, updated.stock_quantity, updated.description, updated.package) == \
+        (Decimal('130.00'), 40, 'Дневной', '50 мл')
+    assert repo.search('маска')[0].stock_quantity == 0
+
+
+# Тест выгрузки продаж: CSV и NDJSON отдаются потоком, фильтры по кассиру и датам
+def test_38_sales_export(client, admin_user, cashier_user, test_product):
+    import csv
+    import io
+    import json
+
+    SaleRepo().add(test_product.id, cashier_user.id, 2, Decimal('200.00'))
+    SaleRepo().add(test_product.id, admin_user.id, 1, Decimal('100.00'))
+
+    response = client.get('/sales/export')
+    assert response.status_code == 302
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+
+    response = client.get('/sales/export?format=csv')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert len(rows) == 2
+    assert rows[0]['quantity'] == '2'
+
+    response = client.get(f'/sales/export?format=ndjson&cashier_id={cashier_user.id}')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 1
+    assert lines[0]['cashier_id'] == cashier_user.id
+    assert lines[0]['total_price'] == 200.0
+
+    response = client.get('/sales/export?format=ndjson&start=2000-01-01&end=2000-01-31')
+    assert response.get_data(as_text=True) == ''
+
+    response = client.get('/sales/export?format=xml')
+    assert response.status_code == 302
+
+
+# Тест JSON API: постраничная выдача, выбор полей, 304 только по ETag, права доступа
+def test_39_json_api_conditional_get(client, admin_user, cashier_user, test_product):
+    from flask import g
+
+    response = client.get('/api/v1/products')
+    assert response.status_code == 401
+    assert response.is_json
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+
+    response = client.get('/api/v1/products?fields=id,name,price')
+    assert response.status_code == 200
+    assert response.json['items'] == [{'id': test_product.id, 'name': 'Тестовый товар', 'price': 100.0}]
+    etag = response.headers['ETag']
+    assert 'Last-Modified' not in response.headers
+
+    assert client.get('/api/v1/products?fields=id,name,price', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/v1/products?fields=id,name,price',
+                      headers={'If-Modified-Since': 'Tue, 01 Jan 2999 00:00:00 GMT'}).status_code == 200
+    assert client.get('/api/v1/products?fields=bogus').status_code == 400
+    assert client.get('/api/v1/statistics').status_code == 403
+
+    ProductRepo().update(test_product.id, price=Decimal('90.00'))
+    response = client.get('/api/v1/products?fields=id,name,price', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json['items'][0]['price'] == 90.0
+
+    SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('90.00'))
+    SaleRepo().add(test_product.id, admin_user.id, 1, Decimal('90.00'))
+    response = client.get('/api/v1/sales?limit=1')
+    assert [sale['cashier_id'] for sale in response.json['items']] == [cashier_user.id]
+    assert response.json['next_cursor'] is None
+    etag = response.headers['ETag']
+    assert client.get('/api/v1/sales?limit=1', headers={'If-None-Match': etag}).status_code == 304
+    SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('90.00'))
+    assert client.get('/api/v1/sales?limit=1', headers={'If-None-Match': etag}).status_code == 200
+
+    # Роль входит в ETag: после повышения тот же адрес отдает продажи всех касс
+    etag = client.get('/api/v1/sales').headers['ETag']
+    UserRepo().update(cashier_user.id, role=ROLE_DIRECTOR)
+    # Контекст приложения общий для запросов теста: пользователь загружается заново
+    g.pop('_login_user', None)
+    response = client.get('/api/v1/sales', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and len(response.json['items']) == 3
+    UserRepo().update(cashier_user.id, role=ROLE_CASHIER)
+
+    client.get('/auth/logout')
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/api/v1/statistics')
+    assert response.json['total_sales_count'] == 3
+    assert response.json['top_products'][0]['name'] == 'Тестовый товар'
+
+
+# Тест дельта-синхронизации каталога: номер изменения растет при любой записи товара,
+# дельта содержит только измененные товары и удаленные id
+def test_40_catalog_delta_feed(client, cashier_user, test_product):
+    from app.models.checkout import CheckoutService
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+
+    response = client.get('/api/v1/catalog')
+    assert response.json['reset'] is True
+    assert [product['id'] for product in response.json['products']] == [test_product.id]
+    seq = response.json['seq']
+
+    response = client.get(f'/api/v1/catalog?since={seq}')
+    assert response.json == {'seq': seq, 'reset': False, 'products': [], 'deleted': []}
+
+    repo = ProductRepo()
+    other = repo.add('Пудра', 'Пудра', Decimal('300.00'), 5)
+    CheckoutService().checkout(cashier_user.id, [(test_product.id, 2)])
+    response = client.get(f'/api/v1/catalog?since={seq}')
+    changed = {product['id']: product for product in response.json['products']}
+    assert set(changed) == {test_product.id, other.id}
+    assert changed[test_product.id]['stock_quantity'] == 8
+    assert response.json['seq'] > seq
+    seq = response.json['seq']
+
+    repo.delete(other.id)
+    response = client.get(f'/api/v1/catalog?since={seq}')
+    assert response.json['products'] == []
+    assert response.json['deleted'] == [other.id]
+
+    response = client.get('/api/v1/catalog?since=999999999')
+    assert response.json['reset'] is True
+    assert [product['id'] for product in response.json['products']] == [test_product.id]
+
+    response = client.get('/sales/create')
+    assert b'/api/v1/catalog' in response.data
+
+
+# Тест генератора данных для нагрузочных тестов: повторяемость по seed и согласованность сводки
+def test_41_benchmark_data_generator(client):
+    import random
+    from benchmarks import datagen
+    from benchmarks.common import percentile
+    from app.models.sales_rollup import SalesRollupRepo
+
+    assert datagen._products(random.Random(7), 5) == datagen._products(random.Random(7), 5)
+
+    result = datagen.generate(products=30, cashiers=3, sales=500, days=7, seed=1)
+    assert result['sales'] == Sale.query.count() > 0
+    assert len(ProductRepo().search('SYN')) == 30
+    total = sum(sale.total_price for sale in Sale.query.all())
+    assert Decimal(str(SalesRollupRepo().get_total_revenue())) == total
+    assert Sale.query.filter(Sale.receipt_id.is_(None)).count() == 0
+    assert 0 < result['receipts'] <= result['sales']
+
+    assert percentile(list(range(1, 101)), 50) == 50
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+# Бюджет SQL-запросов на страницу: рост числа запросов (например, N+1) роняет тест
+def assert_query_budget(client, url, budget, method='get', **kwargs):
+    from app.models.query_stats import capture_queries
+    with capture_queries() as stats:
+        response = getattr(client, method)(url, **kwargs)
+    assert response.status_code in (200, 302), url
+    assert stats.count <= budget, (
+        f"{method.upper()} {url}: {stats.count} запросов, бюджет {budget}\n" + "\n".join(stats.statements)
+    )
+    return response
+
+
+# Тест учета запросов: заголовок Server-Timing, строка лога и бюджеты запросов страниц
+def test_42_query_budgets(client, admin_user, cashier_user, test_product, caplog):
+    import json
+    import logging
+
+    repo = ProductRepo()
+    for i in range(5):
+        repo.add(f'Товар {i}', 'Крем', Decimal('50.00'), 10)
+    for _ in range(5):
+        SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('100.00'))
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    with caplog.at_level(logging.INFO, logger='cosmeticshop.requests'):
+        response = assert_query_budget(client, '/sales/', 2)
+    assert response.headers.getlist('Server-Timing')[0].startswith('db;dur=')
+    line = json.loads(caplog.records[-1].getMessage())
+    assert line['endpoint'] == 'sales.list_sales'
+    assert line['queries'] >= 1 and line['slowest_sql']
+
+    # Отчеты: первый запрос ставит задачу, повторный берет готовый результат
+    client.get('/sales/daily_report')
+    client.get('/sales/statistics')
+    assert_query_budget(client, '/sales/daily_report', 2)
+    assert_query_budget(client, '/sales/statistics', 2)
+    assert_query_budget(client, '/products/', 3)
+    assert_query_budget(client, '/products/?search=товар', 3)
+    assert_query_budget(client, '/products/?category=Крем', 3)
+    assert_query_budget(client, '/products/discounts', 2)
+    assert_query_budget(client, f'/products/{test_product.id}/edit', 2)
+
+    client.get('/auth/logout')
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+    assert_query_budget(client, '/sales/my_sales', 2)
+    assert_query_budget(client, '/sales/create', 1)
+    # Продажа: товары, списание, чек, строки, сводка и версии кэша
+    assert_query_budget(client, '/sales/create', 7, method='post', data={
+        'product_ids': [str(test_product.id)],
+        'quantities': ['1'],
+        'confirmed': 'on'
+    })
+
+
+# Тест метрик Prometheus: задержки по маршрутам, продажи, неудачные входы, сумма по процессам
+def test_43_prometheus_metrics(client, admin_user, cashier_user, test_product, tmp_path, app):
+    import json
+    import os
+    import subprocess
+    import sys
+    from app.models.checkout import CheckoutService, CheckoutError
+    from app.models.metrics import registry
+
+    def metric(text, line_start):
+        return [float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(line_start)]
+
+    registry.reset()
+    client.post('/auth/login', data={'username': 'cashier', 'password': 'wrong'})
+    client.post('/auth/login', data={'username': 'cashier', 'password': 'cashier123'})
+    client.get('/products/')
+    CheckoutService().checkout(cashier_user.id, [(test_product.id, 1), (test_product.id, 1)])
+    with pytest.raises(CheckoutError):
+        CheckoutService().checkout(cashier_user.id, [(test_product.id, 100)])
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert metric(text, 'cosmeticshop_login_failures_total{reason="invalid_credentials"}') == [1]
+    assert metric(text, 'cosmeticshop_checkouts_total') == [1]
+    assert metric(text, 'cosmeticshop_checkout_rejected_total') == [1]
+    assert metric(text, 'cosmeticshop_checkout_cart_lines_bucket{le="1"}') == [1]
+    assert metric(text, 'cosmeticshop_http_request_duration_seconds_count'
+                        '{endpoint="products.list_products",method="GET"}') == [1]
+    assert metric(text, 'cosmeticshop_db_lock_wait_seconds_count')[0] >= 1
+    assert 'cosmeticshop_db_pool_connections{state="size"}' in text
+
+    # Снимок завершившегося процесса: счетчики складываются, gauge не учитываются
+    finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                              capture_output=True, text=True).stdout.strip()
+    # и снимок предыдущего процесса с тем же pid, но другим временем запуска, не затирается
+    for name, checkouts in ((f'{finished}-1', 4), (f'{os.getpid()}-1', 2)):
+        (tmp_path / f'{name}.json').write_text(json.dumps({
+            'values': [['cosmeticshop_checkouts_total', [], checkouts]],
+            'histograms': [],
+            'gauges': [['cosmeticshop_db_pool_connections', [['state', 'size']], 100]],
+        }))
+    # Посторонние файлы в каталоге пропускаются
+    (tmp_path / 'notes.json').write_text('{}')
+    (tmp_path / 'abc-1.json').write_text('{}')
+    app.config['METRICS_DIR'] = str(tmp_path)
+    try:
+        text = client.get('/metrics').get_data(as_text=True)
+        # Снимки завершившихся процессов перенесены в снимок этого процесса и удалены
+        assert sorted(path.name for path in tmp_path.glob('*.json*')) == sorted(
+            ['notes.json', 'abc-1.json', next(tmp_path.glob(f'{os.getpid()}-*.json')).name])
+        again = client.get('/metrics').get_data(as_text=True)
+    finally:
+        app.config['METRICS_DIR'] = None
+    assert metric(text, 'cosmeticshop_checkouts_total') == [7]
+    assert metric(again, 'cosmeticshop_checkouts_total') == [7]
+    assert metric(text, 'cosmeticshop_db_pool_connections{state="size"}')[0] < 100
+
+    # Доступ к /metrics: чужая сеть без токена получает 403, с токеном - метрики
+    remote = {'REMOTE_ADDR': '10.0.0.5'}
+    assert client.get('/metrics', environ_base=remote).status_code == 403
+    app.config['METRICS_TOKEN'] = 'secret'
+    try:
+        assert client.get('/metrics', environ_base=remote,
+                          headers={'Authorization': 'Bearer wrong'}).status_code == 403
+        assert client.get('/metrics', environ_base=remote,
+                          headers={'Authorization': 'Bearer secret'}).status_code == 200
+    finally:
+        app.config['METRICS_TOKEN'] = None
+
+
+# Тест аналитики: ряды по часам/дням/неделям/месяцам с пустыми интервалами и сравнение периодов
+def test_44_revenue_analytics(client, admin_user, cashier_user, test_product):
+    from datetime import date, datetime, timedelta
+    from app.models.analytics import SalesAnalyticsRepo
+    from app.models.sales_rollup import SalesRollupRepo
+
+    def add_sale(moment, total):
+        sale = SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal(total))
+        sale.sale_date = moment
+        sale.sale_day = moment.date()
+        db.session.commit()
+
+    add_sale(datetime(2025, 3, 3, 10, 15), '100.00')
+    add_sale(datetime(2025, 3, 3, 10, 45), '50.00')
+    add_sale(datetime(2025, 3, 5, 18, 0), '200.00')
+    add_sale(datetime(2025, 2, 27, 12, 0), '70.00')
+    SalesRollupRepo().rebuild()
+
+    repo = SalesAnalyticsRepo()
+    days = repo.revenue_series(date(2025, 3, 3), date(2025, 3, 5), 'day')
+    assert [(row['bucket'], row['revenue'], row['sales_count']) for row in days] == [
+        ('2025-03-03', 150.0, 2), ('2025-03-04', 0.0, 0), ('2025-03-05', 200.0, 1)
+    ]
+    assert days[-1]['cumulative_revenue'] == 350.0
+    assert days[1]['change_pct'] == -100.0
+
+    hours = repo.revenue_series(date(2025, 3, 3), date(2025, 3, 3), 'hour')
+    assert len(hours) == 24
+    assert hours[10] == {'bucket': '2025-03-03 10:00:00', 'revenue': 150.0, 'sales_count': 2, 'quantity': 2,
+                         'cumulative_revenue': 150.0, 'change_pct': None}
+
+    weeks = repo.revenue_series(date(2025, 2, 24), date(2025, 3, 9), 'week')
+    assert [(row['bucket'], row['revenue']) for row in weeks] == [('2025-02-24', 70.0), ('2025-03-03', 350.0)]
+    assert weeks[1]['change_pct'] == 400.0
+    months = repo.revenue_series(date(2025, 2, 1), date(2025, 3, 31), 'month')
+    assert [row['bucket'] for row in months] == ['2025-02-01', '2025-03-01']
+
+    comparison = repo.compare_periods(date(2025, 3, 3), date(2025, 3, 9))
+    assert comparison['previous_start'] == date(2025, 2, 24)
+    assert comparison['current']['revenue'] == 350.0
+    assert comparison['previous']['sales_count'] == 1
+    assert comparison['changes']['revenue'] == 400.0
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/sales/analytics?start=2025-03-01&end=2025-03-09&granularity=week')
+    assert response.status_code == 200
+    assert '+400.0%'.encode('utf-8') in response.data
+    response = client.get('/sales/analytics?start=2020-01-01&end=2025-03-09&granularity=hour')
+    assert 'Слишком много интервалов'.encode('utf-8') in response.data
+
+
+# Тест ABC/XYZ-анализа: классы, скользящие средние и запас в неделях
+def test_45_assortment_report(client, admin_user, cashier_user, test_product):
+    from datetime import date, datetime, timedelta
+    from app.models.assortment import AssortmentAnalytics
+    from app.models.sales_rollup import SalesRollupRepo
+
+    def add_sale(product, moment, quantity, total):
+        sale = SaleRepo().add(product.id, cashier_user.id, quantity, Decimal(total))
+        sale.sale_date = moment
+        sale.sale_day = moment.date()
+        db.session.commit()
+
+    seasonal = ProductRepo().add('Сезонный товар', 'Крем', Decimal('100.00'), 5)
+    idle = ProductRepo().add('Без продаж', 'Крем', Decimal('10.00'), 3)
+    for day in range(14):
+        add_sale(test_product, datetime(2025, 3, 3, 12) + timedelta(days=day), 1, '100.00')
+    add_sale(seasonal, datetime(2025, 3, 3, 12), 2, '200.00')
+    SalesRollupRepo().rebuild()
+
+    report = AssortmentAnalytics().report(date(2025, 3, 3), date(2025, 3, 16), ProductRepo().get_catalog())
+    rows = {row['product'].id: row for row in report['rows']}
+    assert [row['product'].id for row in report['rows']][:2] == [test_product.id, seasonal.id]
+    assert report['total_revenue'] == 1600.0
+
+    steady = rows[test_product.id]
+    assert (steady['abc'], steady['xyz']) == ('A', 'X')
+    assert steady['variation'] == 0.0
+    assert steady['ma7'] == 1.0 and steady['ma28'] == 1.0
+    assert steady['weeks_of_cover'] == pytest.approx(10 / 7)
+
+    assert (rows[seasonal.id]['abc'], rows[seasonal.id]['xyz']) == ('B', 'Z')
+    assert rows[seasonal.id]['ma7'] == 0.0
+    assert rows[seasonal.id]['weeks_of_cover'] == pytest.approx(5.0)
+    assert (rows[idle.id]['abc'], rows[idle.id]['xyz']) == ('C', 'Z')
+    assert rows[idle.id]['weeks_of_cover'] is None
+    assert report['matrix']['AX'] == 1 and report['matrix']['CZ'] == 1
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/sales/assortment?start=2025-03-03&end=2025-03-16&abc=B')
+    assert response.status_code == 200
+    assert 'Сезонный товар'.encode('utf-8') in response.data
+    assert 'Тестовый товар'.encode('utf-8') not in response.data
+
+
+# Тест фоновых отчетов: задача в пуле, кэш результата, пересчет после продажи и ошибки
+def test_46_report_jobs(client, admin_user, cashier_user, test_product, app):
+    import threading
+    from app.models.report_jobs import REPORTS, report, report_jobs
+    from app.models.sale import SALES_VERSION
+
+    release = threading.Event()
+    calls = []
+
+    @report('test_slow', [SALES_VERSION])
+    def slow_report(limit):
+        release.wait(10)
+        calls.append(limit)
+        if limit < 0:
+            raise ValueError('неверный лимит')
+        return {'total': SaleRepo().get_total_sales_count(), 'limit': limit}
+
+    try:
+        app.config['REPORT_WAIT_SECONDS'] = 0
+        job = report_jobs.get('test_slow', limit=5)
+        assert job.pending and job.result is None
+        # Пока задача считается, повторный запрос не ставит вторую
+        assert report_jobs.get('test_slow', limit=5).pending
+        release.set()
+        report_jobs.wait_all(10)
+
+        job = report_jobs.get('test_slow', limit=5)
+        assert not job.pending and job.result == {'total': 0, 'limit': 5}
+        assert job.computed_at is not None
+        assert report_jobs.get('test_slow', limit=5).computed_at == job.computed_at
+        assert calls == [5]
+
+        # Новая продажа меняет версию данных - результат пересчитывается
+        SaleRepo().add(test_product.id, cashier_user.id, 1, Decimal('100.00'))
+        app.config['REPORT_WAIT_SECONDS'] = 10
+        assert report_jobs.get('test_slow', limit=5).result == {'total': 1, 'limit': 5}
+        assert calls == [5, 5]
+
+        failed = report_jobs.get('test_slow', limit=-1)
+        assert failed.error == 'неверный лимит' and failed.result is None
+    finally:
+        del REPORTS['test_slow']
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/sales/statistics')
+    assert 'Данные на'.encode('utf-8') in response.data
+    assert '100.00 руб.'.encode('utf-8') in response.data
+    assert b'http-equiv="refresh"' not in response.data
+
+
+# Тест чеков: корзина - один чек со строками и оплатой, итоги считаются по чекам
+def test_47_receipts(client, admin_user, cashier_user, test_product):
+    from app.models.checkout import CheckoutService, CheckoutError
+    from app.models.receipt import Receipt, ReceiptRepo
+    from app.models.query_plans import check_query_plans
+
+    other = ProductRepo().add('Второй товар', 'Крем', Decimal('50.00'), 10)
+    service = CheckoutService()
+    lines = service.checkout(cashier_user.id, [(test_product.id, 2), (other.id, 1)], 'cash', Decimal('300.00'))
+    receipt = ReceiptRepo().get_with_lines(lines[0]['receipt_id'])
+    assert (float(receipt.total), receipt.line_count, receipt.item_count) == (250.0, 2, 3)
+    assert float(receipt.change) == 50.0
+    assert sorted(line.product_id for line in receipt.lines) == sorted([test_product.id, other.id])
+
+    with pytest.raises(CheckoutError):
+        service.checkout(cashier_user.id, [(other.id, 1)], 'cash', Decimal('10.00'))
+    with pytest.raises(CheckoutError):
+        service.checkout(cashier_user.id, [(other.id, 1)], 'crypto')
+    service.checkout(cashier_user.id, [(other.id, 1)], 'card')
+    SaleRepo().add(other.id, admin_user.id, 1, Decimal('50.00'))
+
+    assert Receipt.query.count() == 3
+    assert ReceiptRepo().get_totals() == (3, 350.0)
+    assert ReceiptRepo().get_totals(cashier_id=cashier_user.id) == (2, 300.0)
+    assert not [p for p in check_query_plans() if p[0].startswith('ReceiptRepo')]
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+    response = client.get(f'/sales/receipts/{receipt.id}')
+    assert 'Чек №'.encode('utf-8') in response.data and 'сдача 50.00'.encode('utf-8') in response.data
+    admin_receipt = Receipt.query.filter_by(cashier_id=admin_user.id).one()
+    assert client.get(f'/sales/receipts/{admin_receipt.id}').status_code == 302
+    response = client.post('/sales/create', data={
+        'product_ids': [str(other.id)], 'quantities': ['1'], 'confirmed': 'on',
+        'payment_method': 'cash', 'paid_amount': '100'
+    }, follow_redirects=True)
+    assert 'Сдача: 50.00'.encode('utf-8') in response.data
+    client.get('/auth/logout')
+
+    client.post('/auth/login', data={
+        'username': 'admin',
+        'password': 'admin123'
+    }, follow_redirects=True)
+    response = client.get('/sales/statistics')
+    assert 'Всего чеков'.encode('utf-8') in response.data
+    assert client.get('/api/v1/statistics').json['total_sales_count'] == 4
+
+
+# Тест идемпотентности продажи: повтор с тем же ключом не создает второй чек
+def test_48_idempotent_checkout(client, cashier_user, test_product, app):
+    import threading
+    import time
+    from app.models.checkout import CheckoutService, CheckoutError
+    from app.models.idempotency import IdempotencyStore, checkout_keys
+    from app.models.query_stats import capture_queries
+    from app.models.receipt import Receipt
+
+    checkout_keys.clear()
+    service = CheckoutService()
+    cashier_id, product_id = cashier_user.id, test_product.id
+    first = service.checkout(cashier_id, [(product_id, 2)], idempotency_key='key-1')
+    with capture_queries() as stats:
+        again = service.checkout(cashier_id, [(product_id, 2)], idempotency_key='key-1')
+    assert again == first and stats.count == 0
+    assert ProductRepo().get_by_id(product_id).stock_quantity == 8
+
+    with pytest.raises(CheckoutError):
+        service.checkout(cashier_id, [(product_id, 50)], idempotency_key='key-2')
+    with capture_queries() as stats, pytest.raises(CheckoutError):
+        service.checkout(cashier_id, [(product_id, 50)], idempotency_key='key-2')
+    assert stats.count == 0
+
+    # Повтор, попавший в другой процесс: ключ находится в чеке
+    checkout_keys.clear()
+    replay = service.checkout(cashier_id, [(product_id, 2)], idempotency_key='key-1')
+    assert replay[0]['receipt_id'] == first[0]['receipt_id']
+    assert Receipt.query.count() == 1
+    assert ProductRepo().get_by_id(product_id).stock_quantity == 8
+
+    # Тот же ключ с другой корзиной или оплатой отклоняется - в памяти и по чеку
+    for reused in ([(product_id, 3)], [(product_id, 1), (product_id, 1)]):
+        with pytest.raises(CheckoutError) as error:
+            service.checkout(cashier_id, reused, idempotency_key='key-1')
+        assert 'уже использован' in error.value.errors[0]
+    checkout_keys.clear()
+    with pytest.raises(CheckoutError) as error:
+        service.checkout(cashier_id, [(product_id, 2)], paid_amount=Decimal('500'), idempotency_key='key-1')
+    assert 'уже использован' in error.value.errors[0]
+    assert Receipt.query.count() == 1
+    assert ProductRepo().get_by_id(product_id).stock_quantity == 8
+
+    app.config['IDEMPOTENCY_MAX_KEYS'] = 2
+    store = IdempotencyStore()
+    for key in ('a', 'b', 'c'):
+        store.run(key, lambda: key)
+    assert len(store._entries()) == 2
+
+    # У другого приложения процесса свои ключи
+    other = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with other.app_context():
+        assert store.run('c', lambda: 'other') == ('other', False)
+    assert store.run('c', lambda: 'again') == ('c', True)
+
+    # Одновременные запросы с одним ключом: действие выполняется один раз
+    calls = []
+
+    def slow_action():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'done'
+
+    def submit(results):
+        with app.app_context():
+            results.append(store.run('same', slow_action))
+
+    results = []
+    threads = [threading.Thread(target=submit, args=(results,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    assert sorted(results) == [('done', False), ('done', True)]
+    app.config['IDEMPOTENCY_MAX_KEYS'] = 10000
+
+    client.post('/auth/login', data={
+        'username': 'cashier',
+        'password': 'cashier123'
+    }, follow_redirects=True)
+    data = {'product_ids': [str(product_id)], 'quantities': ['1'], 'confirmed': 'on',
+            'idempotency_key': 'form-key'}
+    for _ in range(2):
+        response = client.post('/sales/create', data=data)
+        assert response.status_code == 302 and response.headers['Location'].endswith('/sales/')
+    assert Receipt.query.count() == 2
+    assert ProductRepo().get_by_id(product_id).stock_quantity == 7
+
+
+# Тест оптимистичных блокировок товара: версия, конфликт формы и повтор продажи
+def test_49_product_versions(client, admin_user, cashier_user, test_product, monkeypatch):
+    from datetime import datetime
+    from app.models.checkout import CheckoutService
+    from app.models.product import ProductConflict
+
+    repo = ProductRepo()
+    product_id = test_product.id
+    assert test_product.version == 1
+    assert repo.update(product_id, stock_quantity=12).version == 2
+    with pytest.raises(ProductConflict) as conflict:
+        repo.update(product_id, stock_quantity=3, expected_version=1)
+    assert conflict.value.product.stock_quantity == 12
+    assert repo.update(product_id, price=Decimal('150.00'), expected_version=2).stock_quantity == 12
+
+    # Продажа увеличивает версию, поэтому форма директора, открытая до продажи, не затрет остаток
+    client.post('/auth/login', data={'username': 'admin', 'password': 'admin123'})
+    form = client.get(f'/products/{product_id}/edit')
+    assert b'name="version" value="3"' in form.data
+    CheckoutService().checkout(cashier_user.id, [(product_id, 2)])
+    data = {'name': 'Тестовый товар', 'category': 'Крем', 'price': '150.00', 'stock_quantity': '12', 'version': '3',
+            'description': 'Новое описание'}
+    response = client.post(f'/products/{product_id}/edit', data=data)
+    assert response.status_code == 409
+    assert 'сейчас на складе 10 шт.'.encode('utf-8') in response.data
+    assert b'name="version" value="4"' in response.data
+    # Введенные значения сохраняются в форме, остаток показывается текущий
+    assert 'Новое описание</textarea>'.encode('utf-8') in response.data
+    assert b'name="stock_quantity" min="0" value="10"' in response.data
+    assert repo.get_by_id(product_id).stock_quantity == 10
+    response = client.post(f'/products/{product_id}/edit', data=dict(data, stock_quantity='20', version='4'))
+    assert response.status_code == 302
+    assert repo.get_by_id(product_id).stock_quantity == 20
+
+    # Цену изменили между чтением товара и списанием: продажа повторяется по новой цене
+    products = Product.__table__
+
+    class ConcurrentEdit(datetime):
+        calls = 0
+
+        @classmethod
+        def utcnow(cls):
+            if not cls.calls:
+                with db.engine.begin() as connection:
+                    connection.execute(products.update().values(price=Decimal('200.00'), version=products.c.version + 1))
+            cls.calls += 1
+            return datetime.utcnow()
+
+    monkeypatch.setattr('app.models.checkout.datetime', ConcurrentEdit)
+    lines = CheckoutService().checkout(cashier_user.id, [(product_id, 1)])
+    assert ConcurrentEdit.calls == 2
+    assert lines[0]['total_price'] == Decimal('200.00')
+    product = repo.get_by_id(product_id)
+    assert (product.stock_quantity, product.version) == (19, 7)
+
+    # Продажа на другой кассе меняет только остаток: списание проходит с первой попытки
+    class ConcurrentSale(datetime):
+        calls = 0
+
+        @classmethod
+        def utcnow(cls):
+            if not cls.calls:
+                with db.engine.begin() as connection:
+                    connection.execute(products.update().values(stock_quantity=products.c.stock_quantity - 1,
+                                                                version=products.c.version + 1))
+            cls.calls += 1
+            return datetime.utcnow()
+
+    monkeypatch.setattr('app.models.checkout.datetime', ConcurrentSale)
+    CheckoutService().checkout(cashier_user.id, [(product_id, 1)])
+    assert ConcurrentSale.calls == 1
+    product = repo.get_by_id(product_id)
+    assert (product.stock_quantity, product.version) == (17, 9)
+
+
+# Тест резервов корзины: остаток на складе не меняется до продажи, продажа из резерва, снятие истекших
+def test_50_stock_reservations(client, admin_user, cashier_user, test_product):
+    from datetime import datetime, timedelta
+    from app.models.checkout import CheckoutService, CheckoutError
+    from app.models.metrics import registry
+    from app.models.query_plans import check_query_plans
+    from app.models.query_stats import capture_queries
+    from app.models.receipt import Receipt
+    from app.models.reservation import ReservationError, ReservationService, StockReservation, reservations
+
+    repo = ProductRepo()
+    service = reservations
+    cashier_id, admin_id, product_id = cashier_user.id, admin_user.id, test_product.id
+
+    # Резерв уменьшает только свободный остаток, замена резерва не трогает товар
+    service.reserve('cart-1', cashier_id, [(product_id, 3)])
+    service.reserve('cart-1', cashier_id, [(product_id, 4)])
+    product = repo.get_by_id(product_id)
+    assert (product.stock_quantity, product.version) == (10, 1)
+    with pytest.raises(ReservationError) as error:
+        service.reserve('cart-2', admin_id, [(product_id, 7)])
+    assert 'Доступно: 6' in error.value.errors[0]
+    with pytest.raises(ReservationError):
+        service.reserve('cart-1', cashier_id, [(product_id, 11)])
+    assert service.get('cart-1', cashier_id).items == {product_id: 4}
+    assert service.get('cart-1', admin_id) is None
+
+    # Продление тем же составом сдвигает только срок
+    seq = product.change_seq
+    expires_at = StockReservation.query.one().expires_at
+    assert service.reserve('cart-1', cashier_id, [(product_id, 4)]) >= expires_at
+    product = repo.get_by_id(product_id)
+    assert (product.version, product.change_seq) == (1, seq)
+
+    # Директор сохраняет форму, пока товар отложен: записывается ровно введенный остаток
+    assert repo.update(product_id, stock_quantity=12, expected_version=1).stock_quantity == 12
+
+    # Другая касса не может продать отложенное, продажа из резерва списывает остаток
+    with pytest.raises(CheckoutError) as error:
+        CheckoutService().checkout(admin_id, [(product_id, 9)])
+    assert 'Доступно: 8' in error.value.errors[0]
+
+    # Недостаточная оплата при продаже из резерва: отказ учитывается один раз, резерв остается
+    def rejected():
+        return sum(value for name, _, value in registry.snapshot()['values']
+                   if name == 'cosmeticshop_checkout_rejected_total')
+    before = rejected()
+    with pytest.raises(CheckoutError):
+        CheckoutService().checkout(cashier_id, [(product_id, 4)], paid_amount=Decimal('1'), cart_id='cart-1')
+    assert rejected() == before + 1
+    assert service.get('cart-1', cashier_id).items == {product_id: 4}
+    with capture_queries() as stats:
+        lines = CheckoutService().checkout(cashier_id, [(product_id, 4)], cart_id='cart-1')
+    assert lines[0]['total_price'] == Decimal('400.00')
+    assert stats.count <= 8
+    assert repo.get_by_id(product_id).stock_quantity == 8
+    assert StockReservation.query.count() == 0 and Receipt.query.count() == 1
+
+    # Корзина изменилась после резерва: резерв снимается, продажа идет обычным путем
+    service.reserve('cart-3', cashier_id, [(product_id, 5)])
+    CheckoutService().checkout(cashier_id, [(product_id, 2)], cart_id='cart-3')
+    assert repo.get_by_id(product_id).stock_quantity == 6
+    assert StockReservation.query.count() == 0
+
+    # Резерв из другого процесса находится в базе; истекшие снимаются одним проходом
+    service.reserve('cart-4', cashier_id, [(product_id, 1)])
+    service.reserve('cart-5', admin_id, [(product_id, 2)])
+    assert repo.get_by_id(product_id).stock_quantity == 6
+    assert ReservationService().get('cart-4', cashier_id).items == {product_id: 1}
+    assert service.release_expired() == 0
+    assert service.release_expired(datetime.utcnow() + timedelta(hours=1)) == 2
+    assert repo.get_by_id(product_id).stock_quantity == 6
+    assert service.get('cart-4', cashier_id) is None
+
+    # API страницы кассы; дельта каталога показывает свободный остаток
+    client.post('/auth/login', data={'username': 'cashier', 'password': 'cashier123'})
+    catalog = client.get('/api/v1/catalog').get_json()
+    assert catalog['products'][0]['available'] == 6
+    response = client.put('/api/v1/reservations/page-cart', json={'items': [{'product_id': product_id, 'quantity': 3}]})
+    assert response.status_code == 200 and response.get_json()['items'] == [{'product_id': product_id, 'quantity': 3}]
+    delta = client.get(f'/api/v1/catalog?since={catalog["seq"]}').get_json()
+    assert [(item['stock_quantity'], item['available']) for item in delta['products']] == [(6, 3)]
+    response = client.put('/api/v1/reservations/page-cart', json={'items': [{'product_id': product_id, 'quantity': 9}]})
+    assert response.status_code == 409
+    assert client.put('/api/v1/reservations/page-cart', json={'items': [{'quantity': 1}]}).status_code == 400
+    response = client.post('/sales/create', data={'product_ids': [str(product_id)], 'quantities': ['3'],
+                                                  'confirmed': 'on', 'cart_id': 'page-cart'})
+    assert response.status_code == 302 and response.headers['Location'].endswith('/sales/')
+    assert repo.get_by_id(product_id).stock_quantity == 3
+    client.put('/api/v1/reservations/other-cart', json={'items': [{'product_id': product_id, 'quantity': 1}]})
+    assert client.delete('/api/v1/reservations/other-cart').status_code == 204
+    assert repo.get_by_id(product_id).stock_quantity == 3
+
+    assert not [p for p in check_query_plans() if p[0].startswith('ReservationService')]
+
+
+# Тест фабрики приложения: создание без обращения к базе, команды init-db и seed-users
+def test_51_app_factory(tmp_path):
+    import subprocess
+    import sys
+    import time
+    from sqlalchemy import inspect
+    from app.models.migrations import MIGRATIONS, get_schema_version
+    from app.models.reservation import StockReservation, reservations
+
+    path = tmp_path / 'factory.db'
+    code = ('from app.startservice import create_app; import app.wsgi; '
+            f'create_app({{"SQLALCHEMY_DATABASE_URI": "sqlite:///{path}"}})')
+    subprocess.run([sys.executable, '-c', code], check=True)
+    assert not path.exists()
+
+    first = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'RESERVATION_TTL': 5})
+    second = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "other.db"}'})
+    assert (first.config['RESERVATION_TTL'], second.config['RESERVATION_TTL']) == (5, 300)
+    assert 'sales.create_sale' in {rule.endpoint for rule in first.url_map.iter_rules()}
+
+    runner = first.test_cli_runner()
+    assert 'применено миграций' in runner.invoke(args=['init-db']).output
+    assert 'Добавлено пользователей: 2' in runner.invoke(args=['seed-users']).output
+    assert 'Добавлено пользователей: 0' in runner.invoke(args=['seed-users']).output
+    with first.app_context():
+        assert 'stock_reservations' in inspect(db.engine).get_table_names()
+        with db.engine.connect() as connection:
+            assert get_schema_version(connection) == MIGRATIONS[-1][0]
+        assert UserRepo().get_by_username('1').role == ROLE_DIRECTOR
+        db.engine.dispose()
+    with second.app_context():
+        assert 'products' not in inspect(db.engine).get_table_names()
+        db.engine.dispose()
+
+    # У каждого приложения процесса свой поток снятия истекших резервов
+    apps = [create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / f"sweep-{n}.db"}',
+                        'RESERVATION_TTL': 1}) for n in range(2)]
+    for each in apps:
+        each.test_cli_runner().invoke(args=['init-db'])
+        each.test_cli_runner().invoke(args=['seed-users'])
+        with each.app_context():
+            product = ProductRepo().add('Крем', 'Крем', Decimal('100.00'), 5)
+            reservations.reserve('cart', UserRepo().get_by_username('2').id, [(product.id, 2)])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        remaining = 0
+        for each in apps:
+            with each.app_context():
+                remaining += StockReservation.query.count()
+                db.session.remove()
+        if not remaining:
+            break
+        time.sleep(0.2)
+    assert remaining == 0
+    for each in apps:
+        with each.app_context():
+            db.engine.dispose()